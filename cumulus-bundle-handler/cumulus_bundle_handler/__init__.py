@@ -83,13 +83,28 @@ def main():
         LOGGER.error('Missing "bundle-types" in metadata.conf')
         sys.exit(1)
 
-    if args.keep_old_files:
-        LOGGER.info('Keeping files from previous deployment')
+    bundle_types = [bundle_type.strip() for bundle_type in bundle_types]
+
+    # Delta bundles are only used if there is one for every bundle type,
+    # otherwise all files are replaced as usual
+    deltas = {}
+    if not args.no_delta:
+        for bundle_type in bundle_types:
+            deltas[bundle_type] = bundle_manager.get_delta(bundle_type)
+
+    if deltas and all(deltas.values()):
+        LOGGER.info('Applying delta bundles')
+        for bundle_type in bundle_types:
+            bundle_manager.apply_delta(bundle_type, deltas[bundle_type])
     else:
-        _remove_old_files()
-
-    for bundle_type in bundle_types:
-        bundle_manager.download_and_unpack_bundle(bundle_type.strip())
+        if args.keep_old_files:
+            LOGGER.info('Keeping files from previous deployment')
+        else:
+            bundle_manager.clear_installed_versions()
+            _remove_old_files()
+
+        for bundle_type in bundle_types:
+            bundle_manager.download_and_unpack_bundle(bundle_type)
 
     script_executor.run_init_scripts(kill=False, start=True, other=True)
 
@@ -1,9 +1,19 @@
 """ Bundle manager responsible for download and extraction of bundle """
+import hashlib
+import json
 import logging
 import os
+import posixpath
+import shutil
+import stat
 import sys
+import tarfile
 import tempfile
+import threading
+import time
 import zipfile
+import zlib
+from multiprocessing.pool import ThreadPool
 
 from cumulus_bundle_handler import config
 
@@ -14,12 +24,113 @@ else:
 
 try:
     from boto import s3
+    from boto.exception import S3ResponseError
 except ImportError:
     print('Could not import boto. Try installing it with "pip install boto"')
     sys.exit(1)
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 LOGGER = logging.getLogger('cumulus_bundle_handler')
 
+# Bundle formats, in the order they are looked for
+BUNDLE_FORMATS = ['zip', 'tar.gz', 'tar.zst', 'objects.json']
+
+# Supported delta bundle description format
+DELTA_FORMAT = 1
+
+# Supported content addressed bundle manifest format
+OBJECTS_FORMAT = 1
+
+# Number of objects to download in parallel
+DOWNLOAD_WORKERS = 8
+
+# Objects not used for this many days are removed from the object cache
+OBJECT_CACHE_MAX_AGE = 30
+
+# Read downloads in chunks of this size
+CHUNK_SIZE = 1024 * 1024
+
+
+def apply_delta(bundle_type, delta):
+    """ Apply a delta bundle on top of the installed version
+
+    The delta bundle is downloaded and verified before any files are
+    changed. If that fails, the deleted files are removed and the full
+    bundle is unpacked instead.
+
+    :type bundle_type: str
+    :param bundle_type: Bundle type
+    :type delta: dict
+    :param delta: Delta description from get_delta()
+    """
+    extraction_path = _get_extraction_path(bundle_type)
+
+    bundle = tempfile.NamedTemporaryFile(
+        suffix='.zip',
+        delete=False)
+    bundle.close()
+
+    try:
+        try:
+            LOGGER.info("Downloading s3://{}/{} to {}".format(
+                config.get('bundle-bucket'),
+                delta['key'].name,
+                bundle.name))
+            delta['key'].get_contents_to_filename(bundle.name)
+
+            archive = zipfile.ZipFile(bundle.name, 'r')
+            try:
+                bad_file = archive.testzip()
+                filenames = archive.namelist()
+            finally:
+                archive.close()
+
+            if bad_file:
+                raise zipfile.BadZipfile('Bad CRC for {}'.format(bad_file))
+
+            if sorted(filenames) != sorted(delta['changed']):
+                raise zipfile.BadZipfile(
+                    'The delta bundle does not match its description')
+        except Exception as err:
+            LOGGER.warning(
+                'Unable to use the delta bundle: {}. '
+                'Falling back to the full bundle'.format(err))
+            _remove_bundle_files(delta['deleted'], extraction_path)
+            download_and_unpack_bundle(bundle_type)
+            return
+
+        LOGGER.info(
+            'Applying delta from version {} to {}: '
+            '{:d} changed and {:d} deleted files'.format(
+                delta['base-version'],
+                delta['version'],
+                len(delta['changed']),
+                len(delta['deleted'])))
+        _remove_bundle_files(delta['deleted'], extraction_path)
+        success = _extract_zip(bundle.name, extraction_path)
+        _update_bundle_files(
+            delta['changed'], delta['deleted'], extraction_path)
+
+        if success:
+            _store_installed_version(bundle_type, extraction_path)
+    finally:
+        LOGGER.info("Removing temporary file {}".format(bundle.name))
+        os.remove(bundle.name)
+
+
+def clear_installed_versions():
+    """ Forget which bundle versions are installed
+
+    Call this when the files of the installed bundles are removed.
+    """
+    state_file = _get_state_file()
+    if ospath.exists(state_file):
+        os.remove(state_file)
+
 
 def download_and_unpack_bundle(bundle_type):
     """ Download the bundle from AWS S3
@@ -34,39 +145,77 @@ def download_and_unpack_bundle(bundle_type):
         LOGGER.error('No bundle found. Exiting.')
         sys.exit(0)
 
-    bundle = tempfile.NamedTemporaryFile(
-        suffix='.zip',
-        delete=False)
-    bundle.close()
-    LOGGER.info("Downloading s3://{}/{} to {}".format(
-        config.get('bundle-bucket'),
-        key.name,
-        bundle.name))
-    key.get_contents_to_filename(bundle.name)
-
     extraction_path = _get_extraction_path(bundle_type)
 
-    # Unpack the bundle
-    archive = zipfile.ZipFile(bundle.name, 'r')
-    _store_bundle_files(archive.namelist(), extraction_path)
+    if key.name.endswith('.zip'):
+        success = _unpack_zip(key, extraction_path)
+    elif key.name.endswith('.objects.json'):
+        success = _unpack_objects(key, extraction_path)
+    else:
+        success = _unpack_tar(key, extraction_path)
 
-    try:
-        LOGGER.info('Unpacking {} to {}'.format(bundle.name, extraction_path))
-        archive.extractall(extraction_path)
-        for info in archive.infolist():
-            archive.extract(info, extraction_path)
-            if not ospath.isdir(ospath.join(extraction_path, info.filename)):
-                os.chmod(
-                    ospath.join(extraction_path, info.filename),
-                    info.external_attr >> 16)
-    except Exception as err:
-        LOGGER.error('Error when unpacking bundle: {}'.format(err))
-    finally:
-        archive.close()
+    if success:
+        _store_installed_version(bundle_type, extraction_path)
 
-    # Remove the downloaded package
-    LOGGER.info("Removing temporary file {}".format(bundle.name))
-    os.remove(bundle.name)
+
+def get_delta(bundle_type):
+    """ Find a delta bundle from the installed version
+
+    :type bundle_type: str
+    :param bundle_type: Bundle type
+    :returns: dict or None -- Delta description with the delta bundle key
+        in 'key', or None if no delta bundle can be used
+    """
+    installed = _load_installed_versions().get(bundle_type)
+    if not installed:
+        LOGGER.debug('No installed version of {} known'.format(bundle_type))
+        return None
+
+    if (installed.get('environment') != config.get('environment') or
+            installed.get('extraction-path') !=
+            _get_extraction_path(bundle_type)):
+        LOGGER.debug('Installed {} bundle is from another setup'.format(
+            bundle_type))
+        return None
+
+    base_version = installed.get('version')
+    if base_version == config.get('version'):
+        LOGGER.debug('Version {} of {} is already installed'.format(
+            base_version, bundle_type))
+        return None
+
+    bucket = _get_bucket()
+    description_key = _lookup_key(
+        bucket,
+        _get_key_name(bundle_type, 'delta-{}.json'.format(base_version)))
+    if not description_key:
+        LOGGER.debug('No delta bundle for {} from version {}'.format(
+            bundle_type, base_version))
+        return None
+
+    try:
+        delta = json.loads(description_key.get_contents_as_string())
+    except ValueError as err:
+        LOGGER.warning('Ignoring broken delta description {}: {}'.format(
+            description_key.name, err))
+        return None
+
+    if (delta.get('format') != DELTA_FORMAT or
+            delta.get('base-version') != base_version):
+        LOGGER.warning('Ignoring unsupported delta description {}'.format(
+            description_key.name))
+        return None
+
+    delta['key'] = _lookup_key(
+        bucket,
+        _get_key_name(bundle_type, 'delta-{}.zip'.format(base_version)))
+    if not delta['key']:
+        LOGGER.warning('Delta bundle missing for {}'.format(
+            description_key.name))
+        return None
+
+    LOGGER.debug('Found delta bundle {}'.format(delta['key'].name))
+    return delta
 
 
 def _get_extraction_path(bundle_type):
@@ -110,12 +259,84 @@ def _get_extraction_path(bundle_type):
     return path
 
 
-def _get_key(bundle_type):
-    """ Returns the bundle key
+def _extract_zip(filename, extraction_path):
+    """ Extract a zip archive, keeping the file permissions
 
-    :type bundle_type: str
-    :param bundle_type: Bundle type to download
-    :returns: boto.s3.key -- S3 key object
+    Symbolic link entries are recreated as links after all files are
+    extracted. On Windows the link target is copied instead.
+
+    :type filename: str
+    :param filename: Path to the zip archive
+    :type extraction_path: str
+    :param extraction_path: Path to extract the archive to
+    :returns: bool -- True if all files were extracted
+    """
+    archive = zipfile.ZipFile(filename, 'r')
+
+    success = False
+    try:
+        LOGGER.info('Unpacking {} to {}'.format(filename, extraction_path))
+        links = []
+        for info in archive.infolist():
+            if _is_link_entry(info):
+                links.append((info.filename, archive.read(info)))
+                continue
+
+            path = ospath.join(extraction_path, info.filename)
+
+            # Do not write through links from a previous deployment
+            if ospath.islink(path):
+                os.remove(path)
+
+            archive.extract(info, extraction_path)
+            if not ospath.isdir(path):
+                os.chmod(path, info.external_attr >> 16)
+
+        for link_name, target in links:
+            _create_link(link_name, target, extraction_path)
+        success = True
+    except Exception as err:
+        LOGGER.error('Error when unpacking bundle: {}'.format(err))
+    finally:
+        archive.close()
+
+    return success
+
+
+def _create_link(link_name, target, extraction_path):
+    """ Create a symbolic link from a bundle
+
+    :type link_name: str
+    :param link_name: Name of the link within the bundle
+    :type target: str
+    :param target: Link target, relative to the directory of the link
+    :type extraction_path: str
+    :param extraction_path: Path the bundle is extracted to
+    """
+    resolved = posixpath.normpath(
+        posixpath.join(posixpath.dirname(link_name), target))
+    if target.startswith('/') or not _is_safe_name(resolved):
+        LOGGER.warning('Skipping unsafe link {} -> {}'.format(
+            link_name, target))
+        return
+
+    path = ospath.join(extraction_path, *link_name.split('/'))
+    if not ospath.exists(ospath.dirname(path)):
+        os.makedirs(ospath.dirname(path))
+    if ospath.lexists(path):
+        os.remove(path)
+
+    if sys.platform in ['win32', 'cygwin']:
+        shutil.copy2(
+            ospath.join(extraction_path, *resolved.split('/')), path)
+    else:
+        os.symlink(target, path)
+
+
+def _get_bucket():
+    """ Returns the bundle bucket
+
+    :returns: boto.s3.bucket.Bucket
     """
     LOGGER.debug("Connecting to AWS S3")
     connection = s3.connect_to_region(
@@ -126,26 +347,234 @@ def _get_key(bundle_type):
     # Get the relevant bucket
     bucket_name = config.get('bundle-bucket')
     LOGGER.debug('Using bucket {}'.format(bucket_name))
-    bucket = connection.get_bucket(bucket_name)
+    return connection.get_bucket(bucket_name)
+
+
+def _get_cache_file():
+    """ Returns the path to the file listing all installed bundle files
+
+    :returns: str -- Path
+    """
+    if sys.platform in ['win32', 'cygwin']:
+        if not ospath.exists('C:\\cumulus\\cache'):
+            os.makedirs('C:\\cumulus\\cache')
+        return 'C:\\cumulus\\cache\\cumulus-bundle-handler.cache'
+
+    return '/var/local/cumulus-bundle-handler.cache'
+
+
+def _get_cache_entry(extraction_path, filename):
+    """ Returns the full path of a bundle file, as stored in the cache file
+
+    :type extraction_path: str
+    :param extraction_path: Path the bundle was extracted to
+    :type filename: str
+    :param filename: File name within the bundle
+    :returns: str -- Path
+    """
+    if sys.platform in ['win32', 'cygwin']:
+        return '{}\\{}'.format(extraction_path, filename)
+
+    return '{}/{}'.format(extraction_path, filename)
+
+
+def _get_key(bundle_type):
+    """ Returns the bundle key
+
+    :type bundle_type: str
+    :param bundle_type: Bundle type to download
+    :returns: boto.s3.key -- S3 key object
+    """
+    bucket = _get_bucket()
 
     # Download the bundle
-    key_name = (
-        '{env}/{version}/bundle-{env}-{version}-{bundle}.zip'.format(
-            env=config.get('environment'),
-            version=config.get('version'),
-            bundle=bundle_type))
-    LOGGER.debug('Looking for bundle {}'.format(key_name))
-    key = bucket.get_key(key_name)
-
-    # When we have found a key, don't look any more
-    if key:
-        LOGGER.debug('Found bundle: {}'.format(key_name))
-        return key
+    for bundle_format in BUNDLE_FORMATS:
+        key = _lookup_key(bucket, _get_key_name(bundle_type, bundle_format))
+
+        # When we have found a key, don't look any more
+        if key:
+            return key
 
-    LOGGER.debug('Bundle not found: {}'.format(key_name))
     return None
 
 
+def _get_key_name(bundle_type, suffix):
+    """ Returns the name of a bundle key for the configured version
+
+    :type bundle_type: str
+    :param bundle_type: Bundle type
+    :type suffix: str
+    :param suffix: Key name suffix, e.g. zip
+    :returns: str -- Key name
+    """
+    return '{env}/{version}/bundle-{env}-{version}-{bundle}.{suffix}'.format(
+        env=config.get('environment'),
+        version=config.get('version'),
+        bundle=bundle_type,
+        suffix=suffix)
+
+
+def _get_object_cache_dir():
+    """ Returns the path to the local cache of content addressed objects
+
+    :returns: str -- Path
+    """
+    if sys.platform in ['win32', 'cygwin']:
+        return 'C:\\cumulus\\cache\\objects'
+
+    return '/var/local/cumulus-bundle-handler-objects'
+
+
+def _get_object_path(cache_dir, sha1):
+    """ Returns the path to a cached object
+
+    :type cache_dir: str
+    :param cache_dir: Object cache directory
+    :type sha1: str
+    :param sha1: SHA1 hex digest of the file content
+    :returns: str -- Path
+    """
+    return ospath.join(cache_dir, sha1[:2], sha1)
+
+
+def _get_state_file():
+    """ Returns the path to the file listing the installed versions
+
+    :returns: str -- Path
+    """
+    if sys.platform in ['win32', 'cygwin']:
+        if not ospath.exists('C:\\cumulus\\cache'):
+            os.makedirs('C:\\cumulus\\cache')
+        return 'C:\\cumulus\\cache\\cumulus-bundle-handler.versions'
+
+    return '/var/local/cumulus-bundle-handler.versions'
+
+
+def _is_link_entry(info):
+    """ Check if a zip entry is a symbolic link
+
+    :type info: zipfile.ZipInfo
+    :param info: Zip entry
+    :returns: bool -- True for symbolic links created on Unix
+    """
+    return info.create_system == 3 and stat.S_ISLNK(info.external_attr >> 16)
+
+
+def _is_safe_member(member):
+    """ Check that a tar member can be extracted safely
+
+    Only regular files and directories within the extraction path are
+    allowed.
+
+    :type member: tarfile.TarInfo
+    :param member: Archive member
+    :returns: bool -- True if the member can be extracted
+    """
+    if not (member.isfile() or member.isdir()):
+        return False
+
+    return _is_safe_name(member.name)
+
+
+def _is_safe_name(filename):
+    """ Check that a file name within a bundle stays in the extraction path
+
+    :type filename: str
+    :param filename: File name within the bundle
+    :returns: bool -- True if the file can be extracted
+    """
+    if filename.startswith('/') or '..' in filename.split('/'):
+        return False
+
+    return True
+
+
+def _load_installed_versions():
+    """ Returns the installed bundle versions
+
+    :returns: dict -- Bundle type to dict with environment, version and
+        extraction-path
+    """
+    state_file = _get_state_file()
+    if not ospath.exists(state_file):
+        return {}
+
+    try:
+        with open(state_file, 'r') as file_handle:
+            return json.load(file_handle)
+    except ValueError as err:
+        LOGGER.warning('Ignoring broken state file {}: {}'.format(
+            state_file, err))
+        return {}
+
+
+def _lookup_key(bucket, key_name):
+    """ Returns a key, or None if it does not exist
+
+    :type bucket: boto.s3.bucket.Bucket
+    :param bucket: Bundle bucket
+    :type key_name: str
+    :param key_name: Key name
+    :returns: boto.s3.key.Key or None
+    """
+    LOGGER.debug('Looking for {}'.format(key_name))
+
+    try:
+        key = bucket.get_key(key_name)
+    except S3ResponseError as error:
+        # Missing keys give 403 without the s3:ListBucket permission
+        if error.status != 403:
+            raise
+        key = None
+
+    if key:
+        LOGGER.debug('Found {}'.format(key_name))
+    else:
+        LOGGER.debug('Not found: {}'.format(key_name))
+
+    return key
+
+
+def _prune_object_cache(cache_dir):
+    """ Remove objects that have not been used for OBJECT_CACHE_MAX_AGE days
+
+    :type cache_dir: str
+    :param cache_dir: Object cache directory
+    """
+    limit = time.time() - OBJECT_CACHE_MAX_AGE * 24 * 3600
+
+    for root, _, files in os.walk(cache_dir):
+        for basename in files:
+            path = ospath.join(root, basename)
+            if ospath.getmtime(path) < limit:
+                LOGGER.debug('Removing unused object {}'.format(path))
+                os.remove(path)
+
+
+def _remove_bundle_files(filenames, extraction_path):
+    """ Remove files deleted from a bundle
+
+    Directories left empty are removed as well.
+
+    :type filenames: list
+    :param filenames: File names within the bundle
+    :type extraction_path: str
+    :param extraction_path: Path the bundle was extracted to
+    """
+    for filename in filenames:
+        path = ospath.join(extraction_path, *filename.split('/'))
+        if not (ospath.isfile(path) or ospath.islink(path)):
+            continue
+
+        LOGGER.debug('Removing file {}'.format(path))
+        os.remove(path)
+
+        try:
+            os.removedirs(ospath.dirname(path))
+        except OSError:
+            pass
+
+
 def _store_bundle_files(filenames, extraction_path):
     """ Store a list of bundle paths
 
@@ -154,11 +583,7 @@ def _store_bundle_files(filenames, extraction_path):
     :type extraction_path: str
     :param extraction_path: Path to prefix all filenames with
     """
-    cache_file = '/var/local/cumulus-bundle-handler.cache'
-    if sys.platform in ['win32', 'cygwin']:
-        if not ospath.exists('C:\\cumulus\\cache'):
-            os.makedirs('C:\\cumulus\\cache')
-        cache_file = 'C:\\cumulus\\cache\\cumulus-bundle-handler.cache'
+    cache_file = _get_cache_file()
 
     file_handle = open(cache_file, 'a')
     try:
@@ -166,13 +591,310 @@ def _store_bundle_files(filenames, extraction_path):
             if not filename:
                 continue
 
-            if sys.platform in ['win32', 'cygwin']:
-                filename = '{}\\{}'.format(extraction_path, filename)
-            else:
-                filename = '{}/{}'.format(extraction_path, filename)
-
-            file_handle.write('{}\n'.format(filename))
+            file_handle.write('{}\n'.format(
+                _get_cache_entry(extraction_path, filename)))
 
         LOGGER.debug('Stored bundle information in {}'.format(cache_file))
     finally:
         file_handle.close()
+
+
+def _store_installed_version(bundle_type, extraction_path):
+    """ Store the version of a bundle that was installed
+
+    :type bundle_type: str
+    :param bundle_type: Bundle type
+    :type extraction_path: str
+    :param extraction_path: Path the bundle was extracted to
+    """
+    versions = _load_installed_versions()
+    versions[bundle_type] = {
+        'environment': config.get('environment'),
+        'version': config.get('version'),
+        'extraction-path': extraction_path
+    }
+
+    state_file = _get_state_file()
+    with open(state_file, 'w') as file_handle:
+        json.dump(versions, file_handle)
+
+    LOGGER.debug('Stored installed version in {}'.format(state_file))
+
+
+def _unpack_objects(key, extraction_path):
+    """ Install a content addressed bundle
+
+    The objects that are not in the local object cache are downloaded
+    first. The files are then copied from the cache.
+
+    :type key: boto.s3.key.Key
+    :param key: S3 key of the object manifest
+    :type extraction_path: str
+    :param extraction_path: Path to extract the bundle to
+    :returns: bool -- True if all files were extracted
+    """
+    try:
+        objects = json.loads(key.get_contents_as_string())
+    except ValueError as err:
+        LOGGER.error('Broken object manifest {}: {}'.format(key.name, err))
+        return False
+
+    if objects.get('format') != OBJECTS_FORMAT:
+        LOGGER.error('Unsupported object manifest format in {}'.format(
+            key.name))
+        return False
+
+    cache_dir = _get_object_cache_dir()
+
+    missing = {}
+    for entry in objects['files'].values():
+        if not ospath.exists(_get_object_path(cache_dir, entry['sha1'])):
+            missing[entry['sha1']] = entry['key']
+
+    LOGGER.info(
+        'Downloading {:d} of {:d} objects from s3://{}, '
+        'the rest is cached'.format(
+            len(missing), len(objects['files']), config.get('bundle-bucket')))
+
+    downloader = _ObjectDownloader(cache_dir)
+    pool = ThreadPool(DOWNLOAD_WORKERS)
+    try:
+        pool.map(downloader.download, missing.items())
+    except Exception as err:
+        LOGGER.error('Error when downloading objects: {}'.format(err))
+        return False
+    finally:
+        pool.close()
+        pool.join()
+
+    LOGGER.info('Unpacking s3://{}/{} to {}'.format(
+        config.get('bundle-bucket'),
+        key.name,
+        extraction_path))
+
+    filenames = []
+    success = False
+    try:
+        for filename in sorted(objects['files'].keys()):
+            entry = objects['files'][filename]
+            if not _is_safe_name(filename):
+                LOGGER.warning('Skipping unsafe bundle entry {}'.format(
+                    filename))
+                continue
+
+            path = ospath.join(extraction_path, *filename.split('/'))
+            if not ospath.exists(ospath.dirname(path)):
+                os.makedirs(ospath.dirname(path))
+
+            source = _get_object_path(cache_dir, entry['sha1'])
+            shutil.copyfile(source, path)
+            os.chmod(path, entry['mode'] & 07777)
+
+            # Mark the object as used
+            os.utime(source, None)
+
+            filenames.append(filename)
+        success = True
+    except Exception as err:
+        LOGGER.error('Error when unpacking bundle: {}'.format(err))
+
+    _store_bundle_files(filenames, extraction_path)
+    _prune_object_cache(cache_dir)
+
+    return success
+
+
+def _unpack_tar(key, extraction_path):
+    """ Unpack a tar bundle while it is being downloaded
+
+    :type key: boto.s3.key.Key
+    :param key: S3 key of the bundle
+    :type extraction_path: str
+    :param extraction_path: Path to extract the bundle to
+    :returns: bool -- True if all files were extracted
+    """
+    if key.name.endswith('.tar.zst'):
+        if not zstandard:
+            LOGGER.error(
+                'Could not import zstandard, needed for {}. Try installing '
+                'it with "pip install zstandard"'.format(key.name))
+            sys.exit(1)
+
+        file_handle = zstandard.ZstdDecompressor().stream_reader(key)
+        mode = 'r|'
+    else:
+        file_handle = key
+        mode = 'r|gz'
+
+    LOGGER.info('Unpacking s3://{}/{} to {}'.format(
+        config.get('bundle-bucket'),
+        key.name,
+        extraction_path))
+
+    filenames = []
+    success = False
+    try:
+        archive = tarfile.open(fileobj=file_handle, mode=mode)
+        try:
+            for member in archive:
+                if not _is_safe_member(member):
+                    LOGGER.warning('Skipping unsafe bundle entry {}'.format(
+                        member.name))
+                    continue
+
+                archive.extract(member, extraction_path)
+                filenames.append(member.name)
+        finally:
+            archive.close()
+        success = True
+    except Exception as err:
+        LOGGER.error('Error when unpacking bundle: {}'.format(err))
+    finally:
+        key.close()
+
+    _store_bundle_files(filenames, extraction_path)
+
+    return success
+
+
+def _unpack_zip(key, extraction_path):
+    """ Download and unpack a zip bundle
+
+    :type key: boto.s3.key.Key
+    :param key: S3 key of the bundle
+    :type extraction_path: str
+    :param extraction_path: Path to extract the bundle to
+    :returns: bool -- True if all files were extracted
+    """
+    bundle = tempfile.NamedTemporaryFile(
+        suffix='.zip',
+        delete=False)
+    bundle.close()
+    LOGGER.info("Downloading s3://{}/{} to {}".format(
+        config.get('bundle-bucket'),
+        key.name,
+        bundle.name))
+    key.get_contents_to_filename(bundle.name)
+
+    archive = zipfile.ZipFile(bundle.name, 'r')
+    try:
+        _store_bundle_files(archive.namelist(), extraction_path)
+    finally:
+        archive.close()
+
+    # Unpack the bundle
+    success = _extract_zip(bundle.name, extraction_path)
+
+    # Remove the downloaded package
+    LOGGER.info("Removing temporary file {}".format(bundle.name))
+    os.remove(bundle.name)
+
+    return success
+
+
+def _update_bundle_files(changed, deleted, extraction_path):
+    """ Update the list of bundle paths after applying a delta bundle
+
+    :type changed: list
+    :param changed: File names added or changed within the bundle
+    :type deleted: list
+    :param deleted: File names deleted from the bundle
+    :type extraction_path: str
+    :param extraction_path: Path the bundle was extracted to
+    """
+    cache_file = _get_cache_file()
+
+    entries = []
+    if ospath.exists(cache_file):
+        with open(cache_file, 'r') as file_handle:
+            entries = [line.rstrip('\n') for line in file_handle]
+
+    removed = set([
+        _get_cache_entry(extraction_path, filename) for filename in deleted
+    ])
+    entries = [entry for entry in entries if entry not in removed]
+
+    known = set(entries)
+    for filename in changed:
+        entry = _get_cache_entry(extraction_path, filename)
+        if entry not in known:
+            entries.append(entry)
+            known.add(entry)
+
+    with open(cache_file, 'w') as file_handle:
+        for entry in entries:
+            file_handle.write('{}\n'.format(entry))
+
+    LOGGER.debug('Updated bundle information in {}'.format(cache_file))
+
+
+class _ObjectDownloader(object):
+    """ Download objects to the object cache from several threads
+
+    Each thread uses its own S3 connection.
+    """
+
+    def __init__(self, cache_dir):
+        """ Constructor
+
+        :type cache_dir: str
+        :param cache_dir: Object cache directory
+        """
+        self.cache_dir = cache_dir
+        self._local = threading.local()
+
+    def download(self, item):
+        """ Download an object and verify its content
+
+        :type item: tuple
+        :param item: (SHA1 hex digest of the content, key name)
+        """
+        sha1, key_name = item
+
+        if not hasattr(self._local, 'bucket'):
+            self._local.bucket = _get_bucket()
+
+        path = _get_object_path(self.cache_dir, sha1)
+        try:
+            os.makedirs(ospath.dirname(path))
+        except OSError:
+            if not ospath.isdir(ospath.dirname(path)):
+                raise
+
+        decompressor = None
+        if key_name.endswith('.deflate'):
+            decompressor = zlib.decompressobj(-15)
+
+        LOGGER.debug('Downloading {}'.format(key_name))
+        key = self._local.bucket.new_key(key_name)
+        digest = hashlib.sha1()
+        tmpfile = tempfile.NamedTemporaryFile(
+            dir=ospath.dirname(path),
+            delete=False)
+        try:
+            while True:
+                chunk = key.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+
+                if decompressor:
+                    chunk = decompressor.decompress(chunk)
+                digest.update(chunk)
+                tmpfile.write(chunk)
+
+            if decompressor:
+                chunk = decompressor.flush()
+                digest.update(chunk)
+                tmpfile.write(chunk)
+
+            tmpfile.close()
+
+            if digest.hexdigest() != sha1:
+                raise IOError('Checksum mismatch for {}'.format(key_name))
+
+            if not ospath.exists(path):
+                os.rename(tmpfile.name, path)
+        finally:
+            tmpfile.close()
+            if ospath.exists(tmpfile.name):
+                os.remove(tmpfile.name)
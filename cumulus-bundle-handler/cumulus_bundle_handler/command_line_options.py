@@ -7,4 +7,8 @@ PARSER.add_argument(
     '--keep-old-files',
     action='count',
     help='Do not delete files from the previous deployment')
+PARSER.add_argument(
+    '--no-delta',
+    action='count',
+    help='Always download the full bundles, never delta bundles')
 ARGS = PARSER.parse_args()
@@ -0,0 +1,501 @@
+#!/usr/bin/env python
+""" Benchmark bundle builds on synthetic source trees
+
+Generates source trees with different shapes, builds a zip bundle for each
+and uploads it to a local S3 stand-in. The time spent finding the files,
+building the archive, calculating the bundle checksum and uploading it is
+reported as JSON, so that results can be compared between releases.
+
+Usage:
+    python benchmarks/bundle.py [--scale 1.0] [--cases small-files,mixed]
+                                [--output results.json]
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+from s3_stub import S3Stub
+
+# Multipart upload part size in MB, the smallest S3 allows, so that the
+# huge-files case uses multipart uploads even at small scales
+UPLOAD_PART_SIZE = 5
+
+# Bump this when the result format changes
+RESULT_FORMAT = 1
+
+ENVIRONMENT = 'benchmark'
+
+# Words used to generate compressible text
+WORDS = [
+    'bundle', 'cumulus', 'deploy', 'environment', 'stack', 'template',
+    'server', 'config', 'version', 'upload', 'archive', 'path'
+]
+
+
+def _write_text(filename, size, rand):
+    """ Write a compressible text file
+
+    :type filename: str
+    :param filename: Path to the file
+    :type size: int
+    :param size: File size in bytes
+    :type rand: random.Random
+    :param rand: Random generator
+    """
+    line = ' '.join([rand.choice(WORDS) for _ in range(12)]) + '\n'
+    with open(filename, 'wb') as file_handle:
+        written = 0
+        while written < size:
+            chunk = line * max(1, min(size - written, 65536) // len(line))
+            chunk = chunk[:size - written]
+            file_handle.write(chunk)
+            written += len(chunk)
+
+
+def _write_random(filename, size):
+    """ Write an incompressible file
+
+    :type filename: str
+    :param filename: Path to the file
+    :type size: int
+    :param size: File size in bytes
+    """
+    with open(filename, 'wb') as file_handle:
+        written = 0
+        while written < size:
+            chunk = os.urandom(min(size - written, 1024 * 1024))
+            file_handle.write(chunk)
+            written += len(chunk)
+
+
+def _write_zeros(filename, size):
+    """ Write a file of zeros
+
+    :type filename: str
+    :param filename: Path to the file
+    :type size: int
+    :param size: File size in bytes
+    """
+    with open(filename, 'wb') as file_handle:
+        written = 0
+        while written < size:
+            chunk = '\0' * min(size - written, 1024 * 1024)
+            file_handle.write(chunk)
+            written += len(chunk)
+
+
+def _makedirs(path):
+    """ Create a directory and its parents if needed
+
+    :type path: str
+    :param path: Directory path
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+
+def generate_small_files(root, scale, rand):
+    """ Many small text files in a shallow tree
+
+    :type root: str
+    :param root: Directory to create the tree in
+    :type scale: float
+    :param scale: Scale factor for the number and size of the files
+    :type rand: random.Random
+    :param rand: Random generator
+    :returns: list -- (target, destination) path rewrites
+    """
+    for index in range(int(20000 * scale)):
+        directory = os.path.join(
+            root, 'app{:d}'.format(index % 20), 'mod{:d}'.format(index % 400))
+        _makedirs(directory)
+        _write_text(
+            os.path.join(directory, 'file{:d}.py'.format(index)),
+            rand.randint(200, 4000),
+            rand)
+
+    return []
+
+
+def generate_huge_files(root, scale, rand):
+    """ A few huge files, half compressible and half random
+
+    :type root: str
+    :param root: Directory to create the tree in
+    :type scale: float
+    :param scale: Scale factor for the number and size of the files
+    :type rand: random.Random
+    :param rand: Random generator
+    :returns: list -- (target, destination) path rewrites
+    """
+    size = int(64 * 1024 * 1024 * scale)
+    _makedirs(root)
+    _write_text(os.path.join(root, 'huge.log'), size, rand)
+    _write_random(os.path.join(root, 'huge.bin'), size)
+    _write_zeros(os.path.join(root, 'huge.img'), size)
+
+    return []
+
+
+def generate_deep_nesting(root, scale, rand):
+    """ Files spread over deeply nested directories
+
+    :type root: str
+    :param root: Directory to create the tree in
+    :type scale: float
+    :param scale: Scale factor for the number and size of the files
+    :type rand: random.Random
+    :param rand: Random generator
+    :returns: list -- (target, destination) path rewrites
+    """
+    for branch in range(max(1, int(50 * scale))):
+        directory = os.path.join(root, 'branch{:d}'.format(branch))
+        for depth in range(40):
+            directory = os.path.join(directory, 'level{:d}'.format(depth))
+            _makedirs(directory)
+            _write_text(
+                os.path.join(directory, 'file.txt'),
+                rand.randint(100, 2000),
+                rand)
+
+    return []
+
+
+def generate_many_rewrites(root, scale, rand):
+    """ Files in many directories, each with its own path rewrite
+
+    :type root: str
+    :param root: Directory to create the tree in
+    :type scale: float
+    :param scale: Scale factor for the number and size of the files
+    :type rand: random.Random
+    :param rand: Random generator
+    :returns: list -- (target, destination) path rewrites
+    """
+    rewrites = []
+    for app in range(200):
+        rewrites.append((
+            os.path.join(root, 'app{:d}'.format(app)),
+            'opt/app{:d}'.format(app)))
+
+    for index in range(int(10000 * scale)):
+        directory = os.path.join(root, 'app{:d}'.format(index % 200))
+        _makedirs(directory)
+        _write_text(
+            os.path.join(directory, 'file{:d}.txt'.format(index)),
+            rand.randint(200, 4000),
+            rand)
+
+    return rewrites
+
+
+def generate_mixed(root, scale, rand):
+    """ Text, random, already compressed and empty files of mixed sizes
+
+    :type root: str
+    :param root: Directory to create the tree in
+    :type scale: float
+    :param scale: Scale factor for the number and size of the files
+    :type rand: random.Random
+    :param rand: Random generator
+    :returns: list -- (target, destination) path rewrites
+    """
+    for index in range(int(2000 * scale)):
+        directory = os.path.join(root, 'dir{:d}'.format(index % 50))
+        _makedirs(directory)
+        size = int(rand.expovariate(1.0 / 32768))
+        kind = index % 4
+
+        if kind == 0:
+            _write_text(
+                os.path.join(directory, 'text{:d}.html'.format(index)),
+                size,
+                rand)
+        elif kind == 1:
+            _write_random(
+                os.path.join(directory, 'random{:d}.dat'.format(index)),
+                size)
+        elif kind == 2:
+            _write_random(
+                os.path.join(directory, 'image{:d}.png'.format(index)),
+                size)
+        else:
+            _write_zeros(
+                os.path.join(directory, 'empty{:d}.txt'.format(index)),
+                size)
+
+    return []
+
+
+CASES = [
+    ('small-files', generate_small_files),
+    ('huge-files', generate_huge_files),
+    ('deep-nesting', generate_deep_nesting),
+    ('many-rewrites', generate_many_rewrites),
+    ('mixed', generate_mixed)
+]
+
+
+def write_config(workdir, endpoint, cases):
+    """ Write a cumulus configuration with one bundle per case
+
+    :type workdir: str
+    :param workdir: Benchmark work directory
+    :type endpoint: str
+    :param endpoint: URL of the S3 stand-in
+    :type cases: dict
+    :param cases: Source path and rewrites per case name
+    :returns: str -- Path to the configuration file
+    """
+    template = os.path.join(workdir, 'template.json')
+    with open(template, 'w') as file_handle:
+        file_handle.write('{}')
+
+    lines = [
+        '[general]',
+        'cache-dir: {}'.format(os.path.join(workdir, 'cache')),
+        'upload-part-size: {:d}'.format(UPLOAD_PART_SIZE),
+        '',
+        '[environment: {}]'.format(ENVIRONMENT),
+        'access-key-id: benchmark',
+        'secret-access-key: benchmark',
+        'region: eu-west-1',
+        'bucket: benchmark',
+        'stacks: benchmark',
+        'bundles: {}'.format(', '.join(sorted(cases.keys()))),
+        'version: {}'.format(int(time.time())),
+        's3-endpoint: {}'.format(endpoint),
+        '',
+        '[stack: benchmark]',
+        'template: {}'.format(template),
+        'disable-rollback: true',
+        ''
+    ]
+
+    for name, (path, rewrites) in sorted(cases.items()):
+        lines.append('[bundle: {}]'.format(name))
+        lines.append('paths: {}'.format(path))
+        if rewrites:
+            lines.append('path-rewrites:')
+            for target, destination in rewrites:
+                lines.append('    {} -> {}'.format(target, destination))
+        lines.append('')
+
+    filename = os.path.join(workdir, 'cumulus.conf')
+    with open(filename, 'w') as file_handle:
+        file_handle.write('\n'.join(lines))
+
+    return filename
+
+
+def get_tree_size(path):
+    """ Returns the number of files and bytes in a tree
+
+    :type path: str
+    :param path: Directory
+    :returns: tuple -- (files, bytes)
+    """
+    files = 0
+    size = 0
+    for root, _, filenames in os.walk(path):
+        for filename in filenames:
+            files += 1
+            size += os.path.getsize(os.path.join(root, filename))
+
+    return files, size
+
+
+def run_case(name, path, bundle_manager, config, stub):
+    """ Time the bundle steps for one case
+
+    :type name: str
+    :param name: Case and bundle name
+    :type path: str
+    :param path: Source tree
+    :type bundle_manager: module
+    :param bundle_manager: cumulus_ds.bundle_manager
+    :type config: cumulus_ds.config.Configuration
+    :param config: Cumulus configuration
+    :type stub: s3_stub.S3Stub
+    :param stub: S3 stand-in
+    :returns: dict -- Results
+    """
+    files, size = get_tree_size(path)
+    timings = {}
+
+    start = time.time()
+    matchers = {
+        ENVIRONMENT: bundle_manager._get_path_matcher(name, ENVIRONMENT)
+    }
+    found = len(list(bundle_manager._find_files(
+        path, matchers, config.get_bundle_excludes(name))))
+    timings['find_files'] = time.time() - start
+
+    start = time.time()
+    entries = len(list(bundle_manager._bundle_entries(
+        name, ENVIRONMENT, [path])))
+    timings['bundle_entries'] = time.time() - start
+
+    tmpfile = tempfile.NamedTemporaryFile(suffix='.zip', delete=False)
+    try:
+        start = time.time()
+        bundle_manager._bundle_zip(tmpfile, name, ENVIRONMENT, [path])
+        tmpfile.close()
+        timings['bundle_zip'] = time.time() - start
+        bundle_size = os.path.getsize(tmpfile.name)
+
+        start = time.time()
+        bundle_checksum = bundle_manager._generate_local_checksum(
+            tmpfile.name)
+        timings['checksum'] = time.time() - start
+
+        received = stub.received_bytes
+        completed = stub.completed_uploads
+        start = time.time()
+        bundle_manager._upload_bundle(tmpfile.name, name, bundle_checksum)
+        timings['upload'] = time.time() - start
+        uploaded = stub.received_bytes - received
+        multipart_uploads = stub.completed_uploads - completed
+    finally:
+        tmpfile.close()
+        os.remove(tmpfile.name)
+
+    return {
+        'files': files,
+        'bytes': size,
+        'found_files': found,
+        'bundled_files': entries,
+        'bundle_bytes': bundle_size,
+        'uploaded_bytes': uploaded,
+        'multipart_uploads': multipart_uploads,
+        'seconds': timings,
+        'mb_per_second': {
+            step: size / 1024.0 / 1024.0 / seconds if seconds else None
+            for step, seconds in timings.items()
+        }
+    }
+
+
+def main():
+    """ Main function """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '--scale',
+        type=float,
+        default=1.0,
+        help='Scale the number and size of the files. Default: 1.0')
+    parser.add_argument(
+        '--cases',
+        default=','.join([name for name, _ in CASES]),
+        help='Comma separated list of cases. Default: all')
+    parser.add_argument(
+        '--output',
+        help='Write the JSON results to this file instead of stdout')
+    parser.add_argument(
+        '--workdir',
+        help='Directory for the source trees. Default: a temporary directory')
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=1,
+        help='Random seed for the source trees. Default: 1')
+    args = parser.parse_args()
+
+    names = [name.strip() for name in args.cases.split(',')]
+    for name in names:
+        if name not in dict(CASES):
+            parser.error('Unknown case {}'.format(name))
+
+    stub = S3Stub()
+    stub.start()
+
+    workdir = os.path.abspath(
+        args.workdir or tempfile.mkdtemp(prefix='cumulus-benchmark-'))
+    cwd = os.getcwd()
+    try:
+        # Path rewrites match paths relative to the working directory
+        os.chdir(workdir)
+
+        cases = {}
+        for name in names:
+            rewrites = dict(CASES)[name](name, args.scale, random.Random(
+                args.seed))
+            cases[name] = (name, rewrites)
+
+        config_file = write_config(workdir, stub.get_endpoint(), cases)
+
+        # The configuration is parsed when cumulus_ds is imported
+        sys.argv = [
+            'cumulus', '--environment', ENVIRONMENT, '--config', config_file]
+        import logging
+        logging.basicConfig(level=logging.WARNING)
+        from cumulus_ds import bundle_manager
+        from cumulus_ds.config import CONFIG as config
+
+        results = {}
+        for name in names:
+            sys.stderr.write('Running {}\n'.format(name))
+            results[name] = run_case(
+                name, cases[name][0], bundle_manager, config, stub)
+    finally:
+        stub.stop()
+        os.chdir(cwd)
+        if not args.workdir:
+            shutil.rmtree(workdir)
+
+    report = {
+        'format': RESULT_FORMAT,
+        'cumulus_version': _get_cumulus_version(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': _get_cpu_count(),
+        'scale': args.scale,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'cases': results
+    }
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as file_handle:
+            file_handle.write(output + '\n')
+    else:
+        print(output)
+
+    return 0
+
+
+def _get_cpu_count():
+    """ Returns the number of CPUs
+
+    :returns: int or None
+    """
+    import multiprocessing
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return None
+
+
+def _get_cumulus_version():
+    """ Returns the version from settings.conf
+
+    :returns: str
+    """
+    from ConfigParser import SafeConfigParser
+    settings = SafeConfigParser()
+    settings.read(os.path.join(
+        os.path.dirname(BENCHMARK_DIR), 'cumulus_ds', 'settings.conf'))
+
+    return settings.get('general', 'version')
+
+if __name__ == '__main__':
+    sys.exit(main())
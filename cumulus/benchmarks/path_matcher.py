@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+""" Benchmark path rewrites and environment exclusion
+
+Measures the time per file to match a synthetic file list against an
+increasing number of path rewrites. The compiled PathMatcher is compared
+to matching every rewrite in turn, as bundling did before.
+
+Usage:
+    python benchmarks/path_matcher.py [--files N] [--rules 1,10,100]
+"""
+import argparse
+import imp
+import os.path
+import sys
+import time
+
+# Importing cumulus_ds parses the cumulus command line, so load the module
+# on its own
+PATH_MATCHER = imp.load_source(
+    'path_matcher',
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        '..', 'cumulus_ds', 'path_matcher.py'))
+
+
+def linear_rewrite(environment, rewrites, filename):
+    """ Exclude and rewrite a file by checking every rule
+
+    :type environment: str
+    :param environment: Environment name
+    :type rewrites: list
+    :param rewrites: (target, destination) tuples
+    :type filename: str
+    :param filename: Path to the file
+    :returns: str or None -- Archive name, None if excluded
+    """
+    prefix = '__cumulus-{}__'.format(environment)
+    basename = os.path.basename(filename)
+
+    if basename.startswith('__cumulus-'):
+        if len(basename.split(prefix)) != 2:
+            return None
+    elif prefix in filename.split(os.path.sep):
+        return None
+
+    arcname = filename
+    for target, destination in rewrites:
+        if arcname[:len(target)] == target:
+            arcname = arcname.replace(target, destination)
+
+    return arcname
+
+
+def compiled_rewrite(matcher, filename):
+    """ Exclude and rewrite a file with a compiled matcher
+
+    :type matcher: PathMatcher
+    :param matcher: Compiled rules
+    :type filename: str
+    :param filename: Path to the file
+    :returns: str or None -- Archive name, None if excluded
+    """
+    if matcher.is_excluded(filename):
+        return None
+
+    return matcher.rewrite(filename)
+
+
+def get_filenames(count):
+    """ Returns a synthetic list of file names
+
+    :type count: int
+    :param count: Number of file names
+    :returns: list -- File names
+    """
+    filenames = []
+    for index in xrange(count):
+        filenames.append('src/app{:d}/module{:d}/file{:d}.py'.format(
+            index % 100, index % 1000, index))
+
+    return filenames
+
+
+def get_rewrites(count):
+    """ Returns synthetic path rewrites
+
+    One rewrite matches the files of each app directory.
+
+    :type count: int
+    :param count: Number of rewrites
+    :returns: list -- (target, destination) tuples
+    """
+    return [
+        ('src/app{:d}/'.format(index), 'opt/app{:d}/'.format(index))
+        for index in xrange(count)]
+
+
+def run(function, filenames):
+    """ Run function for all filenames
+
+    :type function: callable
+    :param function: Function taking a file name
+    :type filenames: list
+    :param filenames: File names
+    :returns: float -- Microseconds per file
+    """
+    start = time.time()
+    for filename in filenames:
+        function(filename)
+
+    return (time.time() - start) * 1000000 / len(filenames)
+
+
+def main():
+    """ Main function """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '--files',
+        type=int,
+        default=100000,
+        help='Number of files. Default: 100000')
+    parser.add_argument(
+        '--rules',
+        default='1,10,100,1000',
+        help='Comma separated numbers of rewrites. Default: 1,10,100,1000')
+    args = parser.parse_args()
+
+    filenames = get_filenames(args.files)
+
+    print('{:>8} {:>14} {:>14}'.format(
+        'rules', 'linear us/file', 'compiled us/file'))
+    for count in [int(rules) for rules in args.rules.split(',')]:
+        rewrites = get_rewrites(count)
+        matcher = PATH_MATCHER.PathMatcher('stage', rewrites)
+
+        linear = run(
+            lambda filename: linear_rewrite('stage', rewrites, filename),
+            filenames)
+        compiled = run(
+            lambda filename: compiled_rewrite(matcher, filename),
+            filenames)
+
+        print('{:>8d} {:>14.2f} {:>16.2f}'.format(count, linear, compiled))
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,357 @@
+""" Local S3 stand-in for benchmarks
+
+Implements the parts of the S3 REST API that bundle uploads use: bucket
+listing, HEAD, PUT and multipart uploads, including listing their parts. Only the size and ETag of the
+uploaded objects are kept, so large bundles do not fill the memory.
+
+Use it through the s3-endpoint environment option.
+"""
+import BaseHTTPServer
+import SocketServer
+import binascii
+import hashlib
+import re
+import socket
+import threading
+import time
+import urllib
+import urlparse
+import uuid
+from xml.sax.saxutils import escape
+
+NAMESPACE = 'http://s3.amazonaws.com/doc/2006-03-01/'
+
+# Read request bodies in chunks of this size
+CHUNK_SIZE = 1024 * 1024
+
+
+class S3Stub(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ Threaded S3 stand-in server """
+    daemon_threads = True
+
+    def __init__(self, port=0):
+        """ Constructor
+
+        :type port: int
+        :param port: Port to listen on, a free port if 0
+        """
+        BaseHTTPServer.HTTPServer.__init__(
+            self, ('127.0.0.1', port), _RequestHandler)
+        self.lock = threading.Lock()
+        self.objects = {}
+        self.uploads = {}
+        self.received_bytes = 0
+        self.requests = 0
+        self.completed_uploads = 0
+
+        self._connections = {}
+        self._thread = None
+
+    def get_endpoint(self):
+        """ Returns the URL to use as s3-endpoint
+
+        :returns: str -- URL
+        """
+        return 'http://127.0.0.1:{:d}'.format(self.server_address[1])
+
+    def process_request_thread(self, request, client_address):
+        """ Handle the requests of a connection, keeping track of it """
+        with self.lock:
+            self._connections[request] = threading.current_thread()
+        try:
+            SocketServer.ThreadingMixIn.process_request_thread(
+                self, request, client_address)
+        finally:
+            with self.lock:
+                self._connections.pop(request, None)
+
+    def start(self):
+        """ Serve requests in a background thread """
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """ Stop serving and wait for all connections to be closed
+
+        Keep-alive connections of clients are closed by the server.
+        """
+        self.shutdown()
+        self._thread.join()
+
+        with self.lock:
+            connections = self._connections.items()
+        for request, thread in connections:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            thread.join()
+
+        self.server_close()
+
+
+class _RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Handles a single S3 request """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        """ Do not log requests """
+        pass
+
+    def do_DELETE(self):
+        """ Abort a multipart upload or delete an object """
+        bucket, key, query = self._parse_path()
+        with self.server.lock:
+            if 'uploadId' in query:
+                self.server.uploads.pop(query['uploadId'][0], None)
+            else:
+                self.server.objects.pop((bucket, key), None)
+        self._send(204)
+
+    def do_GET(self):
+        """ List a bucket or the parts of an upload
+
+        Object contents are not kept.
+        """
+        bucket, key, query = self._parse_path()
+        if key and 'uploadId' in query:
+            self._list_parts(bucket, key, query['uploadId'][0])
+            return
+
+        if key:
+            self._send_error(404, 'NoSuchKey')
+            return
+
+        prefix = query.get('prefix', [''])[0]
+        with self.server.lock:
+            keys = sorted(
+                (name, self.server.objects[(bucket_name, name)])
+                for bucket_name, name in self.server.objects
+                if bucket_name == bucket and name.startswith(prefix))
+
+        contents = ''.join([
+            '<Contents><Key>{}</Key><LastModified>{}</LastModified>'
+            '<ETag>"{}"</ETag><Size>{:d}</Size>'
+            '<StorageClass>STANDARD</StorageClass></Contents>'.format(
+                escape(name),
+                time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime()),
+                etag,
+                size)
+            for name, (size, etag) in keys])
+
+        self._send_xml(
+            '<ListBucketResult xmlns="{}"><Name>{}</Name>'
+            '<Prefix>{}</Prefix><IsTruncated>false</IsTruncated>{}'
+            '</ListBucketResult>'.format(
+                NAMESPACE, escape(bucket), escape(prefix), contents))
+
+    def do_HEAD(self):
+        """ Describe a bucket or an object """
+        bucket, key, _ = self._parse_path()
+        if not key:
+            self._send(200)
+            return
+
+        with self.server.lock:
+            entry = self.server.objects.get((bucket, key))
+
+        if not entry:
+            self._send(404)
+            return
+
+        size, etag = entry
+        self._send(200, headers={
+            'ETag': '"{}"'.format(etag),
+            'Content-Length': str(size),
+            'Last-Modified': time.strftime(
+                '%a, %d %b %Y %H:%M:%S GMT', time.gmtime())
+        })
+
+    def do_POST(self):
+        """ Start or complete a multipart upload """
+        bucket, key, query = self._parse_path()
+        body = self.rfile.read(int(self.headers.get('content-length', 0)))
+
+        if 'uploads' in query:
+            upload_id = uuid.uuid4().hex
+            with self.server.lock:
+                self.server.uploads[upload_id] = {}
+            self._send_xml(
+                '<InitiateMultipartUploadResult xmlns="{}">'
+                '<Bucket>{}</Bucket><Key>{}</Key><UploadId>{}</UploadId>'
+                '</InitiateMultipartUploadResult>'.format(
+                    NAMESPACE, escape(bucket), escape(key), upload_id))
+            return
+
+        with self.server.lock:
+            parts = self.server.uploads.pop(query['uploadId'][0], None)
+        if parts is None:
+            self._send_error(404, 'NoSuchUpload')
+            return
+
+        numbers = [
+            int(number)
+            for number in re.findall(r'<PartNumber>(\d+)</PartNumber>', body)]
+        digests = ''.join([parts[number][1] for number in numbers])
+        etag = '{}-{:d}'.format(
+            hashlib.md5(digests).hexdigest(), len(numbers))
+
+        with self.server.lock:
+            self.server.objects[(bucket, key)] = (
+                sum([parts[number][0] for number in numbers]), etag)
+            self.server.completed_uploads += 1
+
+        self._send_xml(
+            '<CompleteMultipartUploadResult xmlns="{}">'
+            '<Bucket>{}</Bucket><Key>{}</Key><ETag>"{}"</ETag>'
+            '</CompleteMultipartUploadResult>'.format(
+                NAMESPACE, escape(bucket), escape(key), etag))
+
+    def do_PUT(self):
+        """ Create a bucket, upload an object or an upload part """
+        bucket, key, query = self._parse_path()
+        size, md5 = self._read_body()
+
+        if not key:
+            self._send(200)
+            return
+
+        with self.server.lock:
+            parts = None
+            if 'uploadId' in query:
+                parts = self.server.uploads.get(query['uploadId'][0])
+                if parts is not None:
+                    parts[int(query['partNumber'][0])] = (size, md5.digest())
+            else:
+                self.server.objects[(bucket, key)] = (size, md5.hexdigest())
+
+        if 'uploadId' in query and parts is None:
+            self._send_error(404, 'NoSuchUpload')
+            return
+
+        self._send(200, headers={'ETag': '"{}"'.format(md5.hexdigest())})
+
+    def _list_parts(self, bucket, key, upload_id):
+        """ Send the uploaded parts of a multipart upload
+
+        :type bucket: str
+        :param bucket: Bucket name
+        :type key: str
+        :param key: Key name
+        :type upload_id: str
+        :param upload_id: Multipart upload ID
+        """
+        with self.server.lock:
+            parts = self.server.uploads.get(upload_id)
+            if parts is not None:
+                parts = sorted(parts.items())
+
+        if parts is None:
+            self._send_error(404, 'NoSuchUpload')
+            return
+
+        self._send_xml(
+            '<ListPartsResult xmlns="{}"><Bucket>{}</Bucket><Key>{}</Key>'
+            '<UploadId>{}</UploadId><IsTruncated>false</IsTruncated>{}'
+            '</ListPartsResult>'.format(
+                NAMESPACE,
+                escape(bucket),
+                escape(key),
+                upload_id,
+                ''.join([
+                    '<Part><PartNumber>{:d}</PartNumber>'
+                    '<LastModified>{}</LastModified><ETag>"{}"</ETag>'
+                    '<Size>{:d}</Size></Part>'.format(
+                        number,
+                        time.strftime(
+                            '%Y-%m-%dT%H:%M:%S.000Z', time.gmtime()),
+                        binascii.hexlify(digest),
+                        size)
+                    for number, (size, digest) in parts])))
+
+    def _parse_path(self):
+        """ Returns the bucket, key and query of the request
+
+        :returns: tuple -- (bucket, key, query dict)
+        """
+        url = urlparse.urlparse(self.path)
+        parts = url.path.lstrip('/').split('/', 1)
+        key = ''
+        if len(parts) > 1:
+            key = urllib.unquote(parts[1])
+
+        return (
+            urllib.unquote(parts[0]),
+            key,
+            urlparse.parse_qs(url.query, keep_blank_values=True))
+
+    def _read_body(self):
+        """ Read the request body, keeping only its size and MD5
+
+        :returns: tuple -- (size, hashlib md5 object)
+        """
+        remaining = int(self.headers.get('content-length', 0))
+        md5 = hashlib.md5()
+        size = 0
+        while remaining > 0:
+            chunk = self.rfile.read(min(remaining, CHUNK_SIZE))
+            if not chunk:
+                break
+
+            md5.update(chunk)
+            size += len(chunk)
+            remaining -= len(chunk)
+
+        with self.server.lock:
+            self.server.received_bytes += size
+            self.server.requests += 1
+
+        return size, md5
+
+    def _send(self, status, body='', headers=None):
+        """ Send a response
+
+        :type status: int
+        :param status: HTTP status
+        :type body: str
+        :param body: Response body
+        :type headers: dict or None
+        :param headers: Extra headers
+        """
+        headers = headers or {}
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if 'Content-Length' not in headers:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _send_error(self, status, code):
+        """ Send an S3 error response
+
+        :type status: int
+        :param status: HTTP status
+        :type code: str
+        :param code: S3 error code
+        """
+        self._send(
+            status,
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<Error><Code>{}</Code><Message>{}</Message></Error>'.format(
+                code, code),
+            {'Content-Type': 'application/xml'})
+
+    def _send_xml(self, body):
+        """ Send an XML document
+
+        :type body: str
+        :param body: XML document without declaration
+        """
+        self._send(
+            200,
+            '<?xml version="1.0" encoding="UTF-8"?>\n' + body,
+            {'Content-Type': 'application/xml'})
@@ -57,6 +57,11 @@ LOGGING_CONFIG = {
             'level': logging.CRITICAL,
             'propagate': False
         },
+        'cumulus_ds.checksum': {
+            'handlers': ['default'],
+            'level': 'DEBUG',
+            'propagate': False
+        },
         'cumulus_ds.bundle_manager': {
             'handlers': ['default'],
             'level': 'DEBUG',
@@ -77,6 +82,41 @@ LOGGING_CONFIG = {
             'level': 'DEBUG',
             'propagate': False
         },
+        'cumulus_ds.git_source': {
+            'handlers': ['default'],
+            'level': 'DEBUG',
+            'propagate': False
+        },
+        'cumulus_ds.hook_cache': {
+            'handlers': ['default'],
+            'level': 'DEBUG',
+            'propagate': False
+        },
+        'cumulus_ds.manifest': {
+            'handlers': ['default'],
+            'level': 'DEBUG',
+            'propagate': False
+        },
+        'cumulus_ds.object_store': {
+            'handlers': ['default'],
+            'level': 'DEBUG',
+            'propagate': False
+        },
+        'cumulus_ds.throughput': {
+            'handlers': ['default'],
+            'level': 'DEBUG',
+            'propagate': False
+        },
+        'cumulus_ds.upload_ledger': {
+            'handlers': ['default'],
+            'level': 'DEBUG',
+            'propagate': False
+        },
+        'cumulus_ds.uploader': {
+            'handlers': ['default'],
+            'level': 'DEBUG',
+            'propagate': False
+        },
         'cumulus_ds.helpers.stack': {
             'handlers': ['default'],
             'level': 'DEBUG',
@@ -98,6 +138,13 @@ def main():
         if config.args.bundle:
             bundle_manager.build_bundles()
 
+        if config.args.promote_from:
+            bundle_manager.promote_bundles(config.args.promote_from)
+
+        if config.args.gc_bundles:
+            bundle_manager.gc_bundles(
+                deployment_manager.get_deployed_versions())
+
         if config.args.undeploy:
             deployment_manager.undeploy(force=config.args.force)
 
@@ -1,29 +1,81 @@
 """ Bundling functions """
+import copy
 import hashlib
+import json
 import logging
+import multiprocessing
 import os
+import posixpath
 import subprocess
 import sys
 import tempfile
+import time
+import urllib2
+import urlparse
 import zipfile
+from collections import defaultdict
+from multiprocessing.pool import ThreadPool
 
 if sys.platform in ['win32', 'cygwin']:
     import ntpath as ospath
 else:
     import os.path as ospath
 
+from cumulus_ds import checksum
+from cumulus_ds import compression
 from cumulus_ds import connection_handler
+from cumulus_ds import git_source
+from cumulus_ds import hook_cache
+from cumulus_ds import manifest
+from cumulus_ds import object_store
+from cumulus_ds import path_matcher
+from cumulus_ds import throughput
+from cumulus_ds import upload_ledger
+from cumulus_ds import uploader
 from cumulus_ds.config import CONFIG as config
 from cumulus_ds.exceptions import (
+    BundleBuildException,
     ChecksumMismatchException,
+    ConfigurationException,
+    GarbageCollectionException,
     HookExecutionException,
     UnsupportedCompression)
 
 logger = logging.getLogger(__name__)
 
+# Upload rate limiter of this process. Bundle worker processes share the
+# upload-rate-limit equally
+_RATE_LIMITER = {
+    'pid': None,
+    'limiter': None,
+    'share': 1
+}
+
+# Files smaller than this are not deduplicated by content
+DEDUPLICATE_MIN_SIZE = 1024
+
+# Bundle key suffixes, in the order the bundle handler looks for them
+BUNDLE_FORMATS = ['zip', 'tar.gz', 'tar.zst', 'objects.json']
+
+# Largest number of keys S3 deletes in a single request
+MAX_DELETE_KEYS = 1000
+
+# Largest object S3 can copy in a single request
+MAX_COPY_SIZE = 5 * 1024 * 1024 * 1024
+
 
 def build_bundles():
-    """ Build bundles for the environment """
+    """ Build bundles for the environment
+
+    With --bundle-workers larger than 1 the bundles are built and uploaded
+    in a pool of worker processes. With --bundle-environments the bundles
+    for all environments are built together.
+    """
+    environments = config.get_bundle_environments()
+    if len(environments) > 1:
+        _build_bundles_for_environments(environments)
+        return None
+
     bundle_types = config.get_bundles()
 
     if not bundle_types:
@@ -31,155 +83,1754 @@ def build_bundles():
             'No bundles configured, will deploy without any bundles')
         return None
 
+    workers = min(config.get_bundle_workers(), len(bundle_types))
+    if workers > 1:
+        _build_bundles_parallel(bundle_types, workers)
+        return None
+
     for bundle_type in bundle_types:
-        # Run pre-bundle-hook
-        _pre_bundle_hook(bundle_type)
+        _build_bundle(bundle_type)
+
+
+def gc_bundles(stack_versions):
+    """ Delete old bundle versions of the environment
+
+    Versions are ordered by their latest upload. The newest --keep
+    versions of the bucket and of each replica bucket, the configured
+    version and the versions the running stacks are deployed with are kept
+    in all buckets. All other versions are deleted from the bucket and the
+    replica buckets of the environment. Content addressed objects may be
+    shared by several versions and are not deleted.
+
+    :type stack_versions: dict
+    :param stack_versions: (stack status, version) tuples of the running
+        stacks of the environment, keyed by stack name
+    """
+    # The version a stack is being updated from is not known
+    busy = sorted([
+        stack_name
+        for stack_name, (status, _) in stack_versions.items()
+        if status.endswith('_IN_PROGRESS')
+    ])
+    if busy:
+        raise GarbageCollectionException(
+            'Stacks {} are in progress. Try again when they are done'.format(
+                ', '.join(busy)))
+
+    keep = config.get_bundle_versions_to_keep()
+    deployed = set([
+        version
+        for _, version in stack_versions.values()
+        if version
+    ])
+    protected = deployed | set([config.get_environment_option('version')])
+
+    try:
+        connection = connection_handler.connect_s3()
+    except Exception:
+        raise
+
+    # Replica buckets are opened through a connection to their region
+    buckets = [connection.get_bucket(config.get_environment_option('bucket'))]
+    for region, bucket_name in config.get_replica_buckets():
+        if bucket_name in [bucket.name for bucket in buckets]:
+            continue
+
+        buckets.append(
+            connection_handler.connect_s3(region=region).get_bucket(
+                bucket_name))
+
+    # Replicas may be ahead of or behind the bucket, so the newest versions
+    # of every bucket are kept everywhere
+    listings = []
+    for bucket in buckets:
+        versions = _list_versions(bucket)
+        listings.append((bucket, versions))
+        protected.update(sorted(
+            versions,
+            key=lambda version: versions[version]['modified'],
+            reverse=True)[:keep])
+
+    for version in sorted(deployed):
+        logger.info('Keeping version {}, it is deployed'.format(version))
+
+    deletions = []
+    total = 0
+    for bucket, versions in listings:
+        key_names = []
+        for version in sorted(versions):
+            if version in protected:
+                continue
+
+            logger.info(
+                'Deleting version {} from s3://{} ({:d} objects)'.format(
+                    version, bucket.name, len(versions[version]['keys'])))
+            key_names.extend(versions[version]['keys'])
+
+        if key_names:
+            deletions.append((bucket, key_names))
+            total += len(key_names)
+
+    if not deletions:
+        logger.info('No bundle versions to delete')
+        return None
+
+    if not config.args.force:
+        message = (
+            'This will DELETE {:d} objects. '
+            'This action cannot be undone. '
+            'Are you sure you want to do continue? [N/y] ').format(total)
+        if raw_input(message).lower() not in ['yes', 'y']:
+            print('Skipping garbage collection.')
+            return None
+
+    for bucket, key_names in deletions:
+        _delete_keys(bucket, key_names)
+
+    logger.info('Deleted {:d} objects of old bundle versions'.format(total))
+
+
+def promote_bundles(source_environment):
+    """ Promote the bundles of another environment by server-side copy
+
+    The bundles of source_environment are copied within S3 to the keys of
+    the current environment, so the artifacts are byte-identical and
+    nothing is built or uploaded. A bundle is only promoted if it contains
+    the same files for both environments.
+
+    :type source_environment: str
+    :param source_environment: Environment to promote the bundles from
+    """
+    bundle_types = config.get_bundles()
+
+    if not bundle_types:
+        logger.warning('No bundles configured, nothing to promote')
+        return None
+
+    # A copy request is signed with one set of credentials, which must be
+    # allowed to both read the source and write the target bucket
+    credentials = (
+        config.get_environment_option('access-key-id'),
+        config.get_environment_option('secret-access-key'))
+    environment = config.get_environment()
+    config.set_environment(source_environment)
+    try:
+        source_credentials = (
+            config.get_environment_option('access-key-id'),
+            config.get_environment_option('secret-access-key'))
+    finally:
+        config.set_environment(environment)
+
+    if source_credentials != credentials:
+        raise ConfigurationException(
+            'Cannot promote from {} to {}, the environments use different '
+            'AWS credentials. Build the bundles with --bundle instead'.format(
+                source_environment, environment))
+
+    failures = []
+    for bundle_type in bundle_types:
+        try:
+            _promote_bundle(bundle_type, source_environment)
+        except (BundleBuildException, ChecksumMismatchException) as error:
+            logger.error('Bundle {} not promoted: {}'.format(
+                bundle_type, error))
+            failures.append(bundle_type)
+
+    if failures:
+        raise BundleBuildException(
+            'Failed to promote {} of {} bundles: {}'.format(
+                len(failures), len(bundle_types), ', '.join(failures)))
+
+
+def _build_bundle(bundle_type):
+    """ Build and upload a single bundle, including its hooks
+
+    :type bundle_type: str
+    :param bundle_type: Bundle name
+    """
+    # Run pre-bundle-hook
+    _pre_bundle_hook(bundle_type)
+
+    if config.has_pre_built_bundle(bundle_type):
+        bundle_path = config.get_pre_built_bundle_path(
+            bundle_type)
+        logger.info('Using pre-built bundle: {}'.format(bundle_path))
+
+        scheme = urlparse.urlparse(bundle_path).scheme
+        try:
+            if scheme == 's3':
+                _copy_pre_built_bundle(bundle_path, bundle_type)
+            elif scheme in ['http', 'https']:
+                _transfer_pre_built_bundle(bundle_path, bundle_type)
+            else:
+                _upload_bundle(bundle_path, bundle_type)
+        except UnsupportedCompression:
+            raise
+    elif config.is_content_addressed_bundle(bundle_type):
+        logger.info('Building content addressed bundle {}'.format(
+            bundle_type))
+        logger.info('Bundle paths: {}'.format(', '.join(
+            config.get_bundle_paths(bundle_type))))
+
+        _bundle_objects(bundle_type)
+    else:
+        logger.info('Building bundle {}'.format(bundle_type))
+        logger.info('Bundle paths: {}'.format(', '.join(
+            config.get_bundle_paths(bundle_type))))
+
+        bundle_format = config.get_bundle_format(bundle_type)
+
+        cache_path = None
+        previous = None
+        if config.is_incremental_bundle(bundle_type):
+            if bundle_format == 'zip':
+                cache_path = manifest.get_cache_path(
+                    config.get_cache_dir(),
+                    config.get_environment(),
+                    bundle_type)
+                previous = manifest.load(cache_path)
+            else:
+                logger.warning(
+                    'Incremental builds are only supported for zip bundles. '
+                    'Doing a full build of {}'.format(bundle_type))
+
+        if config.is_stream_upload_bundle(bundle_type):
+            bundle_manifest = _stream_bundle(bundle_type, cache_path, previous)
+        else:
+            bundle_manifest = _build_local_bundle(
+                bundle_type, cache_path, previous)
+
+        # Delta bundles are only supported for zip bundles
+        if bundle_manifest:
+            _upload_manifest(bundle_type, bundle_manifest)
+
+            if config.get_delta_from_version():
+                _upload_delta(
+                    bundle_type,
+                    bundle_manifest,
+                    config.get_delta_from_version())
+
+    _replicate_bundle(bundle_type)
+
+    # Run post-bundle-hook
+    _post_bundle_hook(bundle_type)
+
+    logger.info('Done bundling {}'.format(bundle_type))
+
+
+def _build_bundle_worker(bundle_type):
+    """ Build a bundle in a worker process
+
+    All log records are captured and returned to the parent process, so
+    that the output for each bundle can be printed in one piece.
+
+    :type bundle_type: str
+    :param bundle_type: Bundle name
+    :returns: tuple -- (bundle_type, list of (logger name, level, message),
+        error message or None)
+    """
+    handler = _CaptureHandler()
+    loggers = [
+        logging.getLogger(name)
+        for name in logging.Logger.manager.loggerDict.keys()
+        if name.startswith('cumulus_ds')
+    ]
+
+    original_handlers = {}
+    for bundle_logger in loggers:
+        original_handlers[bundle_logger] = (
+            bundle_logger.handlers, bundle_logger.propagate)
+        bundle_logger.handlers = [handler]
+        bundle_logger.propagate = False
+
+    error = None
+    try:
+        _build_bundle(bundle_type)
+    except (Exception, SystemExit) as err:
+        error = '{}: {}'.format(err.__class__.__name__, err)
+        logger.error('Failed to build bundle {}: {}'.format(
+            bundle_type, error))
+    finally:
+        for bundle_logger, (handlers, propagate) in \
+                original_handlers.items():
+            bundle_logger.handlers = handlers
+            bundle_logger.propagate = propagate
+
+    return bundle_type, handler.messages, error
+
+
+def _build_local_bundle(bundle_type, cache_path=None, previous=None):
+    """ Build a bundle in a temporary file and upload it
+
+    :type bundle_type: str
+    :param bundle_type: Bundle name
+    :type cache_path: str or None
+    :param cache_path: Directory for the incremental build data
+    :type previous: dict or None
+    :param previous: Manifest from the previous build
+    :returns: dict or None -- Manifest of the bundle, None for tar bundles
+    """
+    tmptar = tempfile.NamedTemporaryFile(
+        suffix='.{}'.format(config.get_bundle_format(bundle_type)),
+        delete=False)
+    logger.debug('Created temporary tar file {}'.format(tmptar.name))
+
+    bundle_path = tmptar.name
+    bundle_checksum = checksum.BundleChecksum(
+        config.get_upload_part_size())
+    try:
+        bundle_manifest = _bundle_archive(
+            checksum.ChecksumWriter(tmptar, bundle_checksum),
+            bundle_type,
+            previous=previous)
+
+        tmptar.close()
+
+        if cache_path:
+            bundle_path = manifest.save(
+                cache_path, bundle_manifest, tmptar.name)
+
+        try:
+            _upload_bundle(bundle_path, bundle_type, bundle_checksum)
+        except UnsupportedCompression:
+            raise
+    finally:
+        if ospath.exists(tmptar.name):
+            logger.debug('Removing temporary tar file {}'.format(
+                tmptar.name))
+            os.remove(tmptar.name)
+
+    return bundle_manifest
+
+
+def _build_bundles_for_environments(environments):
+    """ Build and upload the bundles for several environments
+
+    Zip bundles used by more than one of the environments are built in
+    one pass, see _build_shared_bundle(). Other bundles are built for one
+    environment at a time.
+
+    :type environments: list
+    :param environments: Environment names, --environment first
+    """
+    bundle_types = []
+    bundle_environments = defaultdict(list)
+    try:
+        for environment in environments:
+            config.set_environment(environment)
+            for bundle_type in config.get_bundles() or []:
+                if bundle_type not in bundle_types:
+                    bundle_types.append(bundle_type)
+                bundle_environments[bundle_type].append(environment)
+    finally:
+        config.set_environment(environments[0])
+
+    if not bundle_types:
+        logger.warning(
+            'No bundles configured, will deploy without any bundles')
+        return None
+
+    if config.get_bundle_workers() > 1:
+        logger.warning(
+            'Building bundles one at a time, --bundle-workers is not '
+            'supported with --bundle-environments')
+
+    try:
+        for bundle_type in bundle_types:
+            shared = bundle_environments[bundle_type]
+            if len(shared) > 1 and _is_shareable_bundle(bundle_type):
+                _build_shared_bundle(bundle_type, shared)
+                continue
+
+            for environment in shared:
+                config.set_environment(environment)
+                logger.info('Building {} for environment {}'.format(
+                    bundle_type, environment))
+                _build_bundle(bundle_type)
+    finally:
+        config.set_environment(environments[0])
+
+
+def _build_bundles_parallel(bundle_types, workers):
+    """ Build and upload bundles in a pool of worker processes
+
+    Log output is printed per bundle, prefixed with the bundle name and in
+    the order the bundles are configured. All failures are reported when
+    every bundle has been processed.
+
+    :type bundle_types: list
+    :param bundle_types: List of bundle names
+    :type workers: int
+    :param workers: Number of worker processes
+    """
+    logger.info('Building {} bundles using {} worker processes'.format(
+        len(bundle_types), workers))
+
+    failures = []
+    pool = multiprocessing.Pool(
+        processes=workers,
+        initializer=_init_bundle_worker,
+        initargs=(workers,))
+    try:
+        for bundle_type, messages, error in pool.imap(
+                _build_bundle_worker, bundle_types):
+            for name, level, message in messages:
+                logging.getLogger(name).log(
+                    level, '[{}] {}'.format(bundle_type, message))
+
+            if error:
+                failures.append((bundle_type, error))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    if failures:
+        for bundle_type, error in failures:
+            logger.error('Bundle {} failed: {}'.format(bundle_type, error))
+        raise BundleBuildException(
+            'Failed to build {} of {} bundles: {}'.format(
+                len(failures),
+                len(bundle_types),
+                ', '.join([bundle_type for bundle_type, _ in failures])))
+
+
+def _build_shared_bundle(bundle_type, environments):
+    """ Build and upload a zip bundle for several environments at once
+
+    The bundle paths are walked and every file is compressed once. Each
+    file is written to the archives of all environments that include it.
+    The archives are then uploaded for each environment.
+
+    :type bundle_type: str
+    :param bundle_type: Bundle name
+    :type environments: list
+    :param environments: Environment names
+    """
+    _pre_bundle_hook(bundle_type)
+
+    logger.info('Building bundle {} for environments {}'.format(
+        bundle_type, ', '.join(environments)))
+    logger.info('Bundle paths: {}'.format(', '.join(
+        config.get_bundle_paths(bundle_type))))
+
+    tmpfiles = {}
+    checksums = {}
+    try:
+        outputs = {}
+        for environment in environments:
+            tmpfiles[environment] = tempfile.NamedTemporaryFile(
+                suffix='.zip', delete=False)
+            checksums[environment] = checksum.BundleChecksum(
+                config.get_upload_part_size())
+            outputs[environment] = checksum.ChecksumWriter(
+                tmpfiles[environment], checksums[environment])
+
+        manifests = _bundle_zip_shared(
+            outputs,
+            bundle_type,
+            environments,
+            config.get_bundle_paths(bundle_type))
+
+        for environment in environments:
+            tmpfiles[environment].close()
+
+        for environment in environments:
+            config.set_environment(environment)
+            _upload_bundle(
+                tmpfiles[environment].name,
+                bundle_type,
+                checksums[environment])
+            _upload_manifest(bundle_type, manifests[environment])
+
+            if config.get_delta_from_version():
+                _upload_delta(
+                    bundle_type,
+                    manifests[environment],
+                    config.get_delta_from_version())
+
+            _replicate_bundle(bundle_type)
+    finally:
+        config.set_environment(environments[0])
+        for tmpfile in tmpfiles.values():
+            tmpfile.close()
+            if ospath.exists(tmpfile.name):
+                os.remove(tmpfile.name)
+
+    _post_bundle_hook(bundle_type)
+
+    logger.info('Done bundling {}'.format(bundle_type))
+
+
+class _CaptureHandler(logging.Handler):
+    """ Logging handler keeping all formatted messages in memory """
+
+    def __init__(self):
+        """ Constructor """
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        """ Store the record as (logger name, level, message)
+
+        :type record: logging.LogRecord
+        :param record: Log record
+        """
+        self.messages.append(
+            (record.name, record.levelno, record.getMessage()))
+
+
+def _bundle_archive(tmpfile, bundle_type, previous=None):
+    """ Create an archive in the format configured for the bundle
+
+    :type tmpfile: tempfile instance
+    :param tmpfile: File object to write the archive to
+    :type bundle_type: str
+    :param bundle_type: Bundle name
+    :type previous: dict or None
+    :param previous: Manifest from the previous build, zip bundles only
+    :returns: dict or None -- Manifest describing the new archive, None for
+        tar bundles
+    """
+    bundle_format = config.get_bundle_format(bundle_type)
+
+    source = config.get_bundle_source(bundle_type)
+    if source:
+        repository = git_source.GitRepository(*source)
+        try:
+            return _bundle_zip(
+                tmpfile,
+                bundle_type,
+                config.get_environment(),
+                config.get_bundle_paths(bundle_type),
+                previous=previous,
+                repository=repository)
+        finally:
+            repository.close()
+
+    if bundle_format == 'zip':
+        return _bundle_zip(
+            tmpfile,
+            bundle_type,
+            config.get_environment(),
+            config.get_bundle_paths(bundle_type),
+            previous=previous)
+
+    _bundle_tar(
+        tmpfile,
+        bundle_type,
+        config.get_environment(),
+        config.get_bundle_paths(bundle_type),
+        bundle_format)
+    return None
+
+
+def _bundle_objects(bundle_type):
+    """ Upload the bundle files to the content addressed object store
+
+    Files are hashed, and compressed and uploaded if their content is not
+    in the bucket yet, in --upload-concurrency worker threads. The object
+    manifest of the version is uploaded last.
+
+    :type bundle_type: str
+    :param bundle_type: Bundle name
+    """
+    try:
+        connection = connection_handler.connect_s3()
+    except Exception:
+        raise
+
+    bucket = connection.get_bucket(
+        config.get_environment_option('bucket'))
+
+    logger.info('Listing stored objects in s3://{}/{}'.format(
+        bucket.name, object_store.OBJECT_PREFIX))
+    store = object_store.ObjectStore(
+        bucket.name,
+        object_store.list_objects(bucket),
+        part_size=config.get_upload_part_size(),
+        retries=config.get_upload_retries(),
+        journal_dir=ospath.join(config.get_cache_dir(), 'uploads'),
+        rate_limiter=_get_rate_limiter(),
+        progress=throughput.ProgressReporter(bundle_type))
+
+    policy = _get_compression_policy(bundle_type)
+    reproducible = config.is_reproducible_bundle(bundle_type)
+
+    def store_file(item):
+        """ Store a file in the object store """
+        filename, arcname = item
+        return store.store(filename, arcname, policy, reproducible)
+
+    files = {}
+    uploaded_files = 0
+    uploaded_size = 0
+    for entry, size in compression.ordered_imap(
+            store_file,
+            _bundle_entries(
+                bundle_type,
+                config.get_environment(),
+                config.get_bundle_paths(bundle_type)),
+            config.get_upload_concurrency()):
+        files[entry.pop('arcname')] = entry
+        if size:
+            uploaded_files += 1
+            uploaded_size += size
+
+    logger.info(
+        'Uploaded {:d} of {:d} files ({:.1f} MB), '
+        'the rest was already stored'.format(
+            uploaded_files, len(files), uploaded_size / 1024.0 / 1024.0))
+
+    key_name = _get_key_name(bundle_type, 'objects.json')
+    _upload_json(
+        bucket,
+        key_name,
+        {
+            'format': object_store.OBJECTS_FORMAT,
+            'files': files
+        })
+
+    logger.info('Completed upload of {} to s3://{}/{}'.format(
+        bundle_type, bucket.name, key_name))
+
+
+def _bundle_tar(tmpfile, bundle_type, environment, paths, bundle_format):
+    """ Create a compressed tar archive
+
+    The archive is written as one compressed stream, so the files are not
+    compressed in parallel. zstd uses --compression-workers threads
+    internally.
+
+    :type tmpfile: tempfile instance
+    :param tmpfile: Tempfile object
+    :type bundle_type: str
+    :param bundle_type: Bundle name
+    :type environment: str
+    :param environment: Environment name
+    :type paths: list
+    :param paths: List of paths to include
+    :type bundle_format: str
+    :param bundle_format: tar.gz or tar.zst
+    """
+    logger.info('Generating {} file for {}'.format(bundle_format, bundle_type))
+
+    if config.get_bundle_deduplication(bundle_type) != 'none':
+        logger.warning(
+            'Deduplication is only supported for zip bundles. '
+            'Bundling all copies of duplicate files in {}'.format(bundle_type))
+
+    archive = compression.TarStream(
+        tmpfile,
+        bundle_format,
+        level=config.get_compression_level(bundle_type),
+        reproducible=config.is_reproducible_bundle(bundle_type),
+        workers=config.get_compression_workers())
+
+    for filename, arcname in _bundle_entries(bundle_type, environment, paths):
+        archive.add(filename, arcname)
+
+    archive.close()
+
+    for line in archive.get_report():
+        logger.info(line)
+
+
+def _bundle_zip(
+        tmpfile,
+        bundle_type,
+        environment,
+        paths,
+        previous=None,
+        repository=None):
+    """ Create a zip archive
+
+    Files are compressed in a pool of worker threads and written to the
+    archive in the same order as they are found, so the result does not
+    depend on the number of workers.
+
+    If a manifest from a previous build is given, files that have not
+    changed since then are copied from the previous archive as they are,
+    without being read and compressed again.
+
+    If a git repository is given, the files are read from its commit
+    instead of the local file system.
+
+    :type tmpfile: tempfile instance
+    :param tmpfile: Tempfile object
+    :type bundle_type: str
+    :param bundle_type: Bundle name
+    :type environment: str
+    :param environment: Environment name
+    :type paths: list
+    :param paths: List of paths to include
+    :type previous: dict or None
+    :param previous: Manifest from the previous build
+    :type repository: cumulus_ds.git_source.GitRepository or None
+    :param repository: Repository to read the files from
+    :returns: dict -- Manifest describing the new archive
+    """
+    logger.info('Generating zip file for {}'.format(bundle_type))
+    archive = zipfile.ZipFile(tmpfile, 'w', allowZip64=True)
+    bundle_manifest = manifest.new()
+
+    policy = _get_compression_policy(bundle_type)
+    bundle_manifest['compression'] = policy.get_signature()
+    stats = compression.CompressionStats()
+
+    if previous and previous.get('compression') != \
+            bundle_manifest['compression']:
+        logger.info(
+            'The compression settings have changed since the previous '
+            'build, compressing all files')
+        previous = None
+
+    if repository:
+        bundle_manifest['source'] = 'git'
+
+    # Entries of local files and git blobs are not comparable
+    if previous and previous.get('source') != bundle_manifest.get('source'):
+        logger.info(
+            'The bundle source has changed since the previous build, '
+            'compressing all files')
+        previous = None
+
+    previous_archive = None
+    previous_files = {}
+    if previous:
+        logger.info('Reusing unchanged files from the previous build')
+        previous_archive = zipfile.ZipFile(previous['archive'], 'r')
+        previous_files = previous['files']
+    reused = 0
+
+    reproducible = config.is_reproducible_bundle(bundle_type)
+    if reproducible:
+        logger.info('Building a reproducible archive')
+
+    deduplicate = config.get_bundle_deduplication(bundle_type)
+    linked = 0
+
+    def prepare(item):
+        """ Compress a file, unless it can be reused or linked """
+        if repository:
+            filename, arcname, git_file = item
+            return _prepare_git_entry(
+                repository,
+                git_file,
+                filename,
+                arcname,
+                previous_archive,
+                previous_files.get(filename),
+                reproducible,
+                policy)
+
+        filename, arcname, link = item
+        if link:
+            return _prepare_link(filename, arcname, link, reproducible)
+
+        return _prepare_entry(
+            filename,
+            arcname,
+            previous_archive,
+            previous_files.get(filename),
+            reproducible,
+            policy)
+
+    if repository:
+        items = _git_bundle_entries(
+            bundle_type, environment, paths, repository)
+    else:
+        items = _deduplicate_entries(
+            _bundle_entries(bundle_type, environment, paths),
+            deduplicate)
+
+    entries = compression.ordered_imap(
+        prepare, items, config.get_compression_workers())
+
+    try:
+        for entry in entries:
+            zinfo = entry['zinfo']
+            if entry['source']:
+                compression.write_raw_entry(
+                    archive,
+                    zinfo,
+                    compression.open_raw_entry(
+                        previous_archive.fp, entry['source']))
+                logger.debug('Reused unchanged file {}'.format(
+                    entry['filename']))
+                reused += 1
+            else:
+                try:
+                    compression.write_raw_entry(archive, zinfo, entry['data'])
+                finally:
+                    entry['data'].close()
+
+            if entry['link']:
+                linked += 1
+            else:
+                stats.add(zinfo)
+
+            bundle_manifest['files'][entry['filename']] = \
+                _get_manifest_entry(entry)
+    finally:
+        entries.close()
+
+    archive.close()
+
+    if previous_archive:
+        previous_archive.close()
+        logger.info('Reused {} of {} files from the previous build'.format(
+            reused, len(bundle_manifest['files'])))
+
+    if deduplicate != 'none':
+        logger.info('Stored {:d} duplicate files as links'.format(linked))
+
+    for line in stats.get_report():
+        logger.info(line)
+
+    return bundle_manifest
+
+
+def _bundle_zip_shared(outputs, bundle_type, environments, paths):
+    """ Create zip archives for several environments in one pass
+
+    :type outputs: dict
+    :param outputs: File object to write the archive to per environment
+    :type bundle_type: str
+    :param bundle_type: Bundle name
+    :type environments: list
+    :param environments: Environment names
+    :type paths: list
+    :param paths: List of paths to include
+    :returns: dict -- Manifest describing the archive per environment
+    """
+    logger.info('Generating zip files for {}'.format(bundle_type))
+
+    policy = _get_compression_policy(bundle_type)
+    stats = compression.CompressionStats()
+    reproducible = config.is_reproducible_bundle(bundle_type)
+
+    archives = {}
+    manifests = {}
+    for environment in environments:
+        archives[environment] = zipfile.ZipFile(
+            outputs[environment], 'w', allowZip64=True)
+        manifests[environment] = manifest.new()
+        manifests[environment]['compression'] = policy.get_signature()
+
+    def prepare(item):
+        """ Compress a file """
+        filename, arcname, file_environments = item
+        entry = _prepare_entry(
+            filename, arcname, None, None, reproducible, policy)
+        entry['environments'] = file_environments
+        return entry
+
+    entries = compression.ordered_imap(
+        prepare,
+        _bundle_entries_for_environments(bundle_type, environments, paths),
+        config.get_compression_workers())
+
+    shared = 0
+    try:
+        for entry in entries:
+            try:
+                for environment in entry['environments']:
+                    # Each archive stores its own header offset
+                    zinfo = copy.copy(entry['zinfo'])
+                    entry['data'].seek(0)
+                    compression.write_raw_entry(
+                        archives[environment], zinfo, entry['data'])
+
+                    manifests[environment]['files'][entry['filename']] = \
+                        _get_manifest_entry(entry)
+            finally:
+                entry['data'].close()
+
+            stats.add(entry['zinfo'])
+            if len(entry['environments']) > 1:
+                shared += 1
+    finally:
+        entries.close()
+
+    for archive in archives.values():
+        archive.close()
+
+    logger.info(
+        'Compressed {:d} files once for {:d} environments, {:d} of them '
+        'are included in more than one environment'.format(
+            stats.get_files(), len(environments), shared))
+
+    for line in stats.get_report():
+        logger.info(line)
+
+    return manifests
+
+
+def _bundle_entries(bundle_type, environment, paths):
+    """ Find all files to include in a bundle
+
+    Files for other environments are excluded and all path rewrites are
+    applied to the archive names.
+
+    :type bundle_type: str
+    :param bundle_type: Bundle name
+    :type environment: str
+    :param environment: Environment name
+    :type paths: list
+    :param paths: List of paths to include
+    :returns: generator -- (filename, arcname) tuples
+    """
+    for filename, arcname, _ in _bundle_entries_for_environments(
+            bundle_type, [environment], paths):
+        yield filename, arcname
+
+
+def _bundle_entries_for_environments(bundle_type, environments, paths):
+    """ Find all files to include in a bundle for several environments
+
+    The bundle paths are walked once. Directories are only pruned if they
+    are excluded for all environments.
+
+    :type bundle_type: str
+    :param bundle_type: Bundle name
+    :type environments: list
+    :param environments: Environment names
+    :type paths: list
+    :param paths: List of paths to include
+    :returns: generator -- (filename, arcname, environments) tuples, with
+        the environments that include the file in the given order
+    """
+    matchers = {}
+    for environment in environments:
+        matchers[environment] = _get_path_matcher(bundle_type, environment)
+    matcher = matchers[environments[0]]
+
+    for path in paths:
+        path = _convert_paths_to_local_format(path)
+
+        if ospath.isdir(path):
+            # Extract all file names from directory
+            filenames = _find_files(
+                path, matchers, config.get_bundle_excludes(bundle_type))
+        else:
+            filenames = [(path, frozenset(environments))]
+
+        for filename, included in filenames:
+            # Exclude files with other target environments
+            file_environments = [
+                environment
+                for environment in environments
+                if environment in included and
+                not matchers[environment].is_excluded(filename)
+            ]
+            if not file_environments:
+                logger.debug('Excluding file {}'.format(filename))
+                continue
+
+            arcname = matcher.rewrite(filename)
+            if arcname != filename:
+                logger.debug('Rewrote "{}" to "{}" in bundle {}'.format(
+                    filename, arcname, bundle_type))
+
+            logger.debug('Adding: {}'.format(filename))
+            yield filename, arcname, file_environments
+
+
+def _copy_pre_built_bundle(url, bundle_type):
+    """ Copy a pre-built bundle stored in S3 within S3
+
+    :type url: str
+    :param url: s3://bucket/key URL of the bundle
+    :type bundle_type: str
+    :param bundle_type: Bundle type
+    """
+    url = urlparse.urlparse(url)
+
+    try:
+        connection = connection_handler.connect_s3()
+    except Exception:
+        raise
+
+    source_key = connection.get_bucket(url.netloc).get_key(
+        url.path.lstrip('/'))
+    if not source_key:
+        raise BundleBuildException(
+            'Pre-built bundle s3://{}{} not found'.format(
+                url.netloc, url.path))
+
+    bucket = connection.get_bucket(
+        config.get_environment_option('bucket'))
+    key_name = _get_key_name(bundle_type, _get_compression_format(url.path))
+
+    _copy_key(source_key, bucket, key_name)
+
+    logger.info('Completed copy of {} to s3://{}/{}'.format(
+        bundle_type, bucket.name, key_name))
+
+
+def _copy_key(source_key, bucket, key_name):
+    """ Copy an S3 object within S3 and verify its checksum
+
+    The copy is skipped if the key already has the ETag of the source.
+
+    :type source_key: boto.s3.key.Key
+    :param source_key: Object to copy
+    :type bucket: boto.s3.bucket.Bucket
+    :param bucket: Bucket to copy to
+    :type key_name: str
+    :param key_name: S3 key name of the copy
+    """
+    source_etag = source_key.etag.strip('"')
+
+    ledger = _get_upload_ledger()
+    if ledger:
+        entry = upload_ledger.lookup(
+            ledger[0], ledger[1], bucket.name, key_name)
+        if (entry and entry['etag'] == source_etag and
+                _is_ledger_entry_trusted(entry)):
+            logger.info('s3://{}/{} is already up to date'.format(
+                bucket.name, key_name))
+            return
+
+    key = bucket.get_key(key_name)
+    if key and key.etag.strip('"') == source_etag:
+        logger.info('s3://{}/{} is already up to date'.format(
+            bucket.name, key_name))
+        _record_copy(ledger, source_key, bucket, key_name)
+        return
+
+    logger.info('Copying s3://{}/{} to s3://{}/{}'.format(
+        source_key.bucket.name, source_key.name, bucket.name, key_name))
+
+    if source_key.size <= MAX_COPY_SIZE:
+        etag = bucket.copy_key(
+            key_name, source_key.bucket.name, source_key.name).etag
+    else:
+        etag = _copy_key_multipart(source_key, bucket, key_name)
+
+    if etag.strip('"') != source_etag:
+        raise ChecksumMismatchException(
+            'Mismatching checksum s3://{}/{} ({}) and s3://{}/{} ({})'.format(
+                source_key.bucket.name,
+                source_key.name,
+                source_etag,
+                bucket.name,
+                key_name,
+                etag.strip('"')))
+
+    _record_copy(ledger, source_key, bucket, key_name)
+
+
+def _copy_key_multipart(source_key, bucket, key_name):
+    """ Copy an S3 object larger than MAX_COPY_SIZE in parts
+
+    The parts are as large as the first part of the source upload, so the
+    copy gets the same ETag as the source.
+
+    :type source_key: boto.s3.key.Key
+    :param source_key: Object to copy
+    :type bucket: boto.s3.bucket.Bucket
+    :param bucket: Bucket to copy to
+    :type key_name: str
+    :param key_name: S3 key name of the copy
+    :returns: str -- ETag of the copy
+    """
+    response = source_key.bucket.connection.make_request(
+        'HEAD',
+        source_key.bucket.name,
+        source_key.name,
+        query_args='partNumber=1')
+    response.read()
+
+    if response.status == 206:
+        part_size = int(response.getheader('content-length'))
+    else:
+        part_size = checksum.get_part_size(
+            config.get_upload_part_size(), source_key.size)
+
+    upload = bucket.initiate_multipart_upload(key_name)
+    try:
+        part_num = 1
+        for start in xrange(0, source_key.size, part_size):
+            upload.copy_part_from_key(
+                source_key.bucket.name,
+                source_key.name,
+                part_num,
+                start,
+                min(start + part_size, source_key.size) - 1)
+            part_num += 1
+
+        return upload.complete_upload().etag
+    except:
+        upload.cancel_upload()
+        raise
+
+
+def _deduplicate_entries(entries, mode):
+    """ Find files that are copies of a file earlier in the bundle
+
+    With inode, files that are the same file on disk, e.g. reached through
+    symbolic links or hard links, are duplicates. With content, files of
+    the same size are also compared by content hash. Only files of the same
+    size are hashed.
+
+    :type entries: generator
+    :param entries: (filename, arcname) tuples from _bundle_entries()
+    :type mode: str
+    :param mode: none, inode or content
+    :returns: generator -- (filename, arcname, link) tuples. link is the
+        arcname of the first copy for duplicates, otherwise None
+    """
+    if mode == 'none':
+        for filename, arcname in entries:
+            yield filename, arcname, None
+        return
+
+    entries = [
+        (filename, arcname, os.stat(filename))
+        for filename, arcname in entries
+    ]
+
+    sizes = defaultdict(int)
+    if mode == 'content':
+        for _, _, stat in entries:
+            sizes[stat.st_size] += 1
+
+    first = {}
+    for filename, arcname, stat in entries:
+        keys = []
+        if stat.st_ino:
+            keys.append((stat.st_dev, stat.st_ino))
+        if sizes[stat.st_size] > 1 and stat.st_size >= DEDUPLICATE_MIN_SIZE:
+            keys.append((stat.st_size, compression.hash_file(filename)))
+
+        link = None
+        for key in keys:
+            if key in first:
+                link = first[key]
+                break
+
+        for key in keys:
+            first.setdefault(key, link or arcname)
+
+        if link:
+            logger.debug('Linking duplicate {} to {}'.format(arcname, link))
+        yield filename, arcname, link
+
+
+def _delete_keys(bucket, key_names):
+    """ Delete keys in batches of multi-object deletes
+
+    Manifests are deleted first, so that a partly deleted version is never
+    used to build delta bundles from. Deleted keys are removed from the
+    upload ledger.
+
+    :type bucket: boto.s3.bucket.Bucket
+    :param bucket: Bucket to delete from
+    :type key_names: list
+    :param key_names: S3 key names
+    """
+    key_names = sorted(
+        key_names,
+        key=lambda key_name: (
+            not key_name.endswith('.manifest.json'), key_name))
+    ledger = _get_upload_ledger()
+
+    failures = 0
+    for start in range(0, len(key_names), MAX_DELETE_KEYS):
+        batch = key_names[start:start + MAX_DELETE_KEYS]
+        result = bucket.delete_keys(batch, quiet=True)
+
+        for error in result.errors:
+            logger.error('Could not delete s3://{}/{}: {}'.format(
+                bucket.name, error.key, error.message))
+        failures += len(result.errors)
+
+        if ledger:
+            upload_ledger.forget_keys(ledger[0], ledger[1], bucket.name, batch)
+
+        logger.debug('Deleted {:d} of {:d} objects from s3://{}'.format(
+            start + len(batch), len(key_names), bucket.name))
+
+    if failures:
+        raise GarbageCollectionException(
+            'Failed to delete {:d} objects from s3://{}'.format(
+                failures, bucket.name))
+
+
+def _get_compression_format(bundle_path):
+    """ Returns the compression format of a bundle from its file name
+
+    :type bundle_path: str
+    :param bundle_path: Path or URL path of the bundle
+    :returns: str -- zip, tar.gz or tar.zst
+    """
+    if bundle_path.endswith('.zip'):
+        return 'zip'
+    elif bundle_path.endswith('.tar.gz') or bundle_path.endswith('.tgz'):
+        return 'tar.gz'
+    elif bundle_path.endswith('.tar.zst'):
+        return 'tar.zst'
+
+    raise UnsupportedCompression(
+        'Unknown compression format for {}. We are currently only '
+        'supporting .zip, .tar.gz and .tar.zst'.format(bundle_path))
+
+
+def _get_environment_differences(bundle_type, environments):
+    """ Find the files a bundle does not include for all environments
+
+    :type bundle_type: str
+    :param bundle_type: Bundle name
+    :type environments: list
+    :param environments: Environment names
+    :returns: list or None -- Archive names, None if the bundle paths are
+        not available locally
+    """
+    if (config.has_pre_built_bundle(bundle_type) or
+            config.get_bundle_source(bundle_type)):
+        return None
+
+    paths = config.get_bundle_paths(bundle_type)
+    for path in paths:
+        if not ospath.exists(_convert_paths_to_local_format(path)):
+            return None
+
+    differences = []
+    for _, arcname, included in _bundle_entries_for_environments(
+            bundle_type, environments, paths):
+        if len(included) != len(environments):
+            differences.append(arcname)
+
+    return differences
+
+
+def _get_manifest_entry(entry):
+    """ Returns the manifest entry for a file written to an archive
+
+    :type entry: dict
+    :param entry: Entry from _prepare_entry() or _prepare_link()
+    :returns: dict -- Manifest entry
+    """
+    stat = entry['stat']
+    file_entry = {
+        'arcname': entry['zinfo'].filename,
+        'sha1': entry['sha1'],
+        'size': stat.st_size,
+        'mode': stat.st_mode,
+        'mtime': stat.st_mtime
+    }
+
+    if entry['link']:
+        file_entry['mode'] = entry['zinfo'].external_attr >> 16
+        file_entry['link'] = entry['link']
+
+    if entry.get('blob'):
+        file_entry['blob'] = entry['blob']
+
+    return file_entry
+
+
+def _get_path_matcher(bundle_type, environment):
+    """ Compile the path rewrites and environment exclusion of a bundle
+
+    :type bundle_type: str
+    :param bundle_type: Bundle name
+    :type environment: str
+    :param environment: Environment name
+    :returns: cumulus_ds.path_matcher.PathMatcher
+    """
+    rewrites = []
+    for rewrite in config.get_bundle_path_rewrites(bundle_type):
+        rewrites.append((
+            _convert_paths_to_local_format(
+                rewrite['target'].replace('\\\\', '\\')),
+            _convert_paths_to_local_format(
+                rewrite['destination'].replace('\\\\', '\\'))))
+
+    return path_matcher.PathMatcher(environment, rewrites)
+
+
+def _get_rate_limiter():
+    """ Returns the upload rate limiter of this process
+
+    :returns: cumulus_ds.throughput.RateLimiter or None -- None if there is
+        no upload-rate-limit
+    """
+    rate = config.get_upload_rate_limit()
+    if not rate:
+        return None
+
+    if _RATE_LIMITER['pid'] != os.getpid():
+        _RATE_LIMITER['pid'] = os.getpid()
+        _RATE_LIMITER['limiter'] = throughput.RateLimiter(
+            float(rate) / _RATE_LIMITER['share'])
+
+    return _RATE_LIMITER['limiter']
+
+
+def _get_upload_ledger():
+    """ Returns the upload ledger of the current S3 endpoint
+
+    :returns: tuple or None -- (ledger file, endpoint), None if the ledger
+        is disabled
+    """
+    if not config.is_upload_ledger_enabled():
+        return None
+
+    cache_dir = config.get_cache_dir()
+    if not ospath.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    endpoint = config.get_s3_endpoint()
+    if endpoint:
+        endpoint = '{}:{}'.format(endpoint['host'], endpoint['port'])
+
+    return (
+        ospath.join(cache_dir, upload_ledger.LEDGER_NAME),
+        endpoint or '')
+
+
+def _init_bundle_worker(workers):
+    """ Initialize a bundle worker process
+
+    :type workers: int
+    :param workers: Number of worker processes
+    """
+    _RATE_LIMITER['pid'] = None
+    _RATE_LIMITER['share'] = workers
+
+
+def _is_ledger_entry_trusted(entry):
+    """ Check if an upload ledger entry can be used without asking S3
+
+    :type entry: dict
+    :param entry: Entry from upload_ledger.lookup()
+    :returns: bool -- False if the entry is due for verification
+    """
+    interval = config.get_upload_ledger_verify_interval()
+    return not interval or time.time() - entry['verified'] < interval
+
+
+def _is_shareable_bundle(bundle_type):
+    """ Check if a bundle can be built once for several environments
+
+    :type bundle_type: str
+    :param bundle_type: Bundle name
+    :returns: bool -- True for plain zip bundles
+    """
+    return (
+        not config.has_pre_built_bundle(bundle_type) and
+        not config.get_bundle_source(bundle_type) and
+        not config.is_content_addressed_bundle(bundle_type) and
+        not config.is_incremental_bundle(bundle_type) and
+        not config.is_stream_upload_bundle(bundle_type) and
+        config.get_bundle_format(bundle_type) == 'zip' and
+        config.get_bundle_deduplication(bundle_type) == 'none')
+
+
+def _list_versions(bucket):
+    """ List the bundle versions of the environment in a bucket
+
+    All versions are found with a single paginated listing of the
+    environment prefix. Only keys named like bundles of the environment are
+    included.
+
+    :type bucket: boto.s3.bucket.Bucket
+    :param bucket: Bucket to list
+    :returns: dict -- Versions with their key names and the time of their
+        latest upload, e.g. {'1.0': {'keys': [...], 'modified': '...'}}
+    """
+    environment = config.get_environment()
+    prefix = '{}/'.format(environment)
+
+    versions = {}
+    for key in bucket.list(prefix=prefix):
+        version, _, basename = key.name[len(prefix):].partition('/')
+        if not basename.startswith(
+                'bundle-{}-{}-'.format(environment, version)):
+            continue
+
+        entry = versions.setdefault(version, {'keys': [], 'modified': ''})
+        entry['keys'].append(key.name)
+        entry['modified'] = max(entry['modified'], key.last_modified)
+
+    return versions
+
+
+def _prepare_link(filename, arcname, link, reproducible):
+    """ Prepare a link to an earlier copy of a file for the archive
+
+    :type filename: str
+    :param filename: Path to the local file
+    :type arcname: str
+    :param arcname: Name of the file within the archive
+    :type link: str
+    :param link: Name of the first copy within the archive
+    :type reproducible: bool
+    :param reproducible: Normalize the entry metadata
+    :returns: dict -- Same keys as _prepare_entry()
+    """
+    stat = os.stat(filename)
+    zinfo, data, sha1 = compression.get_link_entry(
+        arcname, link, stat.st_mtime, reproducible=reproducible)
+
+    return {
+        'filename': filename,
+        'stat': stat,
+        'zinfo': zinfo,
+        'sha1': sha1,
+        'data': data,
+        'source': None,
+        'link': link
+    }
+
+
+def _prepare_entry(
+        filename,
+        arcname,
+        previous_archive,
+        previous_entry,
+        reproducible,
+        policy):
+    """ Prepare a file for the archive
+
+    Files that are unchanged since the previous build are not compressed.
+    A file is unchanged if its size, mode and mtime are the same as in the
+    previous manifest. If only the mtime differs the content hash is used
+    to decide.
+
+    This is executed in the compression worker threads.
+
+    :type filename: str
+    :param filename: Path to the local file
+    :type arcname: str
+    :param arcname: Name of the file within the archive
+    :type previous_archive: zipfile.ZipFile or None
+    :param previous_archive: Archive from the previous build
+    :type previous_entry: dict or None
+    :param previous_entry: Manifest entry from the previous build
+    :type reproducible: bool
+    :param reproducible: Normalize the entry metadata
+    :type policy: cumulus_ds.compression.CompressionPolicy
+    :param policy: Decides how new files are compressed
+    :returns: dict -- filename, stat, zinfo, sha1, link (None) and either
+        data (a file object with the compressed data) or source (the
+        ZipInfo of the entry to copy from the previous archive)
+    """
+    stat = os.stat(filename)
+    entry = {
+        'filename': filename,
+        'stat': stat,
+        'data': None,
+        'source': None,
+        'link': None
+    }
+
+    # Links are never reused, as the file content is not in the entry
+    if (previous_archive and previous_entry and
+            not previous_entry.get('link')):
+        try:
+            source = previous_archive.getinfo(previous_entry['arcname'])
+        except KeyError:
+            source = None
+
+        sha1 = None
+        if source and manifest.is_unchanged(previous_entry, stat):
+            sha1 = previous_entry['sha1']
+        elif source and previous_entry['size'] == stat.st_size:
+            sha1 = compression.hash_file(filename)
+
+        if sha1 and sha1 == previous_entry['sha1']:
+            zinfo = compression.get_zipinfo(
+                filename, arcname, reproducible=reproducible)
+            zinfo.compress_type = source.compress_type
+            zinfo.compress_size = source.compress_size
+            zinfo.file_size = source.file_size
+            zinfo.CRC = source.CRC
+
+            entry['zinfo'] = zinfo
+            entry['sha1'] = sha1
+            entry['source'] = source
+            return entry
+
+    entry['zinfo'], entry['data'], entry['sha1'] = \
+        compression.compress_file(
+            filename, arcname, reproducible=reproducible, policy=policy)
+    return entry
+
+
+def _prepare_git_entry(
+        repository,
+        git_file,
+        filename,
+        arcname,
+        previous_archive,
+        previous_entry,
+        reproducible,
+        policy):
+    """ Prepare a file from a git commit for the archive
+
+    Files with the same blob ID as in the previous build are copied from
+    the previous archive without being read.
+
+    This is executed in the compression worker threads.
+
+    :type repository: cumulus_ds.git_source.GitRepository
+    :param repository: Repository to read the file from
+    :type git_file: cumulus_ds.git_source.GitFile
+    :param git_file: File in the commit
+    :type filename: str
+    :param filename: Path of the file in the repository, in local format
+    :type arcname: str
+    :param arcname: Name of the file within the archive
+    :type previous_archive: zipfile.ZipFile or None
+    :param previous_archive: Archive from the previous build
+    :type previous_entry: dict or None
+    :param previous_entry: Manifest entry from the previous build
+    :type reproducible: bool
+    :param reproducible: Normalize the entry metadata
+    :type policy: cumulus_ds.compression.CompressionPolicy
+    :param policy: Decides how new files are compressed
+    :returns: dict -- Same keys as _prepare_entry(), and blob
+    """
+    stat = repository.get_stat(git_file)
+    entry = {
+        'filename': filename,
+        'stat': stat,
+        'data': None,
+        'source': None,
+        'link': None,
+        'blob': git_file.blob
+    }
+
+    zinfo = compression.get_zipinfo(
+        filename, arcname, reproducible=reproducible, stat=stat)
+
+    if (previous_archive and previous_entry and
+            previous_entry.get('blob') == git_file.blob):
+        try:
+            source = previous_archive.getinfo(previous_entry['arcname'])
+        except KeyError:
+            source = None
+
+        if source:
+            zinfo.compress_type = source.compress_type
+            zinfo.compress_size = source.compress_size
+            zinfo.file_size = source.file_size
+            zinfo.CRC = source.CRC
+
+            entry['zinfo'] = zinfo
+            entry['sha1'] = previous_entry['sha1']
+            entry['source'] = source
+            return entry
+
+    blob = repository.read_blob(git_file.blob)
+    try:
+        entry['zinfo'], entry['data'], entry['sha1'] = \
+            compression.compress_stream(blob, zinfo, policy=policy)
+    finally:
+        blob.close()
+
+    return entry
+
+
+def _convert_paths_to_local_format(path):
+    """ Convert paths to have the local path separator
+
+    On Windows systems: Convert any / to \\
+    On Other systems: Convert any \ to /
+
+    :type path: str
+    :param path: Path to operate open
+    :returns: str -- Altered version of path
+    """
+    if sys.platform in ['win32', 'cygwin']:
+        path = path.split('/')
+    else:
+        path = path.split('\\')
+
+    return ospath.sep.join(path)
+
+
+def _find_files(directory, matchers, excludes):
+    """ Get a list of files in directory
+
+    Excluded directories and directories for other environments are
+    pruned from the walk. Symlinks pointing back to a directory being
+    walked are skipped.
+
+    :type directory: str
+    :param directory: Path to a directory
+    :type matchers: dict
+    :param matchers: Environment exclusion rules per environment name
+    :type excludes: list
+    :param excludes: Exclude patterns from the bundle configuration
+    :returns: generator -- (filename, environments) tuples, with the set
+        of environments that do not exclude the directory of the file
+    """
+    ignore_file = ospath.join(directory, path_matcher.IGNORE_FILE)
+    rules = path_matcher.IgnoreRules(
+        excludes + path_matcher.read_ignore_file(ignore_file))
+
+    # Device and inode of the directories above each directory to walk
+    ancestors = {directory: frozenset()}
+
+    # Environments that do not exclude each directory to walk
+    included = {directory: frozenset(matchers.keys())}
+
+    for root, dirs, files in os.walk(directory, followlinks=True):
+        parents = ancestors.pop(root, frozenset())
+        environments = included.pop(root, frozenset(matchers.keys()))
+        stat = os.stat(root)
+        if stat.st_ino:
+            parents = parents | frozenset([(stat.st_dev, stat.st_ino)])
+
+        relroot = ospath.relpath(root, directory).replace(ospath.sep, '/')
+        if relroot == '.':
+            relroot = ''
+        else:
+            relroot += '/'
+
+        # Walk in a stable order, independent of the file system
+        kept = []
+        for basename in sorted(dirs):
+            path = ospath.join(root, basename)
+
+            dir_environments = frozenset([
+                environment
+                for environment in environments
+                if not matchers[environment].is_excluded_dir(basename)
+            ])
+            if not dir_environments:
+                logger.debug('Excluding directory {}'.format(path))
+                continue
 
-        if config.has_pre_built_bundle(bundle_type):
-            bundle_path = config.get_pre_built_bundle_path(
-                bundle_type)
-            logger.info('Using pre-built bundle: {}'.format(bundle_path))
+            if rules.is_ignored(relroot + basename, True):
+                logger.debug('Ignoring directory {}'.format(path))
+                continue
 
-            try:
-                _upload_bundle(bundle_path, bundle_type)
-            except UnsupportedCompression:
-                raise
-        else:
-            logger.info('Building bundle {}'.format(bundle_type))
-            logger.info('Bundle paths: {}'.format(', '.join(
-                config.get_bundle_paths(bundle_type))))
+            if ospath.islink(path):
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    logger.warning('Skipping broken symlink {}'.format(path))
+                    continue
 
-            tmptar = tempfile.NamedTemporaryFile(
-                suffix='.zip',
-                delete=False)
-            logger.debug('Created temporary tar file {}'.format(tmptar.name))
+                if (stat.st_dev, stat.st_ino) in parents:
+                    logger.warning('Skipping symlink loop {}'.format(path))
+                    continue
 
-            try:
-                _bundle_zip(
-                    tmptar,
-                    bundle_type,
-                    config.get_environment(),
-                    config.get_bundle_paths(bundle_type))
+            ancestors[path] = parents
+            included[path] = dir_environments
+            kept.append(basename)
+        dirs[:] = kept
 
-                tmptar.close()
+        for basename in sorted(files):
+            if root == directory and basename == path_matcher.IGNORE_FILE:
+                continue
 
-                try:
-                    _upload_bundle(tmptar.name, bundle_type)
-                except UnsupportedCompression:
-                    raise
-            finally:
-                logger.debug('Removing temporary tar file {}'.format(
-                    tmptar.name))
-                os.remove(tmptar.name)
+            if rules.is_ignored(relroot + basename, False):
+                logger.debug('Ignoring file {}'.format(
+                    ospath.join(root, basename)))
+                continue
 
-        # Run post-bundle-hook
-        _post_bundle_hook(bundle_type)
+            filename = ospath.join(root, basename)
+            yield filename, environments
 
-        logger.info('Done bundling {}'.format(bundle_type))
 
+def _git_bundle_entries(bundle_type, environment, paths, repository):
+    """ Find all files to include in a bundle built from a git commit
 
-def _bundle_zip(tmpfile, bundle_type, environment, paths):
-    """ Create a zip archive
+    The same exclusion rules and path rewrites as for local files apply.
+    The bundle paths are relative to the repository root, and the
+    .cumulusignore files are read from the commit.
 
-    :type tmpfile: tempfile instance
-    :param tmpfile: Tempfile object
     :type bundle_type: str
     :param bundle_type: Bundle name
     :type environment: str
     :param environment: Environment name
     :type paths: list
     :param paths: List of paths to include
+    :type repository: cumulus_ds.git_source.GitRepository
+    :param repository: Repository to read the files from
+    :returns: generator -- (filename, arcname, git_file) tuples
     """
-    logger.info('Generating zip file for {}'.format(bundle_type))
-    archive = zipfile.ZipFile(tmpfile, 'w')
-    path_rewrites = config.get_bundle_path_rewrites(bundle_type)
+    matcher = _get_path_matcher(bundle_type, environment)
+    excludes = config.get_bundle_excludes(bundle_type)
 
     for path in paths:
-        path = _convert_paths_to_local_format(path)
+        path = path.replace(ospath.sep, '/').strip('/')
+        if path == '.':
+            path = ''
 
-        if ospath.isdir(path):
-            # Extract all file names from directory
-            filenames = _find_files(path)
-        else:
-            filenames = [path]
+        ignore_file = posixpath.join(path, path_matcher.IGNORE_FILE)
+        rules = path_matcher.IgnoreRules(
+            excludes + path_matcher.parse_ignore_patterns(
+                (repository.read_file(ignore_file) or '').splitlines()))
 
-        for filename in filenames:
-            arcname = filename
+        for git_file in repository.list_files(path):
+            filename = _convert_paths_to_local_format(git_file.path)
 
-            # Exclude files with other target environments
-            prefix = '__cumulus-{}__'.format(environment)
-            basename = ospath.basename(filename)
+            if git_file.path != path:
+                if git_file.path == ignore_file:
+                    continue
 
-            if basename.startswith('__cumulus-'):
-                if len(basename.split(prefix)) != 2:
-                    logger.debug('Excluding file {}'.format(filename))
+                relpath = git_file.path[len(path):].lstrip('/')
+                if _is_git_file_ignored(relpath, matcher, rules):
+                    logger.debug('Ignoring file {}'.format(filename))
                     continue
-            elif prefix in filename.split(ospath.sep):
+
+            if matcher.is_excluded(filename):
                 logger.debug('Excluding file {}'.format(filename))
                 continue
 
-            # Do all rewrites
-            for rewrite in path_rewrites:
-                target = _convert_paths_to_local_format(
-                    rewrite['target'].replace('\\\\', '\\'))
-                destination = _convert_paths_to_local_format(
-                    rewrite['destination'].replace('\\\\', '\\'))
-
-                try:
-                    if arcname[:len(target)] == target:
-                        arcname = arcname.replace(
-                            target,
-                            destination)
-                        logger.debug(
-                            'Replaced "{}" with "{}" in bundle {}'.format(
-                                target,
-                                destination,
-                                bundle_type))
-                except IndexError:
-                    pass
+            arcname = matcher.rewrite(filename)
+            if arcname != filename:
+                logger.debug('Rewrote "{}" to "{}" in bundle {}'.format(
+                    filename, arcname, bundle_type))
 
             logger.debug('Adding: {}'.format(filename))
-            archive.write(filename, arcname, zipfile.ZIP_DEFLATED)
-
-    archive.close()
+            yield filename, arcname, git_file
 
 
-def _convert_paths_to_local_format(path):
-    """ Convert paths to have the local path separator
+def _is_git_file_ignored(relpath, matcher, rules):
+    """ Check if a file from git is excluded by its path
 
-    On Windows systems: Convert any / to \\
-    On Other systems: Convert any \ to /
+    The directories of the file are checked like _find_files() checks the
+    directories it walks.
 
-    :type path: str
-    :param path: Path to operate open
-    :returns: str -- Altered version of path
+    :type relpath: str
+    :param relpath: / separated path relative to the bundle path
+    :type matcher: cumulus_ds.path_matcher.PathMatcher
+    :param matcher: Environment exclusion rules
+    :type rules: cumulus_ds.path_matcher.IgnoreRules
+    :param rules: Exclude patterns
+    :returns: bool -- True if the file should not be bundled
     """
-    if sys.platform in ['win32', 'cygwin']:
-        path = path.split('/')
-    else:
-        path = path.split('\\')
-
-    return ospath.sep.join(path)
+    parts = relpath.split('/')
+    for index in xrange(len(parts) - 1):
+        if matcher.is_excluded_dir(parts[index]):
+            return True
 
+        if rules.is_ignored('/'.join(parts[:index + 1]), True):
+            return True
 
-def _find_files(directory):
-    """ Get a list of files in directory
+    return rules.is_ignored(relpath, False)
 
-    :type directory: str
-    :param directory: Path to a directory
-    """
-    for root, dirs, files in os.walk(directory, followlinks=True):
-        for basename in files:
-            filename = ospath.join(root, basename)
-            yield filename
 
+def _generate_local_checksum(filename):
+    """ Get the checksum of a local file
 
-def _generate_local_md5hash(filename):
-    """ Get the MD5 hash of a local file
+    The file is read in chunks and both the MD5 and the multipart upload
+    ETag are calculated.
 
     :type filename: str
     :param filename: Path to the file to read
-    :returns: str -- MD5 of the file
+    :returns: cumulus_ds.checksum.BundleChecksum -- Checksum of the file
     """
     if not ospath.exists(filename):
         logger.warning(
@@ -187,26 +1838,48 @@ def _generate_local_md5hash(filename):
             'File does not exist.'.format(filename))
         return None
 
-    hash = hashlib.md5(open(filename, 'rb').read()).hexdigest()
+    bundle_checksum = checksum.hash_file(
+        filename, config.get_upload_part_size())
     logger.debug('Generated md5 checksum for {} ({})'.format(
-        ospath.basename(filename), hash))
+        ospath.basename(filename), bundle_checksum.md5))
 
-    return hash
+    return bundle_checksum
 
 
-def _key_exists(bucket_name, key_name, checksum=None):
+def _key_exists(bucket_name, key_name, bundle_checksum=None):
     """ Check if the given key exists in AWS S3.
 
-    If checksum is given, also check if the md5 checksum is the same
+    If bundle_checksum is given, also check if the checksum is the same. The
+    ETag of objects uploaded as multipart uploads is compared using the
+    part digests of the checksum.
+
+    Objects recorded in the upload ledger with the same checksum are not
+    looked up in S3, unless they are due for verification.
 
     :type bucket_name: str
     :param bucket_name: S3 bucket name
     :type key_name: str
     :param key_name: S3 key name
-    :type checksum: str
-    :param checksum: MD5 checksum
+    :type bundle_checksum: cumulus_ds.checksum.BundleChecksum
+    :param bundle_checksum: Checksum of the local bundle
     :returns: bool -- True if the key exists
     """
+    ledger = _get_upload_ledger()
+    entry = None
+    if ledger:
+        entry = upload_ledger.lookup(
+            ledger[0], ledger[1], bucket_name, key_name)
+
+        if bundle_checksum and entry and (
+                entry['md5'] != bundle_checksum.md5 or
+                entry['size'] != bundle_checksum.size):
+            entry = None
+
+        if entry and _is_ledger_entry_trusted(entry):
+            logger.debug('Found s3://{}/{} in the upload ledger'.format(
+                bucket_name, key_name))
+            return True
+
     try:
         connection = connection_handler.connect_s3()
     except Exception:
@@ -216,13 +1889,34 @@ def _key_exists(bucket_name, key_name, checksum=None):
 
     key = bucket.get_key(key_name)
     if not key:
+        if entry:
+            logger.warning(
+                's3://{}/{} is in the upload ledger, but not in S3'.format(
+                    bucket_name, key_name))
+            upload_ledger.forget(ledger[0], ledger[1], bucket_name, key_name)
         return False
 
-    if checksum:
-        if key.etag.replace('"', '') == checksum:
+    if bundle_checksum:
+        if bundle_checksum.matches_etag(key.etag):
+            if ledger:
+                upload_ledger.record(
+                    ledger[0],
+                    ledger[1],
+                    bucket_name,
+                    key_name,
+                    key.etag,
+                    bundle_checksum.md5,
+                    bundle_checksum.size)
             return True
+
+        if entry:
+            upload_ledger.forget(ledger[0], ledger[1], bucket_name, key_name)
         return False
 
+    if entry:
+        upload_ledger.mark_verified(
+            ledger[0], ledger[1], bucket_name, key_name)
+
     return True
 
 
@@ -232,18 +1926,10 @@ def _post_bundle_hook(bundle_name):
     :type bundle: str
     :param bundle: Bundle name
     """
-    command = config.get_post_bundle_hook(bundle_name)
-
-    if not command:
-        return None
-
-    logger.info('Running post-bundle-hook command: "{}"'.format(command))
-    try:
-        subprocess.check_call(command, shell=True)
-    except subprocess.CalledProcessError, error:
-        raise HookExecutionException(
-            'The post-bundle-hook returned a non-zero exit code: {}'.format(
-                error))
+    _run_bundle_hook(
+        'post-bundle-hook',
+        bundle_name,
+        config.get_post_bundle_hook(bundle_name))
 
 
 def _pre_bundle_hook(bundle_name):
@@ -252,25 +1938,405 @@ def _pre_bundle_hook(bundle_name):
     :type bundle: str
     :param bundle: Bundle name
     """
-    command = config.get_pre_bundle_hook(bundle_name)
+    _run_bundle_hook(
+        'pre-bundle-hook',
+        bundle_name,
+        config.get_pre_bundle_hook(bundle_name))
 
+
+def _promote_bundle(bundle_type, source_environment):
+    """ Copy a bundle of another environment to the current environment
+
+    The bundle, its manifest and, for content addressed bundles stored in
+    another bucket, the missing objects are copied.
+
+    :type bundle_type: str
+    :param bundle_type: Bundle name
+    :type source_environment: str
+    :param source_environment: Environment to promote the bundle from
+    """
+    environment = config.get_environment()
+
+    # The source bucket is read through a connection to its own region
+    config.set_environment(source_environment)
+    try:
+        source_version = config.get_environment_option('version')
+        source_key_names = {}
+        for suffix in BUNDLE_FORMATS + ['manifest.json']:
+            source_key_names[suffix] = _get_key_name(bundle_type, suffix)
+
+        source_bucket = connection_handler.connect_s3(
+            region=config.get_environment_option('region')).get_bucket(
+                config.get_environment_option('bucket'))
+    finally:
+        config.set_environment(environment)
+
+    try:
+        connection = connection_handler.connect_s3()
+    except Exception:
+        raise
+
+    bucket = connection.get_bucket(config.get_environment_option('bucket'))
+
+    source_keys = []
+    for suffix in BUNDLE_FORMATS:
+        key = source_bucket.get_key(source_key_names[suffix])
+        if key:
+            source_keys.append((suffix, key))
+
+    if not source_keys:
+        raise BundleBuildException(
+            'No bundle {} found for version {} of environment {}'.format(
+                bundle_type, source_version, source_environment))
+
+    manifest_key = source_bucket.get_key(source_key_names['manifest.json'])
+
+    # Environment specific files would end up in the wrong environment
+    differences = _get_environment_differences(
+        bundle_type, [source_environment, environment])
+    if differences is None:
+        if manifest_key:
+            listing_key = manifest_key
+        else:
+            listing_key = dict(source_keys).get('objects.json')
+
+        if listing_key:
+            differences = [
+                arcname
+                for arcname in json.loads(
+                    listing_key.get_contents_as_string())['files']
+                if path_matcher.ENVIRONMENT_PREFIX in arcname
+            ]
+        elif config.args.force:
+            logger.warning(
+                'Cannot check bundle {} for environment specific files, '
+                'promoting it anyway'.format(bundle_type))
+            differences = []
+        else:
+            raise BundleBuildException(
+                'Cannot check bundle {} for environment specific files. '
+                'Use --force to promote it anyway'.format(bundle_type))
+
+    if differences:
+        for arcname in sorted(differences):
+            logger.debug('Environment specific file: {}'.format(arcname))
+        raise BundleBuildException(
+            'Bundle {} has {:d} files that differ between {} and {}. '
+            'Build it with --bundle instead'.format(
+                bundle_type,
+                len(differences),
+                source_environment,
+                environment))
+
+    logger.info('Promoting bundle {} from environment {}'.format(
+        bundle_type, source_environment))
+
+    for suffix, key in source_keys:
+        if suffix == 'objects.json' and source_bucket.name != bucket.name:
+            _promote_objects(key, bucket)
+
+        _copy_key(key, bucket, _get_key_name(bundle_type, suffix))
+
+    # The manifest is copied last, delta bundles are built from it
+    if manifest_key:
+        _copy_key(
+            manifest_key, bucket, _get_key_name(bundle_type, 'manifest.json'))
+
+    _replicate_bundle(bundle_type)
+
+    logger.info('Done promoting {}'.format(bundle_type))
+
+
+def _promote_objects(objects_key, bucket):
+    """ Copy the objects of a content addressed bundle missing in bucket
+
+    :type objects_key: boto.s3.key.Key
+    :param objects_key: Object manifest of the bundle
+    :type bucket: boto.s3.bucket.Bucket
+    :param bucket: Bucket to copy the objects to
+    """
+    files = json.loads(objects_key.get_contents_as_string())['files']
+    existing = object_store.list_objects(bucket)
+
+    key_names = sorted(set([
+        entry['key']
+        for entry in files.values()
+        if entry['key'] not in existing
+    ]))
+    logger.info('Copying {:d} of {:d} objects to s3://{}'.format(
+        len(key_names), len(files), bucket.name))
+
+    for key_name in key_names:
+        source_key = objects_key.bucket.get_key(key_name)
+        if not source_key:
+            raise BundleBuildException(
+                'Object s3://{}/{} not found'.format(
+                    objects_key.bucket.name, key_name))
+
+        _copy_key(source_key, bucket, key_name)
+
+
+def _record_copy(ledger, source_key, bucket, key_name):
+    """ Record a copied object in the upload ledger
+
+    The MD5 of the data is only known if the ETag is a plain MD5.
+
+    :type ledger: tuple or None
+    :param ledger: Ledger from _get_upload_ledger()
+    :type source_key: boto.s3.key.Key
+    :param source_key: Object that was copied
+    :type bucket: boto.s3.bucket.Bucket
+    :param bucket: Bucket the object was copied to
+    :type key_name: str
+    :param key_name: S3 key name of the copy
+    """
+    if not ledger:
+        return
+
+    etag = source_key.etag.strip('"')
+    upload_ledger.record(
+        ledger[0],
+        ledger[1],
+        bucket.name,
+        key_name,
+        etag,
+        '' if '-' in etag else etag,
+        source_key.size)
+
+
+def _replicate_bundle(bundle_type):
+    """ Copy a bundle version to the replica buckets of the environment
+
+    All objects of the bundle version, including manifests, delta bundles
+    and the objects of content addressed bundles, are copied within S3 to
+    all replica buckets in parallel. The checksum of every copy is
+    verified. The manifest is copied last, as for promoted bundles.
+
+    :type bundle_type: str
+    :param bundle_type: Bundle name
+    """
+    replicas = config.get_replica_buckets()
+    if not replicas:
+        return None
+
+    try:
+        connection = connection_handler.connect_s3()
+    except Exception:
+        raise
+
+    bucket = connection.get_bucket(
+        config.get_environment_option('bucket'), validate=False)
+
+    manifest_key_name = _get_key_name(bundle_type, 'manifest.json')
+    source_keys = sorted(
+        bucket.list(prefix=_get_key_name(bundle_type, '')),
+        key=lambda key: (key.name == manifest_key_name, key.name))
+    if not source_keys:
+        logger.warning('Nothing to replicate for bundle {}'.format(
+            bundle_type))
+        return None
+
+    logger.info('Replicating {} to {}'.format(
+        bundle_type,
+        ', '.join([
+            '{} ({})'.format(replica_bucket, region)
+            for region, replica_bucket in replicas])))
+
+    def replicate(replica):
+        """ Copy the bundle to one replica bucket """
+        region, bucket_name = replica
+        replica_bucket = connection_handler.connect_s3(
+            region=region).get_bucket(bucket_name, validate=False)
+
+        for key in source_keys:
+            if key.name.endswith('.objects.json'):
+                _promote_objects(key, replica_bucket)
+
+            _copy_key(key, replica_bucket, key.name)
+
+    pool = ThreadPool(len(replicas))
+    try:
+        pool.map(replicate, replicas)
+    finally:
+        pool.close()
+        pool.join()
+
+    logger.info('Replicated {} to {:d} buckets'.format(
+        bundle_type, len(replicas)))
+
+
+def _run_bundle_hook(hook, bundle_name, command):
+    """ Execute a bundle hook
+
+    If the hook has declared inputs and neither they nor the declared
+    environment variables changed since its last successful run for the
+    environment, the hook is skipped and its declared outputs are restored
+    from the cache.
+
+    :type hook: str
+    :param hook: pre-bundle-hook or post-bundle-hook
+    :type bundle_name: str
+    :param bundle_name: Bundle name
+    :type command: str or None
+    :param command: Hook command
+    """
     if not command:
         return None
 
-    logger.info('Running pre-bundle-hook command: "{}"'.format(command))
+    cache = None
+    inputs = config.get_bundle_hook_inputs(bundle_name, hook)
+    if inputs:
+        cache = hook_cache.HookCache(
+            ospath.join(
+                config.get_cache_dir(),
+                'hooks',
+                config.get_environment(),
+                bundle_name,
+                hook),
+            command,
+            inputs,
+            config.get_bundle_hook_outputs(bundle_name, hook),
+            config.get_environment(),
+            dict([
+                (name, os.environ.get(name))
+                for name in config.get_bundle_hook_variables(
+                    bundle_name, hook)
+            ]))
+
+        if cache.is_fresh():
+            logger.info(
+                'Skipping {} for {}, its inputs are unchanged'.format(
+                    hook, bundle_name))
+            cache.restore_outputs()
+            return None
+
+    logger.info('Running {} command: "{}"'.format(hook, command))
     try:
         subprocess.check_call(command, shell=True)
     except subprocess.CalledProcessError, error:
         raise HookExecutionException(
-            'The pre-bundle-hook returned a non-zero exit code: {}'.format(
-                error))
+            'The {} returned a non-zero exit code: {}'.format(hook, error))
 
+    if cache:
+        cache.save()
 
-def _upload_bundle(bundle_path, bundle_type):
-    """ Upload all bundles to S3
 
-    :type bundle_path: str
-    :param bundle_path: Local path to the bundle
+def _stream_bundle(bundle_type, cache_path=None, previous=None):
+    """ Build a bundle and upload it while it is being written
+
+    The archive is written straight into an S3 multipart upload, so no
+    temporary file is needed. A local copy is only kept when the bundle
+    is built incrementally, as the next build reads from it.
+
+    :type bundle_type: str
+    :param bundle_type: Bundle name
+    :type cache_path: str or None
+    :param cache_path: Directory for the incremental build data
+    :type previous: dict or None
+    :param previous: Manifest from the previous build
+    :returns: dict or None -- Manifest of the bundle, None for tar bundles
+    """
+    try:
+        connection = connection_handler.connect_s3()
+    except Exception:
+        raise
+
+    bucket = connection.get_bucket(
+        config.get_environment_option('bucket'))
+    key_name = _get_key_name(
+        bundle_type, config.get_bundle_format(bundle_type))
+
+    logger.info('Starting streaming upload of {} to s3://{}/{}'.format(
+        bundle_type, bucket.name, key_name))
+
+    stream = uploader.MultipartUploadStream(
+        bucket,
+        key_name,
+        part_size=config.get_upload_part_size(),
+        concurrency=config.get_upload_concurrency(),
+        retries=config.get_upload_retries(),
+        rate_limiter=_get_rate_limiter(),
+        adaptive=config.is_upload_concurrency_adaptive())
+
+    output = stream
+    local_copy = None
+    if cache_path:
+        local_copy = tempfile.NamedTemporaryFile(
+            suffix='.zip',
+            delete=False)
+        output = compression.TeeWriter(stream, local_copy)
+
+    try:
+        try:
+            bundle_manifest = _bundle_archive(
+                output, bundle_type, previous=previous)
+            stream.close()
+        except:
+            stream.abort()
+            raise
+
+        if local_copy:
+            local_copy.close()
+            manifest.save(cache_path, bundle_manifest, local_copy.name)
+    finally:
+        if local_copy and ospath.exists(local_copy.name):
+            local_copy.close()
+            os.remove(local_copy.name)
+
+    logger.info('Completed upload of {} to s3://{}/{} ({})'.format(
+        bundle_type, bucket.name, key_name, stream.etag))
+
+    return bundle_manifest
+
+
+def _get_compression_policy(bundle_type):
+    """ Returns the compression policy for a zip bundle
+
+    :type bundle_type: str
+    :param bundle_type: Bundle name
+    :returns: cumulus_ds.compression.CompressionPolicy
+    """
+    return compression.CompressionPolicy(
+        level=config.get_compression_level(bundle_type),
+        store_extensions=config.get_compression_store_extensions(bundle_type),
+        min_size=config.get_compression_min_size(bundle_type),
+        entropy_sampling=config.is_entropy_sampling_bundle(bundle_type))
+
+
+def _get_key_name(bundle_type, compression_format, version=None):
+    """ Returns the S3 key name for a bundle
+
+    :type bundle_type: str
+    :param bundle_type: Bundle type
+    :type compression_format: str
+    :param compression_format: File extension, e.g. zip
+    :type version: str or None
+    :param version: Environment version, the current version if None
+    :returns: str -- Key name
+    """
+    if not version:
+        version = config.get_environment_option('version')
+
+    return (
+        '{environment}/{version}/'
+        'bundle-{environment}-{version}-{bundle_type}.{compression}').format(
+            environment=config.get_environment(),
+            version=version,
+            bundle_type=bundle_type,
+            compression=compression_format)
+
+
+def _transfer_pre_built_bundle(url, bundle_type):
+    """ Stream a pre-built bundle from an HTTP server to S3
+
+    The download is written straight into an S3 multipart upload, so the
+    bundle is never stored locally. The URL, ETag and Last-Modified
+    header of the download are stored as metadata of the bundle in S3, and
+    sent as conditions with the next download. If the server answers 304
+    Not Modified, the bundle in S3 is kept.
+
+    :type url: str
+    :param url: http(s):// URL of the bundle
     :type bundle_type: str
     :param bundle_type: Bundle type
     """
@@ -281,57 +2347,367 @@ def _upload_bundle(bundle_path, bundle_type):
 
     bucket = connection.get_bucket(
         config.get_environment_option('bucket'))
+    key_name = _get_key_name(
+        bundle_type, _get_compression_format(urlparse.urlparse(url).path))
+
+    request = urllib2.Request(url)
+    key = bucket.get_key(key_name)
+    if key and key.get_metadata('source-url') == url:
+        if key.get_metadata('source-etag'):
+            request.add_header(
+                'If-None-Match', key.get_metadata('source-etag'))
+        if key.get_metadata('source-last-modified'):
+            request.add_header(
+                'If-Modified-Since', key.get_metadata('source-last-modified'))
+
+    try:
+        response = urllib2.urlopen(request)
+    except urllib2.HTTPError as error:
+        if error.code == 304:
+            logger.info(
+                'This bundle is already uploaded to AWS S3. Skipping upload.')
+            return
+        raise BundleBuildException(
+            'Failed to download pre-built bundle {}: {}'.format(url, error))
+    except urllib2.URLError as error:
+        raise BundleBuildException(
+            'Failed to download pre-built bundle {}: {}'.format(url, error))
+
+    metadata = {'source-url': url}
+    for header in ['etag', 'last-modified']:
+        if response.info().getheader(header):
+            metadata['source-{}'.format(header)] = response.info().getheader(
+                header)
+
+    logger.info('Starting transfer of {} from {} to s3://{}/{}'.format(
+        bundle_type, url, bucket.name, key_name))
+
+    stream = uploader.MultipartUploadStream(
+        bucket,
+        key_name,
+        part_size=config.get_upload_part_size(),
+        concurrency=config.get_upload_concurrency(),
+        retries=config.get_upload_retries(),
+        metadata=metadata,
+        rate_limiter=_get_rate_limiter(),
+        adaptive=config.is_upload_concurrency_adaptive())
 
+    try:
+        try:
+            while True:
+                chunk = response.read(checksum.CHUNK_SIZE)
+                if not chunk:
+                    break
+                stream.write(chunk)
+
+            length = response.info().getheader('content-length')
+            if length and int(length) != stream.tell():
+                raise BundleBuildException(
+                    'Incomplete download of {}: got {:d} of {} bytes'.format(
+                        url, stream.tell(), length))
+
+            stream.close()
+        except:
+            stream.abort()
+            raise
+    finally:
+        response.close()
+
+    logger.info('Completed transfer of {} to s3://{}/{} ({})'.format(
+        bundle_type, bucket.name, key_name, stream.etag))
+
+
+def _upload_bundle(bundle_path, bundle_type, bundle_checksum=None):
+    """ Upload all bundles to S3
+
+    :type bundle_path: str
+    :param bundle_path: Local path to the bundle
+    :type bundle_type: str
+    :param bundle_type: Bundle type
+    :type bundle_checksum: cumulus_ds.checksum.BundleChecksum or None
+    :param bundle_checksum: Checksum calculated while the bundle was
+        written. The bundle is read to calculate it if it is not given
+    """
     # Check that the bundle actually exists
     if not ospath.exists(bundle_path):
         logger.error('File not found: {}'.format(bundle_path))
         sys.exit(1)
 
-    if bundle_path.endswith('.zip'):
-        compression = 'zip'
-    else:
-        raise UnsupportedCompression(
-            'Unknown compression format for {}. '
-            'We are currently only supporting .zip'.format(bundle_path))
+    compression = _get_compression_format(bundle_path)
 
-    # Generate a md5 checksum for the local bundle
-    local_hash = _generate_local_md5hash(bundle_path)
+    # Generate a checksum for the local bundle
+    if not bundle_checksum:
+        bundle_checksum = _generate_local_checksum(bundle_path)
 
-    key_name = (
-        '{environment}/{version}/'
-        'bundle-{environment}-{version}-{bundle_type}.{compression}').format(
-            environment=config.get_environment(),
-            version=config.get_environment_option('version'),
-            bundle_type=bundle_type,
-            compression=compression)
+    key_name = _get_key_name(bundle_type, compression)
 
     # Do not upload bundles if the key already exists and has the same
-    # md5 checksum
+    # checksum
     if _key_exists(
             config.get_environment_option('bucket'),
             key_name,
-            checksum=local_hash):
+            bundle_checksum=bundle_checksum):
         logger.info(
             'This bundle is already uploaded to AWS S3. Skipping upload.')
         return
 
-    # Get the key object
-    key = bucket.new_key(key_name)
+    try:
+        connection = connection_handler.connect_s3()
+    except Exception:
+        raise
+
+    bucket = connection.get_bucket(
+        config.get_environment_option('bucket'))
 
     logger.info('Starting upload of {} to s3://{}/{}'.format(
         bundle_type, bucket.name, key_name))
 
-    key.set_contents_from_filename(bundle_path, replace=True)
+    etag = uploader.upload_file(
+        bucket,
+        key_name,
+        bundle_path,
+        bundle_checksum,
+        concurrency=config.get_upload_concurrency(),
+        retries=config.get_upload_retries(),
+        journal_dir=ospath.join(config.get_cache_dir(), 'uploads'),
+        rate_limiter=_get_rate_limiter(),
+        adaptive=config.is_upload_concurrency_adaptive())
 
     logger.info('Completed upload of {} to s3://{}/{}'.format(
         bundle_type, bucket.name, key_name))
 
-    # Compare MD5 checksums
-    if local_hash == key.md5:
-        logger.debug('Uploaded bundle checksum OK ({})'.format(key.md5))
+    # Compare checksums
+    if bundle_checksum.matches_etag(etag):
+        logger.debug('Uploaded bundle checksum OK ({})'.format(etag))
+
+        ledger = _get_upload_ledger()
+        if ledger:
+            upload_ledger.record(
+                ledger[0],
+                ledger[1],
+                bucket.name,
+                key_name,
+                etag,
+                bundle_checksum.md5,
+                bundle_checksum.size)
     else:
-        logger.error('Mismatching md5 checksum {} ({}) and {} ({})'.format(
-            bundle_path, local_hash, key_name, key.md5))
+        logger.error('Mismatching checksum {} ({}) and {} ({})'.format(
+            bundle_path, bundle_checksum.md5, key_name, etag))
         raise ChecksumMismatchException(
-            'Mismatching md5 checksum {} ({}) and {} ({})'.format(
-                bundle_path, local_hash, key_name, key.md5))
+            'Mismatching checksum {} ({}) and {} ({})'.format(
+                bundle_path, bundle_checksum.md5, key_name, etag))
+
+
+def _upload_delta(bundle_type, bundle_manifest, base_version):
+    """ Upload a delta bundle with the changes since base_version
+
+    The delta bundle is a zip archive holding the added and changed files.
+    It is uploaded together with a JSON description listing the changed and
+    the deleted files. Hosts with base_version installed can apply it
+    instead of downloading the full bundle.
+
+    :type bundle_type: str
+    :param bundle_type: Bundle type
+    :type bundle_manifest: dict
+    :param bundle_manifest: Manifest of the full bundle
+    :type base_version: str
+    :param base_version: Version to build the delta from
+    """
+    if base_version == config.get_environment_option('version'):
+        logger.warning(
+            'Not building a delta bundle from the version being built')
+        return
+
+    try:
+        connection = connection_handler.connect_s3()
+    except Exception:
+        raise
+
+    bucket = connection.get_bucket(
+        config.get_environment_option('bucket'))
+
+    base_key = bucket.get_key(
+        _get_key_name(bundle_type, 'manifest.json', version=base_version))
+    if not base_key:
+        logger.warning(
+            'No manifest found for version {} of bundle {}. '
+            'Not building a delta bundle'.format(base_version, bundle_type))
+        return
+
+    base = json.loads(base_key.get_contents_as_string())
+    if base.get('format') != manifest.REMOTE_MANIFEST_FORMAT:
+        logger.warning(
+            'Unsupported manifest format for version {} of bundle {}. '
+            'Not building a delta bundle'.format(base_version, bundle_type))
+        return
+
+    changed, deleted = manifest.get_delta(
+        base, manifest.get_remote_manifest(bundle_manifest))
+    logger.info(
+        'Building delta bundle for {} from version {}: '
+        '{:d} changed and {:d} deleted files'.format(
+            bundle_type, base_version, len(changed), len(deleted)))
+
+    filenames = {}
+    for filename, entry in bundle_manifest['files'].items():
+        filenames[entry['arcname']] = (filename, entry)
+
+    policy = _get_compression_policy(bundle_type)
+    reproducible = config.is_reproducible_bundle(bundle_type)
+
+    # Files of git bundles are read from the repository again
+    repository = None
+    if config.get_bundle_source(bundle_type):
+        repository = git_source.GitRepository(
+            *config.get_bundle_source(bundle_type))
+
+    tmpfile = tempfile.NamedTemporaryFile(suffix='.zip', delete=False)
+    bundle_checksum = checksum.BundleChecksum(config.get_upload_part_size())
+    try:
+        archive = zipfile.ZipFile(
+            checksum.ChecksumWriter(tmpfile, bundle_checksum),
+            'w',
+            allowZip64=True)
+
+        for arcname in changed:
+            filename, entry = filenames[arcname]
+            if entry.get('link'):
+                zinfo, data, file_sha1 = compression.get_link_entry(
+                    arcname,
+                    entry['link'],
+                    entry['mtime'],
+                    reproducible=reproducible)
+            elif repository:
+                blob = repository.read_blob(entry['blob'])
+                try:
+                    zinfo, data, file_sha1 = compression.compress_stream(
+                        blob,
+                        compression.get_zipinfo(
+                            filename,
+                            arcname,
+                            reproducible=reproducible,
+                            stat=git_source.make_stat(
+                                entry['mode'], entry['size'], entry['mtime'])),
+                        policy=policy)
+                finally:
+                    blob.close()
+            else:
+                zinfo, data, file_sha1 = compression.compress_file(
+                    filename,
+                    arcname,
+                    reproducible=reproducible,
+                    policy=policy)
+
+            try:
+                if file_sha1 != entry['sha1']:
+                    raise ChecksumMismatchException(
+                        '{} changed while bundling'.format(filename))
+
+                compression.write_raw_entry(archive, zinfo, data)
+            finally:
+                data.close()
+
+        archive.close()
+        tmpfile.close()
+
+        delta_name = 'delta-{}'.format(base_version)
+        key_name = _get_key_name(bundle_type, '{}.zip'.format(delta_name))
+
+        etag = uploader.upload_file(
+            bucket,
+            key_name,
+            tmpfile.name,
+            bundle_checksum,
+            concurrency=config.get_upload_concurrency(),
+            retries=config.get_upload_retries(),
+            journal_dir=ospath.join(config.get_cache_dir(), 'uploads'),
+            rate_limiter=_get_rate_limiter(),
+            adaptive=config.is_upload_concurrency_adaptive())
+
+        if not bundle_checksum.matches_etag(etag):
+            raise ChecksumMismatchException(
+                'Mismatching checksum {} ({}) and {} ({})'.format(
+                    tmpfile.name, bundle_checksum.md5, key_name, etag))
+    finally:
+        if repository:
+            repository.close()
+        tmpfile.close()
+        if ospath.exists(tmpfile.name):
+            os.remove(tmpfile.name)
+
+    # The description is uploaded last, as hosts look for it first
+    _upload_json(
+        bucket,
+        _get_key_name(bundle_type, '{}.json'.format(delta_name)),
+        {
+            'format': manifest.REMOTE_MANIFEST_FORMAT,
+            'base-version': base_version,
+            'version': config.get_environment_option('version'),
+            'changed': changed,
+            'deleted': deleted
+        })
+
+    logger.info('Completed upload of delta bundle to s3://{}/{}'.format(
+        bucket.name, key_name))
+
+
+def _upload_json(bucket, key_name, data):
+    """ Upload a JSON document to S3
+
+    The upload is skipped if the upload ledger has the same document.
+
+    :type bucket: boto.s3.bucket.Bucket
+    :param bucket: Bucket to upload to
+    :type key_name: str
+    :param key_name: S3 key name
+    :type data: dict
+    :param data: Data to serialize
+    """
+    body = json.dumps(data, sort_keys=True)
+    md5 = hashlib.md5(body).hexdigest()
+
+    ledger = _get_upload_ledger()
+    if ledger:
+        entry = upload_ledger.lookup(
+            ledger[0], ledger[1], bucket.name, key_name)
+        if (entry and entry['md5'] == md5 and
+                _is_ledger_entry_trusted(entry)):
+            logger.debug('Found s3://{}/{} in the upload ledger'.format(
+                bucket.name, key_name))
+            return
+
+    key = bucket.new_key(key_name)
+    key.set_contents_from_string(
+        body,
+        headers={'Content-Type': 'application/json'})
+    logger.debug('Uploaded s3://{}/{}'.format(bucket.name, key_name))
+
+    if ledger:
+        upload_ledger.record(
+            ledger[0], ledger[1], bucket.name, key_name, md5, md5, len(body))
+
+
+def _upload_manifest(bundle_type, bundle_manifest):
+    """ Upload the remote manifest of a bundle
+
+    The manifest is needed to build delta bundles from this version later.
+
+    :type bundle_type: str
+    :param bundle_type: Bundle type
+    :type bundle_manifest: dict
+    :param bundle_manifest: Manifest returned when the bundle was built
+    """
+    try:
+        connection = connection_handler.connect_s3()
+    except Exception:
+        raise
+
+    # Not validated, so that no request is made if the manifest is
+    # already uploaded
+    bucket = connection.get_bucket(
+        config.get_environment_option('bucket'), validate=False)
+
+    _upload_json(
+        bucket,
+        _get_key_name(bundle_type, 'manifest.json'),
+        manifest.get_remote_manifest(bundle_manifest))
@@ -0,0 +1,178 @@
+""" Streaming checksums of bundles, matching the ETags S3 assigns """
+import hashlib
+import logging
+
+LOGGER = logging.getLogger(__name__)
+
+# Read files in chunks of this size
+CHUNK_SIZE = 1024 * 1024
+
+# S3 does not accept parts smaller than 5 MB, except for the last part
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+# S3 does not accept more than 10000 parts
+MAX_PARTS = 10000
+
+
+def get_multipart_etag(part_digests):
+    """ Calculate the ETag S3 assigns to a completed multipart upload
+
+    :type part_digests: list
+    :param part_digests: Binary MD5 digests of all parts, in order
+    :returns: str -- ETag without quotes
+    """
+    return '{}-{:d}'.format(
+        hashlib.md5(''.join(part_digests)).hexdigest(),
+        len(part_digests))
+
+
+def get_part_size(part_size, size=None):
+    """ Returns the part size to use for a multipart upload
+
+    The part size is raised to the S3 minimum, and if size is given, so
+    that the upload does not need more parts than S3 allows.
+
+    :type part_size: int
+    :param part_size: Configured part size in bytes
+    :type size: int or None
+    :param size: Size of the uploaded object in bytes, if known
+    :returns: int -- Part size in bytes
+    """
+    part_size = max(part_size, MIN_PART_SIZE)
+    if size:
+        part_size = max(part_size, -(-size // MAX_PARTS))
+
+    return part_size
+
+
+def hash_file(filename, part_size):
+    """ Calculate the checksum of a local file, reading it in chunks
+
+    :type filename: str
+    :param filename: Path to the file to read
+    :type part_size: int
+    :param part_size: Configured multipart upload part size in bytes
+    :returns: BundleChecksum
+    """
+    checksum = BundleChecksum(part_size)
+    with open(filename, 'rb') as file_handle:
+        while True:
+            chunk = file_handle.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            checksum.update(chunk)
+
+    return checksum
+
+
+class BundleChecksum(object):
+    """ MD5 and multipart ETag of a bundle, calculated in one pass
+
+    The data is fed with update(). Besides the MD5 of all data, the MD5 of
+    every part_size bytes is kept, so that the ETag S3 assigns to a
+    multipart upload with that part size can be compared too.
+    """
+
+    def __init__(self, part_size):
+        """ Constructor
+
+        :type part_size: int
+        :param part_size: Multipart upload part size in bytes
+        """
+        self.part_size = get_part_size(part_size)
+        self.size = 0
+
+        self._md5 = hashlib.md5()
+        self._part_digests = []
+        self._part = hashlib.md5()
+        self._part_remaining = self.part_size
+
+    @property
+    def md5(self):
+        """ MD5 hex digest of all data """
+        return self._md5.hexdigest()
+
+    @property
+    def part_digests(self):
+        """ Binary MD5 digests of all parts, including the last one """
+        if self._part_remaining < self.part_size or not self._part_digests:
+            return self._part_digests + [self._part.digest()]
+        return list(self._part_digests)
+
+    def matches_etag(self, etag):
+        """ Check if an S3 ETag matches the data
+
+        Both plain MD5 ETags and multipart ETags are supported. Multipart
+        ETags only match if the object was uploaded with the same part size.
+
+        :type etag: str
+        :param etag: ETag, with or without quotes
+        :returns: bool -- True if the ETag matches
+        """
+        etag = etag.replace('"', '')
+
+        if '-' not in etag:
+            return etag == self.md5
+
+        if get_part_size(self.part_size, self.size) != self.part_size:
+            LOGGER.debug('Can not compare multipart ETag {}'.format(etag))
+            return False
+
+        return etag == get_multipart_etag(self.part_digests)
+
+    def update(self, data):
+        """ Add data to the checksum
+
+        :type data: str
+        :param data: Data
+        """
+        self._md5.update(data)
+        self.size += len(data)
+
+        offset = 0
+        while len(data) - offset >= self._part_remaining:
+            end = offset + self._part_remaining
+            self._part.update(buffer(data, offset, end - offset))
+            self._part_digests.append(self._part.digest())
+            self._part = hashlib.md5()
+            self._part_remaining = self.part_size
+            offset = end
+
+        if offset < len(data):
+            self._part.update(buffer(data, offset))
+            self._part_remaining -= len(data) - offset
+
+
+class ChecksumWriter(object):
+    """ Write only file object updating a checksum with all written data """
+
+    def __init__(self, file_handle, checksum):
+        """ Constructor
+
+        :type file_handle: file
+        :param file_handle: File object to write to
+        :type checksum: BundleChecksum
+        :param checksum: Checksum to update
+        """
+        self.file_handle = file_handle
+        self.checksum = checksum
+
+    def flush(self):
+        """ Flush the file object """
+        self.file_handle.flush()
+
+    def tell(self):
+        """ Returns the position in the file object
+
+        :returns: int
+        """
+        return self.file_handle.tell()
+
+    def write(self, data):
+        """ Write data and update the checksum
+
+        :type data: str
+        :param data: Data to write
+        """
+        self.checksum.update(data)
+        self.file_handle.write(data)
@@ -0,0 +1,794 @@
+""" Compression of bundle entries into zip and tar archives """
+import calendar
+import collections
+import gzip
+import hashlib
+import io
+import math
+import os
+import posixpath
+import struct
+from stat import S_IFLNK, S_IFREG, S_IXGRP, S_IXOTH, S_IXUSR
+import sys
+import tarfile
+import tempfile
+import time
+import zipfile
+import zlib
+from multiprocessing.pool import ThreadPool
+
+if sys.platform in ['win32', 'cygwin']:
+    import ntpath as ospath
+else:
+    import os.path as ospath
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from cumulus_ds.exceptions import UnsupportedCompression
+
+# Read files in chunks of this size
+CHUNK_SIZE = 1024 * 1024
+
+# Keep compressed entries in memory up to this size before spilling to disk
+SPOOL_SIZE = 16 * 1024 * 1024
+
+# Number of pending results per worker in ordered_imap
+QUEUE_DEPTH = 4
+
+# Local file header of a zip entry: signature, versions, flags, compression
+# method, time, date, CRC, sizes, and the lengths of the name and extra
+# field that follow it
+LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+LOCAL_HEADER_SIGNATURE = 'PK\x03\x04'
+
+# Default deflate compression level
+COMPRESSION_LEVEL = 6
+
+# File extensions of already compressed formats, stored without compression
+# by default
+STORE_EXTENSIONS = [
+    '7z', 'bz2', 'ear', 'gif', 'gz', 'jar', 'jpeg', 'jpg', 'mp3', 'mp4',
+    'png', 'tgz', 'war', 'webp', 'woff', 'woff2', 'xz', 'zip', 'zst'
+]
+
+# Number of bytes read from the start of a file to estimate its entropy
+ENTROPY_SAMPLE_SIZE = 64 * 1024
+
+# Files smaller than this are not sampled, as the estimate is unreliable
+ENTROPY_MIN_SIZE = 4096
+
+# Files with a sample entropy above this (in bits per byte) are stored
+ENTROPY_THRESHOLD = 7.5
+
+# Timestamp of all entries in reproducible archives (the earliest zip date)
+REPRODUCIBLE_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+# Supported tar based bundle formats
+TAR_FORMATS = ['tar.gz', 'tar.zst']
+
+
+def compress_file(filename, arcname, reproducible=False, policy=None):
+    """ Compress a file into a raw entry
+
+    The CRC, the SHA1 content hash and the compressed data are generated in
+    one pass over the file. The policy decides if the file is deflated or
+    stored. Files that do not get smaller when deflated are stored.
+
+    :type filename: str
+    :param filename: Path to the file to compress
+    :type arcname: str
+    :param arcname: Name of the file within the archive
+    :type reproducible: bool
+    :param reproducible: Normalize the entry metadata, see get_zipinfo()
+    :type policy: CompressionPolicy or None
+    :param policy: Compression policy, the default policy if None
+    :returns: tuple -- (zipfile.ZipInfo, file object with the raw data,
+        SHA1 hex digest of the uncompressed content)
+    """
+    if policy is None:
+        policy = CompressionPolicy()
+
+    zinfo = get_zipinfo(filename, arcname, reproducible=reproducible)
+    zinfo.compress_type = policy.get_compress_type(filename, zinfo.file_size)
+
+    data, sha1 = _read_entry_data(filename, zinfo, policy.level)
+
+    if (zinfo.compress_type == zipfile.ZIP_DEFLATED and
+            zinfo.compress_size >= zinfo.file_size):
+        data.close()
+        zinfo.compress_type = zipfile.ZIP_STORED
+        data, sha1 = _read_entry_data(filename, zinfo, policy.level)
+
+    return zinfo, data, sha1
+
+
+def compress_stream(source, zinfo, policy=None):
+    """ Compress a seekable file object into a raw entry
+
+    Like compress_file(), for content that is not in a local file.
+
+    :type source: file
+    :param source: Seekable file object positioned at the content
+    :type zinfo: zipfile.ZipInfo
+    :param zinfo: Entry description from get_zipinfo(), with the stat of
+        the content
+    :type policy: CompressionPolicy or None
+    :param policy: Compression policy, the default policy if None
+    :returns: tuple -- (zipfile.ZipInfo, file object with the raw data,
+        SHA1 hex digest of the uncompressed content)
+    """
+    if policy is None:
+        policy = CompressionPolicy()
+
+    start = source.tell()
+    zinfo.compress_type = policy.get_compress_type(
+        zinfo.filename, zinfo.file_size, data=source)
+    data, sha1 = _compress_data(source, zinfo, policy.level)
+
+    if (zinfo.compress_type == zipfile.ZIP_DEFLATED and
+            zinfo.compress_size >= zinfo.file_size):
+        data.close()
+        zinfo.compress_type = zipfile.ZIP_STORED
+        source.seek(start)
+        data, sha1 = _compress_data(source, zinfo, policy.level)
+
+    return zinfo, data, sha1
+
+
+def get_entropy(filename, sample_size=ENTROPY_SAMPLE_SIZE):
+    """ Estimate the entropy of a file from a sample of its first bytes
+
+    :type filename: str
+    :param filename: Path to the file to read
+    :type sample_size: int
+    :param sample_size: Number of bytes to read
+    :returns: float -- Entropy in bits per byte, between 0 and 8
+    """
+    with open(filename, 'rb') as file_handle:
+        return _get_sample_entropy(file_handle.read(sample_size))
+
+
+def get_link_entry(arcname, target_arcname, mtime, reproducible=False):
+    """ Create a raw entry for a symbolic link to another archive entry
+
+    The link target is stored relative to the directory of the link, the
+    way Info-ZIP stores symbolic links.
+
+    :type arcname: str
+    :param arcname: Name of the link within the archive
+    :type target_arcname: str
+    :param target_arcname: Name of the linked entry within the archive
+    :type mtime: float
+    :param mtime: Modification time of the link
+    :type reproducible: bool
+    :param reproducible: Use a fixed timestamp
+    :returns: tuple -- (zipfile.ZipInfo, file object with the raw data,
+        SHA1 hex digest of the link target)
+    """
+    if reproducible:
+        date_time = REPRODUCIBLE_DATE_TIME
+    else:
+        date_time = time.localtime(mtime)[0:6]
+
+    zinfo = zipfile.ZipInfo(_normalize_arcname(arcname), date_time)
+    target = posixpath.relpath(
+        zipfile.ZipInfo(_normalize_arcname(target_arcname)).filename,
+        posixpath.dirname(zinfo.filename) or '.')
+
+    zinfo.create_system = 3
+    zinfo.external_attr = (S_IFLNK | 0777) << 16L
+    zinfo.compress_type = zipfile.ZIP_STORED
+    zinfo.file_size = len(target)
+    zinfo.compress_size = len(target)
+    zinfo.CRC = zlib.crc32(target) & 0xffffffff
+
+    return zinfo, io.BytesIO(target), hashlib.sha1(target).hexdigest()
+
+
+def get_tarinfo(filename, arcname, reproducible=False):
+    """ Create a TarInfo object for a local file
+
+    Symbolic links are followed and the owner is not stored, like for zip
+    archives. In reproducible mode the metadata is normalized as in
+    get_zipinfo().
+
+    :type filename: str
+    :param filename: Path to the local file
+    :type arcname: str
+    :param arcname: Name of the file within the archive
+    :type reproducible: bool
+    :param reproducible: Normalize the entry metadata
+    :returns: tarfile.TarInfo
+    """
+    stat = os.stat(filename)
+
+    tarinfo = tarfile.TarInfo(
+        _normalize_arcname(arcname).replace(os.sep, '/'))
+    tarinfo.type = tarfile.REGTYPE
+    tarinfo.size = stat.st_size
+
+    if reproducible:
+        tarinfo.mode = _get_reproducible_mode(stat)
+        tarinfo.mtime = calendar.timegm(REPRODUCIBLE_DATE_TIME)
+        return tarinfo
+
+    tarinfo.mode = stat.st_mode & 07777
+    tarinfo.mtime = stat.st_mtime
+
+    return tarinfo
+
+
+def get_zipinfo(filename, arcname, reproducible=False, stat=None):
+    """ Create a ZipInfo object for a local file
+
+    The arcname is normalized the same way as zipfile.ZipFile.write does it.
+
+    In reproducible mode the metadata that differs between checkouts and
+    build hosts is normalized: the timestamp is fixed, the permissions are
+    set to 0644 or 0755 depending on if the file is executable, and the
+    entry is marked as created on Unix.
+
+    :type filename: str
+    :param filename: Path to the local file
+    :type arcname: str
+    :param arcname: Name of the file within the archive
+    :type reproducible: bool
+    :param reproducible: Normalize the entry metadata
+    :type stat: posix.stat_result or None
+    :param stat: Metadata to use instead of os.stat(filename), for content
+        that is not in a local file
+    :returns: zipfile.ZipInfo
+    """
+    if stat is None:
+        stat = os.stat(filename)
+    arcname = _normalize_arcname(arcname)
+
+    if not reproducible:
+        zinfo = zipfile.ZipInfo(arcname, time.localtime(stat.st_mtime)[0:6])
+        zinfo.external_attr = (stat.st_mode & 0xFFFF) << 16L
+        zinfo.file_size = stat.st_size
+        return zinfo
+
+    zinfo = zipfile.ZipInfo(arcname, REPRODUCIBLE_DATE_TIME)
+    zinfo.create_system = 3
+    zinfo.external_attr = (S_IFREG | _get_reproducible_mode(stat)) << 16L
+    zinfo.file_size = stat.st_size
+
+    return zinfo
+
+
+def hash_file(filename):
+    """ Get the SHA1 hash of a local file, reading it in chunks
+
+    :type filename: str
+    :param filename: Path to the file to read
+    :returns: str -- SHA1 hex digest
+    """
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as file_handle:
+        while True:
+            chunk = file_handle.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            sha1.update(chunk)
+
+    return sha1.hexdigest()
+
+
+def ordered_imap(function, iterable, workers):
+    """ Apply function to all items in a pool of worker threads
+
+    The results are yielded in the same order as the items. At most
+    workers * QUEUE_DEPTH results are pending at any time, which bounds the
+    number of compressed entries waiting to be written.
+
+    zlib and file I/O release the GIL, so compression scales with the
+    number of threads.
+
+    :type function: function
+    :param function: Function taking one item
+    :type iterable: iterable
+    :param iterable: Items to process
+    :type workers: int
+    :param workers: Number of worker threads
+    :returns: generator -- Results of function
+    """
+    if workers <= 1:
+        for item in iterable:
+            yield function(item)
+        return
+
+    pool = ThreadPool(workers)
+    pending = collections.deque()
+    try:
+        for item in iterable:
+            pending.append(pool.apply_async(function, (item,)))
+            if len(pending) >= workers * QUEUE_DEPTH:
+                yield pending.popleft().get()
+
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def open_raw_entry(source, zinfo):
+    """ Position source at the start of the compressed data of an entry
+
+    :type source: file
+    :param source: Open file object of the archive holding the entry
+    :type zinfo: zipfile.ZipInfo
+    :param zinfo: Entry as read from the central directory of source
+    :returns: file -- source, positioned at the raw entry data
+    """
+    source.seek(zinfo.header_offset)
+    header = source.read(LOCAL_HEADER.size)
+    if (len(header) != LOCAL_HEADER.size or
+            header[0:4] != LOCAL_HEADER_SIGNATURE):
+        raise zipfile.BadZipfile(
+            'Bad local file header for {}'.format(zinfo.filename))
+
+    header = LOCAL_HEADER.unpack(header)
+    source.seek(header[-2] + header[-1], os.SEEK_CUR)
+
+    return source
+
+
+def write_raw_entry(archive, zinfo, data):
+    """ Write an already compressed entry to an archive
+
+    :type archive: zipfile.ZipFile
+    :param archive: Archive opened with mode 'w' and allowZip64=True
+    :type zinfo: zipfile.ZipInfo
+    :param zinfo: Entry description with CRC and sizes set
+    :type data: file
+    :param data: File object positioned at the raw entry data.
+        zinfo.compress_size bytes will be read from it
+    """
+    # Archives opened with mode 'w' always write their central directory
+    if archive.mode != 'w' or not archive.fp:
+        raise ValueError(
+            'Raw entries can only be written to archives open with mode "w"')
+
+    if zinfo.compress_type not in [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED]:
+        raise UnsupportedCompression(
+            'Unsupported compression method {} for {}'.format(
+                zinfo.compress_type, zinfo.filename))
+
+    zip64 = (
+        zinfo.file_size > zipfile.ZIP64_LIMIT or
+        zinfo.compress_size > zipfile.ZIP64_LIMIT)
+
+    zinfo.flag_bits = 0x00
+    zinfo.header_offset = archive.fp.tell()
+    archive.fp.write(zinfo.FileHeader(zip64))
+
+    remaining = zinfo.compress_size
+    while remaining > 0:
+        chunk = data.read(min(CHUNK_SIZE, remaining))
+        if not chunk:
+            raise IOError(
+                'Unexpected end of data for {}'.format(zinfo.filename))
+        archive.fp.write(chunk)
+        remaining -= len(chunk)
+
+    archive.filelist.append(zinfo)
+    archive.NameToInfo[zinfo.filename] = zinfo
+
+
+def _compress_data(source, zinfo, level):
+    """ Read a file object into raw entry data, compressed as set in zinfo
+
+    The CRC and the sizes of zinfo are updated.
+
+    :type source: file
+    :param source: File object to read until its end
+    :type zinfo: zipfile.ZipInfo
+    :param zinfo: Entry description with compress_type set
+    :type level: int
+    :param level: Deflate compression level
+    :returns: tuple -- (file object with the raw data, SHA1 hex digest)
+    """
+    compressor = None
+    if zinfo.compress_type == zipfile.ZIP_DEFLATED:
+        compressor = zlib.compressobj(
+            level, zlib.DEFLATED, -15, 8, zlib.Z_DEFAULT_STRATEGY)
+
+    sha1 = hashlib.sha1()
+    data = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    crc = 0
+    file_size = 0
+
+    while True:
+        chunk = source.read(CHUNK_SIZE)
+        if not chunk:
+            break
+
+        file_size += len(chunk)
+        crc = zlib.crc32(chunk, crc) & 0xffffffff
+        sha1.update(chunk)
+        if compressor:
+            chunk = compressor.compress(chunk)
+        data.write(chunk)
+
+    if compressor:
+        data.write(compressor.flush())
+
+    zinfo.file_size = file_size
+    zinfo.compress_size = data.tell()
+    zinfo.CRC = crc
+    data.seek(0)
+
+    return data, sha1.hexdigest()
+
+
+def _format_ratio(file_size, compress_size):
+    """ Format the space saved by compression as a percentage
+
+    :type file_size: int
+    :param file_size: Uncompressed size in bytes
+    :type compress_size: int
+    :param compress_size: Compressed size in bytes
+    :returns: str
+    """
+    if not file_size:
+        return '0.0%'
+    return '{:.1f}%'.format(100.0 * (file_size - compress_size) / file_size)
+
+
+def _format_size(size):
+    """ Format a size in bytes in MB
+
+    :type size: int
+    :param size: Size in bytes
+    :returns: str
+    """
+    return '{:.1f} MB'.format(size / 1024.0 / 1024.0)
+
+
+def _get_reproducible_mode(stat):
+    """ Returns the normalized permissions of a file
+
+    :type stat: posix.stat_result
+    :param stat: os.stat() result for the file
+    :returns: int -- 0755 for executable files, otherwise 0644
+    """
+    if stat.st_mode & (S_IXUSR | S_IXGRP | S_IXOTH):
+        return 0755
+    return 0644
+
+
+def _get_sample_entropy(sample):
+    """ Returns the entropy of a sample of bytes
+
+    :type sample: str
+    :param sample: Sample data
+    :returns: float -- Entropy in bits per byte, between 0 and 8
+    """
+    if not sample:
+        return 0.0
+
+    entropy = 0.0
+    for count in collections.Counter(sample).itervalues():
+        probability = float(count) / len(sample)
+        entropy -= probability * math.log(probability, 2)
+
+    return entropy
+
+
+def _normalize_arcname(arcname):
+    """ Normalize an archive name like zipfile.ZipFile.write does it
+
+    :type arcname: str
+    :param arcname: Name of the file within the archive
+    :returns: str -- Relative, normalized name
+    """
+    arcname = ospath.normpath(ospath.splitdrive(arcname)[1])
+    while arcname[0] in (os.sep, os.altsep):
+        arcname = arcname[1:]
+
+    return arcname
+
+
+def _read_entry_data(filename, zinfo, level):
+    """ Read a file into raw entry data, compressed as set in zinfo
+
+    The CRC and the sizes of zinfo are updated.
+
+    :type filename: str
+    :param filename: Path to the file to read
+    :type zinfo: zipfile.ZipInfo
+    :param zinfo: Entry description with compress_type set
+    :type level: int
+    :param level: Deflate compression level
+    :returns: tuple -- (file object with the raw data, SHA1 hex digest)
+    """
+    with open(filename, 'rb') as file_handle:
+        return _compress_data(file_handle, zinfo, level)
+
+
+class CompressionPolicy(object):
+    """ Decides which files of a bundle are deflated and which are stored
+
+    Deflating files in already compressed formats costs CPU time without
+    making them any smaller, so those are stored as they are.
+    """
+
+    def __init__(
+            self,
+            level=COMPRESSION_LEVEL,
+            store_extensions=None,
+            min_size=0,
+            entropy_sampling=False):
+        """ Constructor
+
+        :type level: int
+        :param level: Deflate compression level, 0 stores all files
+        :type store_extensions: list or None
+        :param store_extensions: File extensions to store, without the
+            leading dot. STORE_EXTENSIONS is used if None
+        :type min_size: int
+        :param min_size: Files smaller than this many bytes are stored
+        :type entropy_sampling: bool
+        :param entropy_sampling: Store files whose first bytes look random
+        """
+        if store_extensions is None:
+            store_extensions = STORE_EXTENSIONS
+
+        self.level = level
+        self.store_extensions = frozenset(
+            [extension.lower().lstrip('.') for extension in store_extensions])
+        self.min_size = min_size
+        self.entropy_sampling = entropy_sampling
+
+    def get_compress_type(self, filename, size, data=None):
+        """ Returns the compression method for a file
+
+        :type filename: str
+        :param filename: Path to the file
+        :type size: int
+        :param size: Size of the file in bytes
+        :type data: file or None
+        :param data: Seekable file object with the content, sampled
+            instead of filename if given
+        :returns: int -- zipfile.ZIP_DEFLATED or zipfile.ZIP_STORED
+        """
+        if self.level == 0 or size < self.min_size:
+            return zipfile.ZIP_STORED
+
+        extension = ospath.splitext(filename)[1].lower().lstrip('.')
+        if extension in self.store_extensions:
+            return zipfile.ZIP_STORED
+
+        if self.entropy_sampling and size >= ENTROPY_MIN_SIZE:
+            if data is None:
+                entropy = get_entropy(filename)
+            else:
+                start = data.tell()
+                entropy = _get_sample_entropy(data.read(ENTROPY_SAMPLE_SIZE))
+                data.seek(start)
+
+            if entropy > ENTROPY_THRESHOLD:
+                return zipfile.ZIP_STORED
+
+        return zipfile.ZIP_DEFLATED
+
+    def get_signature(self):
+        """ Returns a description of the policy
+
+        Archives built with different policies hold differently compressed
+        entries, so entries are only reused if the signatures match.
+
+        :returns: dict
+        """
+        return {
+            'level': self.level,
+            'store-extensions': sorted(self.store_extensions),
+            'min-size': self.min_size,
+            'entropy-sampling': self.entropy_sampling
+        }
+
+
+class CompressionStats(object):
+    """ Collects the sizes of all entries written to an archive """
+
+    def __init__(self):
+        """ Constructor """
+        self.files = collections.defaultdict(int)
+        self.file_size = collections.defaultdict(int)
+        self.compress_size = collections.defaultdict(int)
+
+    def add(self, zinfo):
+        """ Add an entry
+
+        :type zinfo: zipfile.ZipInfo
+        :param zinfo: Entry written to the archive
+        """
+        self.files[zinfo.compress_type] += 1
+        self.file_size[zinfo.compress_type] += zinfo.file_size
+        self.compress_size[zinfo.compress_type] += zinfo.compress_size
+
+    def get_files(self):
+        """ Returns the number of entries
+
+        :returns: int
+        """
+        return sum(self.files.values())
+
+    def get_report(self):
+        """ Returns a summary of the space saved by compression
+
+        :returns: list -- Lines of text
+        """
+        deflated = zipfile.ZIP_DEFLATED
+        stored = zipfile.ZIP_STORED
+        file_size = sum(self.file_size.values())
+        compress_size = sum(self.compress_size.values())
+
+        return [
+            'Deflated {:d} files: {} -> {} ({} saved)'.format(
+                self.files[deflated],
+                _format_size(self.file_size[deflated]),
+                _format_size(self.compress_size[deflated]),
+                _format_ratio(
+                    self.file_size[deflated], self.compress_size[deflated])),
+            'Stored {:d} files without compression: {}'.format(
+                self.files[stored],
+                _format_size(self.file_size[stored])),
+            'Total: {} -> {} ({} saved)'.format(
+                _format_size(file_size),
+                _format_size(compress_size),
+                _format_ratio(file_size, compress_size))
+        ]
+
+
+class TarStream(object):
+    """ Write only, compressed tar archive written as a stream
+
+    The archive is written sequentially, so it can be written straight into
+    an upload stream. The compressed data is written to file_handle.
+    """
+
+    def __init__(
+            self,
+            file_handle,
+            bundle_format,
+            level=COMPRESSION_LEVEL,
+            reproducible=False,
+            workers=1):
+        """ Constructor
+
+        :type file_handle: file
+        :param file_handle: File object to write the archive to
+        :type bundle_format: str
+        :param bundle_format: One of TAR_FORMATS
+        :type level: int
+        :param level: Compression level
+        :type reproducible: bool
+        :param reproducible: Normalize the entry metadata
+        :type workers: int
+        :param workers: Number of zstd compression threads
+        """
+        self.file_handle = file_handle
+        self.reproducible = reproducible
+        self.files = 0
+        self.file_size = 0
+        self.compress_size = 0
+
+        if bundle_format == 'tar.gz':
+            self._compressor = gzip.GzipFile(
+                filename='', mode='wb', compresslevel=level, fileobj=self,
+                mtime=0)
+        elif bundle_format == 'tar.zst':
+            if not zstandard:
+                raise UnsupportedCompression(
+                    'tar.zst bundles require the zstandard module. '
+                    'Install it with "pip install zstandard"')
+            self._compressor = zstandard.ZstdCompressor(
+                level=level,
+                threads=workers if workers > 1 else 0).stream_writer(self)
+        else:
+            raise UnsupportedCompression(
+                'Unknown tar bundle format {}'.format(bundle_format))
+
+        self._archive = tarfile.open(
+            fileobj=self._compressor, mode='w|', format=tarfile.GNU_FORMAT)
+
+    def add(self, filename, arcname):
+        """ Add a local file to the archive
+
+        :type filename: str
+        :param filename: Path to the local file
+        :type arcname: str
+        :param arcname: Name of the file within the archive
+        """
+        tarinfo = get_tarinfo(
+            filename, arcname, reproducible=self.reproducible)
+        with open(filename, 'rb') as file_handle:
+            self._archive.addfile(tarinfo, file_handle)
+        self.files += 1
+        self.file_size += tarinfo.size
+
+    def close(self):
+        """ Write the end of the archive and flush the compressor
+
+        file_handle is not closed.
+        """
+        self._archive.close()
+        if isinstance(self._compressor, gzip.GzipFile):
+            self._compressor.close()
+        else:
+            self._compressor.flush(zstandard.FLUSH_FRAME)
+        self.file_handle.flush()
+
+    def flush(self):
+        """ Flush the file object """
+        self.file_handle.flush()
+
+    def get_files(self):
+        """ Returns the number of entries
+
+        :returns: int
+        """
+        return self.files
+
+    def get_report(self):
+        """ Returns a summary of the space saved by compression
+
+        :returns: list -- Lines of text
+        """
+        return [
+            'Total: {} -> {} ({} saved)'.format(
+                _format_size(self.file_size),
+                _format_size(self.compress_size),
+                _format_ratio(self.file_size, self.compress_size))
+        ]
+
+    def write(self, data):
+        """ Write compressed data to file_handle
+
+        :type data: str
+        :param data: Data to write
+        """
+        self.compress_size += len(data)
+        self.file_handle.write(data)
+
+
+class TeeWriter(object):
+    """ Write only file object copying all data to several file objects
+
+    tell() is answered by the first file object.
+    """
+
+    def __init__(self, *files):
+        """ Constructor
+
+        :type files: file
+        :param files: File objects to write to
+        """
+        self.files = files
+
+    def flush(self):
+        """ Flush all file objects """
+        for file_handle in self.files:
+            file_handle.flush()
+
+    def tell(self):
+        """ Returns the position in the first file object
+
+        :returns: int
+        """
+        return self.files[0].tell()
+
+    def write(self, data):
+        """ Write data to all file objects
+
+        :type data: str
+        :param data: Data to write
+        """
+        for file_handle in self.files:
+            file_handle.write(data)
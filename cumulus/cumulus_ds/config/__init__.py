@@ -1,6 +1,7 @@
 """ Configuration management """
 import logging
 import sys
+import urlparse
 from ConfigParser import SafeConfigParser
 
 if sys.platform in ['win32', 'cygwin']:
@@ -34,6 +35,19 @@ class Configuration:
         if self.args.stacks:
             self.args.stacks = [s.strip() for s in self.args.stacks.split(',')]
 
+        # Split the extra bundle environments
+        if self.args.bundle_environments:
+            self.args.bundle_environments = [
+                e.strip()
+                for e in self.args.bundle_environments.split(',')
+                if e.strip()
+            ]
+
+        # Versions deployed to stacks left out by --stacks would be deleted
+        if self.args.gc_bundles and self.args.stacks:
+            raise ConfigurationException(
+                '--gc-bundles cannot be combined with --stacks')
+
         # Split configuration paths
         if self.args.config:
             self.args.config = [c.strip() for c in self.args.config.split(',')]
@@ -49,6 +63,11 @@ class Configuration:
         elif not self.args.environment:
             raise ConfigurationException('--environment is required')
 
+        if (self.args.promote_from and
+                self.args.promote_from == self.args.environment):
+            raise ConfigurationException(
+                '--promote-from must be another environment')
+
     def _parse_configuration_file(self):
         """ Parse the configuration file """
         try:
@@ -64,6 +83,43 @@ class Configuration:
         """
         return unicode(self.environment)
 
+    def get_bucket_for_region(self, region):
+        """ Returns the bundle bucket to use in a region
+
+        :type region: str
+        :param region: Region name
+        :returns: str -- The replica bucket in the region, the bucket of the
+            environment if there is none
+        """
+        for replica_region, bucket in self.get_replica_buckets():
+            if replica_region == region:
+                return bucket
+
+        return self.get_environment_option('bucket')
+
+    def get_bundle_environments(self):
+        """ Returns the environments to build bundles for
+
+        The first environment is the one given with --environment.
+
+        :returns: list
+        """
+        environments = [self.args.environment]
+        for environment in self.args.bundle_environments or []:
+            if environment not in environments:
+                environments.append(environment)
+
+        return environments
+
+    def set_environment(self, environment):
+        """ Change the current environment
+
+        :type environment: str
+        :param environment: An environment from get_bundle_environments()
+            or --promote-from
+        """
+        self.environment = environment
+
     def get_bundle_path_rewrites(self, bundle):
         """ Returns a dict with all path rewrites
 
@@ -76,6 +132,84 @@ class Configuration:
         except KeyError:
             return []
 
+    def get_bundle_deduplication(self, bundle):
+        """ Returns how duplicate files are detected in a bundle
+
+        :type bundle: str
+        :param bundle: Bundle name
+        :returns: str -- none, inode or content
+        """
+        try:
+            return self.config['bundles'][bundle]['deduplicate']
+        except KeyError:
+            return 'none'
+
+    def get_bundle_excludes(self, bundle):
+        """ Returns the exclude patterns for a bundle
+
+        :type bundle: str
+        :param bundle: Bundle name
+        :returns: list
+        """
+        try:
+            return self.config['bundles'][bundle]['exclude']
+        except KeyError:
+            return []
+
+    def get_bundle_hook_inputs(self, bundle, hook):
+        """ Returns the declared input paths of a bundle hook
+
+        :type bundle: str
+        :param bundle: Bundle name
+        :type hook: str
+        :param hook: pre-bundle-hook or post-bundle-hook
+        :returns: list -- Paths and glob patterns, empty if not declared
+        """
+        try:
+            return self.config['bundles'][bundle]['{}-inputs'.format(hook)]
+        except KeyError:
+            return []
+
+    def get_bundle_hook_outputs(self, bundle, hook):
+        """ Returns the declared output paths of a bundle hook
+
+        :type bundle: str
+        :param bundle: Bundle name
+        :type hook: str
+        :param hook: pre-bundle-hook or post-bundle-hook
+        :returns: list -- Paths
+        """
+        try:
+            return self.config['bundles'][bundle]['{}-outputs'.format(hook)]
+        except KeyError:
+            return []
+
+    def get_bundle_hook_variables(self, bundle, hook):
+        """ Returns the environment variables a bundle hook depends on
+
+        :type bundle: str
+        :param bundle: Bundle name
+        :type hook: str
+        :param hook: pre-bundle-hook or post-bundle-hook
+        :returns: list -- Variable names
+        """
+        try:
+            return self.config['bundles'][bundle]['{}-variables'.format(hook)]
+        except KeyError:
+            return []
+
+    def get_bundle_format(self, bundle):
+        """ Returns the archive format for a bundle
+
+        :type bundle: str
+        :param bundle: Bundle name
+        :returns: str -- zip, tar.gz or tar.zst
+        """
+        try:
+            return self.config['bundles'][bundle]['format']
+        except KeyError:
+            return 'zip'
+
     def get_bundle_paths(self, bundle):
         """ Returns a list of bundle paths for a given bundle
 
@@ -90,6 +224,37 @@ class Configuration:
             raise ConfigurationException(
                 'No paths defined for bundle "{}"'.format(bundle))
 
+    def get_bundle_source(self, bundle):
+        """ Returns the git source of a bundle
+
+        :type bundle: str
+        :param bundle: Bundle name
+        :returns: tuple or None -- (repository path, ref), None if the
+            bundle is built from local files
+        """
+        try:
+            return self.config['bundles'][bundle]['source']
+        except KeyError:
+            return None
+
+    def get_bundle_versions_to_keep(self):
+        """ Returns the number of bundle versions to keep with --gc-bundles
+
+        :returns: int
+        """
+        if self.args.keep < 1:
+            raise ConfigurationException('--keep must be at least 1')
+        return self.args.keep
+
+    def get_bundle_workers(self):
+        """ Returns the number of bundles to build in parallel
+
+        :returns: int
+        """
+        if self.args.bundle_workers < 1:
+            raise ConfigurationException('--bundle-workers must be at least 1')
+        return self.args.bundle_workers
+
     def get_bundles(self):
         """ Returns a list of bundles"""
         try:
@@ -112,6 +277,79 @@ class Configuration:
 
         return bundles
 
+    def get_cache_dir(self):
+        """ Returns the path to the local cache directory
+
+        :returns: str
+        """
+        try:
+            return self.config['general']['cache-dir']
+        except KeyError:
+            return ospath.expanduser(ospath.join('~', '.cumulus'))
+
+    def get_compression_level(self, bundle):
+        """ Returns the deflate compression level for a bundle
+
+        :type bundle: str
+        :param bundle: Bundle name
+        :returns: int
+        """
+        try:
+            return self.config['bundles'][bundle]['compression-level']
+        except KeyError:
+            return 6
+
+    def get_compression_min_size(self, bundle):
+        """ Returns the size below which files are stored uncompressed
+
+        :type bundle: str
+        :param bundle: Bundle name
+        :returns: int -- Size in bytes
+        """
+        try:
+            return self.config['bundles'][bundle]['compress-min-size']
+        except KeyError:
+            return 0
+
+    def get_compression_store_extensions(self, bundle):
+        """ Returns the file extensions to store without compression
+
+        :type bundle: str
+        :param bundle: Bundle name
+        :returns: list or None -- None if the default list should be used
+        """
+        try:
+            return self.config['bundles'][bundle]['store-extensions']
+        except KeyError:
+            return None
+
+    def get_compression_workers(self):
+        """ Returns the number of threads compressing bundle files
+
+        :returns: int
+        """
+        if self.args.compression_workers < 1:
+            raise ConfigurationException(
+                '--compression-workers must be at least 1')
+        return self.args.compression_workers
+
+    def get_connection_pool_size(self):
+        """ Returns the number of idle connections to keep per host
+
+        :returns: int
+        """
+        try:
+            return self.config['general']['connection-pool-size']
+        except KeyError:
+            return 16
+
+    def get_delta_from_version(self):
+        """ Returns the version to build delta bundles from
+
+        :returns: str or None
+        """
+        return self.args.delta_from
+
     def get_environment_option(self, option_name):
         """ Returns version number
 
@@ -195,6 +433,40 @@ class Configuration:
         except KeyError:
             return None
 
+    def get_replica_buckets(self):
+        """ Returns the buckets to replicate bundles to
+
+        :returns: list -- (region, bucket) tuples
+        """
+        try:
+            return self.config[
+                'environments'][self.environment]['replica-buckets']
+        except KeyError:
+            return []
+
+    def get_s3_endpoint(self):
+        """ Returns the custom S3 endpoint, if any
+
+        :returns: dict or None -- Dict with host, port and is_secure
+        """
+        try:
+            endpoint = self.config[
+                'environments'][self.environment]['s3-endpoint']
+        except KeyError:
+            return None
+
+        url = urlparse.urlparse(endpoint)
+        if url.scheme not in ['http', 'https'] or not url.hostname:
+            raise ConfigurationException(
+                'Invalid s3-endpoint "{}". Expected e.g. '
+                'http://localhost:4567'.format(endpoint))
+
+        return {
+            'host': url.hostname,
+            'port': url.port,
+            'is_secure': url.scheme == 'https'
+        }
+
     def get_stack_disable_rollback(self, stack):
         """ See if we should disable rollback
 
@@ -272,6 +544,56 @@ class Configuration:
                 'No stacks found for environment {}'.format(self.environment))
             return None
 
+    def get_upload_concurrency(self):
+        """ Returns the number of parts to upload in parallel
+
+        :returns: int
+        """
+        try:
+            return self.config['general']['upload-concurrency']
+        except KeyError:
+            return 4
+
+    def get_upload_ledger_verify_interval(self):
+        """ Returns how often to verify upload ledger entries against S3
+
+        :returns: int -- Interval in seconds, 0 to never verify
+        """
+        try:
+            return self.config['general']['upload-ledger-verify-hours'] * 3600
+        except KeyError:
+            return 0
+
+    def get_upload_part_size(self):
+        """ Returns the multipart upload part size
+
+        :returns: int -- Part size in bytes
+        """
+        try:
+            return self.config['general']['upload-part-size'] * 1024 * 1024
+        except KeyError:
+            return 16 * 1024 * 1024
+
+    def get_upload_rate_limit(self):
+        """ Returns the maximum upload rate
+
+        :returns: int or None -- Bytes per second, None if not limited
+        """
+        try:
+            return self.config['general']['upload-rate-limit'] * 1024
+        except KeyError:
+            return None
+
+    def get_upload_retries(self):
+        """ Returns the number of retries for each uploaded part
+
+        :returns: int
+        """
+        try:
+            return self.config['general']['upload-retries']
+        except KeyError:
+            return 3
+
     def has_pre_built_bundle(self, bundle):
         """ Checks wether or not the bundle has a pre-built-bundle flag
 
@@ -283,5 +605,86 @@ class Configuration:
             return True
         return False
 
+    def is_content_addressed_bundle(self, bundle):
+        """ Checks wether or not the bundle files are stored by content
+
+        :type bundle: str
+        :param bundle: Bundle name
+        :returns: bool -- True if files are uploaded as separate objects
+        """
+        try:
+            return self.config['bundles'][bundle]['content-addressed']
+        except KeyError:
+            return False
+
+    def is_entropy_sampling_bundle(self, bundle):
+        """ Checks wether or not to sample files to detect random content
+
+        :type bundle: str
+        :param bundle: Bundle name
+        :returns: bool -- True if files that look random should be stored
+        """
+        try:
+            return self.config['bundles'][bundle]['entropy-sampling']
+        except KeyError:
+            return False
+
+    def is_incremental_bundle(self, bundle):
+        """ Checks wether or not the bundle should be built incrementally
+
+        :type bundle: str
+        :param bundle: Bundle name
+        :returns: bool -- True if unchanged files should be reused
+        """
+        try:
+            return self.config['bundles'][bundle]['incremental']
+        except KeyError:
+            return False
+
+    def is_reproducible_bundle(self, bundle):
+        """ Checks wether or not the bundle should be reproducible
+
+        :type bundle: str
+        :param bundle: Bundle name
+        :returns: bool -- True if the archive metadata should be normalized
+        """
+        try:
+            return self.config['bundles'][bundle]['reproducible']
+        except KeyError:
+            return False
+
+    def is_stream_upload_bundle(self, bundle):
+        """ Checks wether or not the bundle should be streamed to S3
+
+        :type bundle: str
+        :param bundle: Bundle name
+        :returns: bool -- True if the bundle is uploaded while it is built
+        """
+        try:
+            return self.config['bundles'][bundle]['stream-upload']
+        except KeyError:
+            return False
+
+    def is_upload_concurrency_adaptive(self):
+        """ Checks wether or not to adapt the upload concurrency
+
+        :returns: bool -- True if the number of parts uploaded in parallel
+            should follow the observed throughput
+        """
+        try:
+            return self.config['general']['upload-adaptive-concurrency']
+        except KeyError:
+            return False
+
+    def is_upload_ledger_enabled(self):
+        """ Checks wether or not to keep a local ledger of uploaded objects
+
+        :returns: bool -- True if the ledger should be used
+        """
+        try:
+            return self.config['general']['upload-ledger']
+        except KeyError:
+            return False
+
 
 CONFIG = Configuration()
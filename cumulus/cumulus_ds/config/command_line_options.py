@@ -1,5 +1,6 @@
 """ Command line options for Cumulus DS """
 import argparse
+import multiprocessing
 
 
 # Read arguments from the command line
@@ -32,6 +33,40 @@ GENERAL_AG.add_argument(
     '--cumulus-version',
     action='count',
     help='Print cumulus version number')
+GENERAL_AG.add_argument(
+    '--bundle-workers',
+    type=int,
+    default=1,
+    help=(
+        'Number of bundles to build and upload in parallel. '
+        'Default: 1'))
+GENERAL_AG.add_argument(
+    '--compression-workers',
+    type=int,
+    default=multiprocessing.cpu_count(),
+    help=(
+        'Number of threads compressing files for each bundle. '
+        'Default: number of CPUs'))
+GENERAL_AG.add_argument(
+    '--bundle-environments',
+    metavar='ENVIRONMENTS',
+    help=(
+        'Comma separated list of more environments to build bundles for. '
+        'Files shared with --environment are only compressed once'))
+GENERAL_AG.add_argument(
+    '--delta-from',
+    metavar='VERSION',
+    help=(
+        'Also upload delta bundles with the changes since VERSION, '
+        'for hosts that have VERSION installed'))
+GENERAL_AG.add_argument(
+    '--keep',
+    type=int,
+    default=10,
+    metavar='N',
+    help=(
+        'Number of bundle versions to keep with --gc-bundles, '
+        'besides the deployed versions. Default: 10'))
 GENERAL_AG.add_argument(
     '--force',
     default=False,
@@ -42,6 +77,20 @@ ACTIONS_AG.add_argument(
     '--bundle',
     action='count',
     help='Build and upload bundles to AWS S3')
+ACTIONS_AG.add_argument(
+    '--promote-from',
+    metavar='ENVIRONMENT',
+    help=(
+        'Copy the bundles of ENVIRONMENT within AWS S3 instead of '
+        'building them. Bundles with environment specific files are '
+        'not promoted'))
+ACTIONS_AG.add_argument(
+    '--gc-bundles',
+    action='count',
+    help=(
+        'Delete old bundle versions of the environment from AWS S3. '
+        'Keeps the newest --keep versions and the versions of the '
+        'running stacks. Use --force to skip the safety question.'))
 ACTIONS_AG.add_argument(
     '--deploy',
     action='count',
@@ -25,7 +25,16 @@ CONF = {
 # [(option, required)]
 GENERAL_OPTIONS = [
     ('log-level', False),
-    ('include', False)
+    ('include', False),
+    ('cache-dir', False),
+    ('upload-part-size', False),
+    ('upload-concurrency', False),
+    ('upload-retries', False),
+    ('upload-rate-limit', False),
+    ('upload-adaptive-concurrency', False),
+    ('connection-pool-size', False),
+    ('upload-ledger', False),
+    ('upload-ledger-verify-hours', False)
 ]
 STACK_OPTIONS = [
     ('template', True),
@@ -37,9 +46,27 @@ STACK_OPTIONS = [
 BUNDLE_OPTIONS = [
     ('paths', True),
     ('path-rewrites', False),
+    ('exclude', False),
     ('pre-bundle-hook', False),
     ('post-bundle-hook', False),
-    ('pre-built-bundle', False)
+    ('pre-bundle-hook-inputs', False),
+    ('pre-bundle-hook-outputs', False),
+    ('pre-bundle-hook-variables', False),
+    ('post-bundle-hook-inputs', False),
+    ('post-bundle-hook-outputs', False),
+    ('post-bundle-hook-variables', False),
+    ('pre-built-bundle', False),
+    ('incremental', False),
+    ('stream-upload', False),
+    ('reproducible', False),
+    ('compression-level', False),
+    ('store-extensions', False),
+    ('compress-min-size', False),
+    ('entropy-sampling', False),
+    ('format', False),
+    ('content-addressed', False),
+    ('deduplicate', False),
+    ('source', False)
 ]
 ENV_OPTIONS = [
     ('access-key-id', True),
@@ -52,7 +79,9 @@ ENV_OPTIONS = [
     ('pre-deploy-hook', False),
     ('post-deploy-hook', False),
     ('stack-name-prefix', False),
-    ('stack-name-suffix', False)
+    ('stack-name-suffix', False),
+    ('s3-endpoint', False),
+    ('replica-buckets', False)
 ]
 
 
@@ -139,13 +168,37 @@ def __get_include_files(config_files):
 def _populate_environments(args, config):
     """ Populate the environments config object
 
+    The environments given with --bundle-environments and --promote-from
+    are populated as well.
+
+    :type args: Namespace
+    :param args: Parsed arguments from argparse
+    :type config: ConfigParser.read
+    :param config: Config parser config object
+    """
+    environments = [args.environment]
+    for environment in args.bundle_environments or []:
+        if environment not in environments:
+            environments.append(environment)
+
+    if args.promote_from and args.promote_from not in environments:
+        environments.append(args.promote_from)
+
+    for environment in environments:
+        _populate_environment(args, config, environment)
+
+
+def _populate_environment(args, config, environment):
+    """ Populate the config object for one environment
+
     :type args: Namespace
     :param args: Parsed arguments from argparse
     :type config: ConfigParser.read
     :param config: Config parser config object
+    :type environment: str
+    :param environment: Environment name
     """
-    section = 'environment: {}'.format(args.environment)
-    environment = args.environment
+    section = 'environment: {}'.format(environment)
     if not section in config.sections():
         raise ConfigurationException(
             'No configuration found for environment {}'.format(environment))
@@ -170,7 +223,7 @@ def _populate_environments(args, config):
                         continue
 
                     stacks.append('{}-{}'.format(
-                        args.environment, item))
+                        environment, item))
                 CONF['environments'][environment][option] = stacks
             elif option == 'version':
                 if args.version:
@@ -178,6 +231,21 @@ def _populate_environments(args, config):
                 else:
                     CONF['environments'][environment][option] = config.get(
                         section, option)
+            elif option == 'replica-buckets':
+                replicas = []
+                for line in config.get(section, option).strip().split('\n'):
+                    if not line.strip():
+                        continue
+
+                    try:
+                        region, bucket = line.split()
+                    except ValueError:
+                        raise ConfigurationException(
+                            'Invalid replica-buckets line "{}". '
+                            'Expected: <region> <bucket>'.format(line.strip()))
+
+                    replicas.append((region, bucket))
+                CONF['environments'][environment][option] = replicas
             else:
                 CONF['environments'][environment][option] = \
                     config.get(section, option)
@@ -215,6 +283,35 @@ def _populate_general(args, config):
             elif option == 'include':
                 # The include option is read earlier
                 continue
+            elif option == 'cache-dir':
+                CONF['general'][option] = ospath.expanduser(
+                    config.get(section, option))
+            elif option in [
+                    'upload-part-size',
+                    'upload-concurrency',
+                    'upload-retries',
+                    'upload-rate-limit',
+                    'connection-pool-size',
+                    'upload-ledger-verify-hours']:
+                try:
+                    value = config.getint(section, option)
+                except ValueError:
+                    raise ConfigurationException(
+                        '{} must be an integer'.format(option))
+
+                if value < 0 or (value == 0 and option not in [
+                        'upload-retries', 'upload-ledger-verify-hours']):
+                    raise ConfigurationException(
+                        '{} is out of range'.format(option))
+
+                CONF['general'][option] = value
+            elif option in ['upload-adaptive-concurrency', 'upload-ledger']:
+                try:
+                    CONF['general'][option] = config.getboolean(
+                        section, option)
+                except ValueError:
+                    raise ConfigurationException(
+                        '{} must be a boolean'.format(option))
             else:
                 CONF['general'][option] = config.get(section, option)
         except NoOptionError:
@@ -330,6 +427,48 @@ def _populate_stacks(args, config):
                 raise ConfigurationException('Error parsing --parameters')
 
 
+def _parse_bundle_source(config, section, bundle):
+    """ Parse the source option of a bundle
+
+    The only supported source is a git commit, given as
+    ``git <repository> <ref>``. The bundle paths are then relative to the
+    repository root.
+
+    :type config: ConfigParser.read
+    :param config: Config parser config object
+    :type section: str
+    :param section: Bundle section name
+    :type bundle: str
+    :param bundle: Bundle name
+    :returns: tuple -- (repository path, ref)
+    """
+    parts = config.get(section, 'source').split()
+    if len(parts) != 3 or parts[0] != 'git':
+        raise ConfigurationException(
+            'Unsupported source in bundle {}. Use: git <repository> '
+            '<ref>'.format(bundle))
+
+    unsupported = []
+    if config.has_option(section, 'pre-built-bundle'):
+        unsupported.append('pre-built-bundle')
+    if (config.has_option(section, 'format') and
+            config.get(section, 'format').strip() != 'zip'):
+        unsupported.append('format')
+    if (config.has_option(section, 'content-addressed') and
+            config.getboolean(section, 'content-addressed')):
+        unsupported.append('content-addressed')
+    if (config.has_option(section, 'deduplicate') and
+            config.get(section, 'deduplicate').strip() != 'none'):
+        unsupported.append('deduplicate')
+
+    if unsupported:
+        raise ConfigurationException(
+            'Bundle {} with a git source does not support {}'.format(
+                bundle, ', '.join(unsupported)))
+
+    return ospath.expanduser(parts[1]), parts[2]
+
+
 def _populate_bundles(args, config):
     """ Populate the bundles config object
 
@@ -351,6 +490,33 @@ def _populate_bundles(args, config):
                         for path in lines:
                             paths.append(ospath.expanduser(path.strip()))
                         CONF['bundles'][bundle]['paths'] = paths
+                    elif option == 'exclude':
+                        CONF['bundles'][bundle][option] = [
+                            line.strip()
+                            for line in config.get(
+                                section, option).strip().split('\n')
+                            if line.strip()
+                        ]
+                    elif option in [
+                            'pre-bundle-hook-inputs',
+                            'pre-bundle-hook-outputs',
+                            'post-bundle-hook-inputs',
+                            'post-bundle-hook-outputs']:
+                        CONF['bundles'][bundle][option] = [
+                            ospath.expanduser(line.strip())
+                            for line in config.get(
+                                section, option).strip().split('\n')
+                            if line.strip()
+                        ]
+                    elif option in [
+                            'pre-bundle-hook-variables',
+                            'post-bundle-hook-variables']:
+                        CONF['bundles'][bundle][option] = [
+                            line.strip()
+                            for line in config.get(
+                                section, option).strip().split('\n')
+                            if line.strip()
+                        ]
                     elif option == 'path-rewrites':
                         CONF['bundles'][bundle]['path-rewrites'] = []
                         lines = config.get(section, option).strip().split('\n')
@@ -373,7 +539,59 @@ def _populate_bundles(args, config):
                                 'target': target.strip(),
                                 'destination': destination.strip()
                             })
+                    elif option in [
+                            'compression-level',
+                            'compress-min-size']:
+                        try:
+                            value = config.getint(section, option)
+                        except ValueError:
+                            raise ConfigurationException(
+                                '{} must be an integer in bundle {}'.format(
+                                    option, bundle))
 
+                        if value < 0 or (
+                                option == 'compression-level' and value > 9):
+                            raise ConfigurationException(
+                                '{} is out of range in bundle {}'.format(
+                                    option, bundle))
+
+                        CONF['bundles'][bundle][option] = value
+                    elif option == 'format':
+                        bundle_format = config.get(section, option).strip()
+                        if bundle_format not in ['zip', 'tar.gz', 'tar.zst']:
+                            raise ConfigurationException(
+                                'Unsupported format {} in bundle {}. Use '
+                                'zip, tar.gz or tar.zst'.format(
+                                    bundle_format, bundle))
+
+                        CONF['bundles'][bundle][option] = bundle_format
+                    elif option == 'deduplicate':
+                        mode = config.get(section, option).strip()
+                        if mode not in ['none', 'inode', 'content']:
+                            raise ConfigurationException(
+                                'Unsupported deduplicate mode {} in bundle {}. '
+                                'Use none, inode or content'.format(
+                                    mode, bundle))
+
+                        CONF['bundles'][bundle][option] = mode
+                    elif option == 'source':
+                        CONF['bundles'][bundle][option] = _parse_bundle_source(
+                            config, section, bundle)
+                    elif option == 'store-extensions':
+                        CONF['bundles'][bundle][option] = [
+                            extension.strip().lstrip('.')
+                            for extension in config.get(
+                                section, option).replace('\n', ',').split(',')
+                            if extension.strip()
+                        ]
+                    elif option in [
+                            'incremental',
+                            'stream-upload',
+                            'reproducible',
+                            'entropy-sampling',
+                            'content-addressed']:
+                        CONF['bundles'][bundle][option] = config.getboolean(
+                            section, option)
                     else:
                         CONF['bundles'][bundle][option] = config.get(
                             section, option)
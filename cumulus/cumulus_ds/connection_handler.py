@@ -1,24 +1,102 @@
-""" Connection handler """
+""" Connection handler
+
+Connections are cached for the whole run, keyed by service, region,
+credentials and endpoint. Each thread gets its own connection object, while
+all connections with the same key share one pool of keep-alive HTTP
+connections, so TLS handshakes are reused across bundles and threads.
+Worker processes start with an empty cache, as sockets must not be shared
+with the parent process.
+"""
 import boto
 import logging
+import os
+import threading
 from boto import cloudformation
+from boto import s3
+from boto.connection import ConnectionPool
+from boto.s3.connection import OrdinaryCallingFormat
 
 from cumulus_ds.config import CONFIG as config
 
 logger = logging.getLogger(__name__)
 
+# Shared HTTP connection pools, keyed by connection key, and the
+# connections of each thread. Reset in forked processes
+_REGISTRY = {
+    'pid': os.getpid(),
+    'pools': {},
+    'local': threading.local()
+}
+_REGISTRY_LOCK = threading.Lock()
+
+
+class _BoundedConnectionPool(ConnectionPool):
+    """ boto connection pool keeping a limited number of idle connections
+
+    boto returns HTTP connections to the pool before their response is read,
+    so connections that do not fit are dropped rather than closed. They are
+    closed once their response is garbage collected.
+    """
+
+    def __init__(self, size):
+        """ Constructor
+
+        :type size: int
+        :param size: Maximum number of connections to keep per host
+        """
+        ConnectionPool.__init__(self)
+        self.max_size = size
+
+    def put_http_connection(self, host, is_secure, conn):
+        """ Return a connection to the pool, unless the pool is full """
+        with self.mutex:
+            pool = self.host_to_pool.get((host, is_secure))
+            if pool and pool.size() >= self.max_size:
+                return
 
-def connect_s3():
+        ConnectionPool.put_http_connection(self, host, is_secure, conn)
+
+
+def connect_s3(region=None):
     """ Connect to AWS S3
 
+    If s3-endpoint is set for the environment, connect to that endpoint
+    instead, e.g. a local S3 stand-in for testing.
+
+    :type region: str or None
+    :param region: Region to connect to, None for the global endpoint
     :returns: boto.s3.connection
     """
-    try:
+    kwargs = {}
+    endpoint = config.get_s3_endpoint()
+    if endpoint:
+        region = None
+        kwargs = {
+            'host': endpoint['host'],
+            'port': endpoint['port'],
+            'is_secure': endpoint['is_secure'],
+            'calling_format': OrdinaryCallingFormat()
+        }
+
+    def connect(access_key_id, secret_access_key):
+        """ Create a new S3 connection """
+        if region:
+            return s3.connect_to_region(
+                region,
+                aws_access_key_id=access_key_id,
+                aws_secret_access_key=secret_access_key)
+
         return boto.connect_s3(
-            aws_access_key_id=config.get_environment_option(
-                'access-key-id'),
-            aws_secret_access_key=config.get_environment_option(
-                'secret-access-key'))
+            aws_access_key_id=access_key_id,
+            aws_secret_access_key=secret_access_key,
+            **kwargs)
+
+    try:
+        return _get_connection(
+            's3',
+            region,
+            endpoint and tuple(sorted(endpoint.items())),
+            connect)
     except Exception as err:
         logger.error('A problem occurred connecting to AWS S3: {}'.format(err))
         raise
@@ -29,15 +107,66 @@ def connect_cloudformation():
 
     :returns: boto.cloudformation.connection
     """
-    try:
+    region = config.get_environment_option('region')
+
+    def connect(access_key_id, secret_access_key):
+        """ Create a new CloudFormation connection """
         return cloudformation.connect_to_region(
-            config.get_environment_option('region'),
-            aws_access_key_id=config.get_environment_option(
-                'access-key-id'),
-            aws_secret_access_key=config.get_environment_option(
-                'secret-access-key'))
+            region,
+            aws_access_key_id=access_key_id,
+            aws_secret_access_key=secret_access_key)
+
+    try:
+        return _get_connection('cloudformation', region, None, connect)
     except Exception as err:
         logger.error(
             'A problem occurred connecting to AWS CloudFormation: {}'.format(
                 err))
         raise
+
+
+def _get_connection(service, region, endpoint, connect):
+    """ Returns the cached connection of this thread, creating it if needed
+
+    :type service: str
+    :param service: AWS service name
+    :type region: str or None
+    :param region: Region name, None for global endpoints
+    :type endpoint: tuple or None
+    :param endpoint: Custom endpoint settings
+    :type connect: function
+    :param connect: Function creating a new connection from an access key ID
+        and a secret access key
+    :returns: boto.connection.AWSAuthConnection
+    """
+    access_key_id = config.get_environment_option('access-key-id')
+    secret_access_key = config.get_environment_option('secret-access-key')
+    key = (service, region, access_key_id, secret_access_key, endpoint)
+
+    with _REGISTRY_LOCK:
+        if _REGISTRY['pid'] != os.getpid():
+            _REGISTRY['pid'] = os.getpid()
+            _REGISTRY['pools'] = {}
+            _REGISTRY['local'] = threading.local()
+        pools = _REGISTRY['pools']
+        local = _REGISTRY['local']
+
+    connections = local.__dict__.setdefault('connections', {})
+    if key in connections:
+        return connections[key]
+
+    connection = connect(access_key_id, secret_access_key)
+    if connection is None:
+        # connect_to_region returns None for unknown regions
+        raise ValueError('Unknown region {}'.format(region))
+
+    with _REGISTRY_LOCK:
+        if key not in pools:
+            pools[key] = _BoundedConnectionPool(
+                config.get_connection_pool_size())
+            logger.debug('Opened {} connection pool for {}'.format(
+                service, region or 'the global endpoint'))
+        connection._pool = pools[key]
+
+    connections[key] = connection
+    return connection
@@ -7,6 +7,7 @@ from cumulus_ds.config import CONFIG as config
 from cumulus_ds.helpers.stack import (
     delete_stack,
     ensure_stack,
+    get_stack_versions,
     list_events_all_stacks,
     list_all_stacks,
     print_output_all_stacks,
@@ -42,6 +43,14 @@ def deploy():
     _post_deploy_hook()
 
 
+def get_deployed_versions():
+    """ Returns the versions the running stacks are deployed with
+
+    :returns: dict -- (stack status, version) tuples keyed by stack name
+    """
+    return get_stack_versions()
+
+
 def list_events():
     """ List events """
     list_events_all_stacks()
@@ -1,3 +1,8 @@
+class BundleBuildException(Exception):
+    """ One or more bundles could not be built """
+    pass
+
+
 class ChecksumMismatchException(Exception):
     """ A checksum check has failed """
     pass
@@ -8,6 +13,11 @@ class ConfigurationException(Exception):
     pass
 
 
+class GarbageCollectionException(Exception):
+    """ Old bundle versions could not be deleted """
+    pass
+
+
 class HookExecutionException(Exception):
     """ Failed to execute a hook """
     pass
@@ -0,0 +1,276 @@
+""" Read bundle files straight from a git repository
+
+Files are listed with git ls-tree and read with git cat-file, so a bundle
+can be built from any commit without a checkout and without walking or
+hashing a working copy. The git blob ID of a file identifies its content.
+"""
+import collections
+import logging
+import os
+import subprocess
+import tempfile
+import threading
+
+from cumulus_ds.exceptions import BundleBuildException
+
+LOGGER = logging.getLogger(__name__)
+
+# Copy blobs in chunks of this size
+CHUNK_SIZE = 1024 * 1024
+
+# Keep blobs in memory up to this size before spilling to disk
+SPOOL_SIZE = 16 * 1024 * 1024
+
+# git tree entry modes
+MODE_FILE = 0100644
+MODE_SYMLINK = 0120000
+
+# A file in a commit. Symbolic links are resolved, so blob is the ID of
+# the content
+GitFile = collections.namedtuple('GitFile', ['path', 'mode', 'blob', 'size'])
+
+
+def make_stat(mode, size, mtime):
+    """ Returns file metadata for content that is not in a local file
+
+    :type mode: int
+    :param mode: File type and permissions
+    :type size: int
+    :param size: Size in bytes
+    :type mtime: int
+    :param mtime: Modification time
+    :returns: posix.stat_result
+    """
+    return os.stat_result((mode, 0, 0, 1, 0, 0, size, mtime, mtime, mtime))
+
+
+class GitRepository(object):
+    """ A commit in a local git repository
+
+    Blobs are read through one git cat-file process per thread, so files
+    can be read from the compression worker threads.
+    """
+
+    def __init__(self, repository, ref):
+        """ Constructor
+
+        :type repository: str
+        :param repository: Path to the repository or a working copy of it
+        :type ref: str
+        :param ref: Branch, tag or commit to read
+        """
+        self.repository = repository
+        self.ref = ref
+        self.commit = self._git(
+            'rev-parse', '--verify', '{}^{{commit}}'.format(ref)).strip()
+        self.commit_time = int(self._git(
+            'show', '-s', '--format=%ct', self.commit).strip())
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._processes = []
+        self._resolver = None
+
+        LOGGER.info('Reading {} at {} ({})'.format(
+            repository, ref, self.commit))
+
+    def close(self):
+        """ Stop all git cat-file processes """
+        with self._lock:
+            processes = self._processes
+            self._processes = []
+
+        for process in processes:
+            process.stdin.close()
+            process.wait()
+
+    def get_stat(self, git_file):
+        """ Returns the file metadata of a file in the commit
+
+        The modification time of all files is the commit time.
+
+        :type git_file: GitFile
+        :param git_file: File in the commit
+        :returns: posix.stat_result
+        """
+        return make_stat(git_file.mode, git_file.size, self.commit_time)
+
+    def list_files(self, path):
+        """ List the files in the commit below a path
+
+        Submodules and symbolic links pointing outside of the repository or
+        to directories are skipped.
+
+        :type path: str
+        :param path: / separated path relative to the repository root, a
+            directory or a file. The whole commit if empty
+        :returns: generator -- GitFile tuples, ordered by path
+        """
+        command = ['ls-tree', '-r', '-z', '-l', '--full-tree', self.commit]
+        if path:
+            command += ['--', path]
+
+        for record in self._git(*command).split('\0'):
+            if not record:
+                continue
+
+            info, name = record.split('\t', 1)
+            mode, object_type, blob, size = info.split()
+            mode = int(mode, 8)
+
+            if object_type != 'blob':
+                LOGGER.warning('Skipping submodule {}'.format(name))
+                continue
+
+            if mode == MODE_SYMLINK:
+                resolved = self._resolve('{}:{}'.format(self.commit, name))
+                if not resolved:
+                    LOGGER.warning(
+                        'Skipping symlink {} not pointing to a file in the '
+                        'repository'.format(name))
+                    continue
+
+                blob, size = resolved
+                mode = MODE_FILE
+
+            yield GitFile(name, mode, blob, int(size))
+
+    def read_blob(self, blob):
+        """ Read the content of a blob
+
+        :type blob: str
+        :param blob: Blob ID
+        :returns: file -- Spooled temporary file with the content,
+            positioned at its start
+        """
+        process = self._get_process()
+        process.stdin.write('{}\n'.format(blob))
+        process.stdin.flush()
+
+        header = process.stdout.readline().split()
+        if len(header) != 3 or header[1] != 'blob':
+            raise BundleBuildException(
+                'Failed to read blob {} from {}: {}'.format(
+                    blob, self.repository, ' '.join(header)))
+
+        data = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        remaining = int(header[2])
+        while remaining > 0:
+            chunk = process.stdout.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                raise BundleBuildException(
+                    'Unexpected end of blob {} from {}'.format(
+                        blob, self.repository))
+            data.write(chunk)
+            remaining -= len(chunk)
+
+        # Each blob is followed by a newline
+        process.stdout.read(1)
+
+        data.seek(0)
+        return data
+
+    def read_file(self, path):
+        """ Read a small file from the commit
+
+        :type path: str
+        :param path: / separated path relative to the repository root
+        :returns: str or None -- Content, None if there is no such file
+        """
+        resolved = self._resolve('{}:{}'.format(self.commit, path))
+        if not resolved:
+            return None
+
+        data = self.read_blob(resolved[0])
+        try:
+            return data.read()
+        finally:
+            data.close()
+
+    def _get_process(self):
+        """ Returns the git cat-file --batch process of this thread
+
+        :returns: subprocess.Popen
+        """
+        process = getattr(self._local, 'process', None)
+        if process is None:
+            process = self._start('cat-file', '--batch')
+            self._local.process = process
+            with self._lock:
+                self._processes.append(process)
+
+        return process
+
+    def _git(self, *args):
+        """ Run a git command in the repository
+
+        :returns: str -- Output of the command
+        """
+        try:
+            process = subprocess.Popen(
+                ['git'] + list(args),
+                cwd=self.repository,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE)
+            output, errors = process.communicate()
+        except OSError as error:
+            raise BundleBuildException(
+                'Failed to run git in {}: {}'.format(self.repository, error))
+
+        if process.returncode != 0:
+            raise BundleBuildException(
+                'git {} failed in {}: {}'.format(
+                    args[0], self.repository, errors.strip()))
+
+        return output
+
+    def _resolve(self, name):
+        """ Find the blob of a path, following symbolic links
+
+        Only called from the thread listing the files.
+
+        :type name: str
+        :param name: <commit>:<path> object name
+        :returns: tuple or None -- (blob ID, size), None if the name does
+            not resolve to a blob in the repository
+        """
+        if self._resolver is None:
+            self._resolver = self._start(
+                'cat-file', '--batch-check', '--follow-symlinks')
+            with self._lock:
+                self._processes.append(self._resolver)
+
+        self._resolver.stdin.write('{}\n'.format(name))
+        self._resolver.stdin.flush()
+
+        line = self._resolver.stdout.readline().rstrip('\n')
+        if line.endswith(' missing') or line.endswith(' ambiguous'):
+            return None
+
+        header = line.split()
+        if len(header) == 3:
+            if header[1] == 'blob':
+                return header[0], header[2]
+            return None
+
+        # symlink, dangling, loop and notdir answers are followed by the
+        # path they concern
+        if len(header) == 2:
+            self._resolver.stdout.read(int(header[1]) + 1)
+
+        return None
+
+    def _start(self, *args):
+        """ Start a long running git process reading from stdin
+
+        :returns: subprocess.Popen
+        """
+        try:
+            return subprocess.Popen(
+                ['git'] + list(args),
+                cwd=self.repository,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE)
+        except OSError as error:
+            raise BundleBuildException(
+                'Failed to run git in {}: {}'.format(self.repository, error))
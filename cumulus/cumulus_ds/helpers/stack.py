@@ -81,7 +81,11 @@ def ensure_stack(
         stack_name, template))
 
     cumulus_parameters = [
-        ('CumulusBundleBucket', config.get_environment_option('bucket')),
+        (
+            'CumulusBundleBucket',
+            config.get_bucket_for_region(
+                config.get_environment_option('region'))
+        ),
         ('CumulusEnvironment', config.get_environment()),
         ('CumulusVersion', config.get_environment_option('version'))
     ]
@@ -186,6 +190,36 @@ def get_stack_by_name(stack_name):
     return None
 
 
+def get_stack_versions():
+    """ Returns the CumulusVersion of the running stacks of the environment
+
+    :returns: dict -- (stack status, version) tuples keyed by stack name.
+        The version is None if the stack has no CumulusVersion parameter
+    """
+    versions = {}
+    for stack_name in config.get_stacks() or []:
+        # Look the stacks up by name, list_stacks returns one page only
+        try:
+            stack = CONNECTION.describe_stacks(stack_name)[0]
+        except boto.exception.BotoServerError as error:
+            if (error.error_code == 'ValidationError' and
+                    'does not exist' in (error.error_message or '')):
+                continue
+            raise
+
+        if stack.stack_status not in RUNNING_STATUSES:
+            continue
+
+        version = None
+        for parameter in stack.parameters:
+            if parameter.key == 'CumulusVersion':
+                version = parameter.value
+
+        versions[stack_name] = (stack.stack_status, version)
+
+    return versions
+
+
 def list_events_all_stacks():
     """ List events for all configured stacks """
     for stack_name in config.get_stacks():
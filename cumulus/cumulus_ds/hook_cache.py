@@ -0,0 +1,273 @@
+""" Skip bundle hooks whose inputs have not changed
+
+A hook with declared inputs is fingerprinted before it runs. The
+fingerprint covers the command, the environment it runs for, the
+declared environment variables and the content of all input files. After a
+successful run the fingerprint and a copy of the declared outputs are
+stored in the cache directory. When the fingerprint is the same the next
+time, the hook is skipped and its outputs are restored from the cache.
+"""
+import glob
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sys
+
+if sys.platform in ['win32', 'cygwin']:
+    import ntpath as ospath
+else:
+    import os.path as ospath
+
+from cumulus_ds import compression
+from cumulus_ds import manifest
+
+LOGGER = logging.getLogger(__name__)
+
+# Version of the stored hook state
+STATE_FORMAT = 1
+
+STATE_NAME = 'state.json'
+OUTPUTS_NAME = 'outputs'
+
+
+class HookCache(object):
+    """ Fingerprint and outputs of the last successful run of a hook """
+
+    def __init__(
+            self, cache_path, command, inputs, outputs, environment,
+            variables):
+        """ Constructor
+
+        :type cache_path: str
+        :param cache_path: Directory to keep the state of this hook in
+        :type command: str
+        :param command: Hook command
+        :type inputs: list
+        :param inputs: Input files and directories, may be glob patterns
+        :type outputs: list
+        :param outputs: Output files and directories
+        :type environment: str
+        :param environment: Environment the hook runs for
+        :type variables: dict
+        :param variables: Values of the environment variables the hook
+            depends on, None for unset variables
+        """
+        self.cache_path = cache_path
+        self.command = command
+        self.inputs = inputs
+        self.outputs = outputs
+
+        values = [command, environment] + [
+            name if value is None else '{}={}'.format(name, value)
+            for name, value in sorted(variables.items())
+        ]
+
+        self._state = _load_state(ospath.join(cache_path, STATE_NAME))
+        self._fingerprint, self._files = get_fingerprint(
+            values, _expand(inputs), self._state.get('files', {}))
+
+    def is_fresh(self):
+        """ Check if the hook can be skipped
+
+        :returns: bool -- True if the inputs and the command are unchanged
+            since the last successful run and its outputs are cached
+        """
+        if self._state.get('fingerprint') != self._fingerprint:
+            return False
+
+        if self._state.get('outputs') != self.outputs:
+            return False
+
+        return True
+
+    def restore_outputs(self):
+        """ Restore the outputs of the last run, unless they are unchanged """
+        if not self.outputs:
+            return
+
+        current, _ = get_fingerprint(
+            [], self.outputs, self._state.get('output-files', {}))
+        if current == self._state.get('output-fingerprint'):
+            LOGGER.debug('Hook outputs are up to date')
+            return
+
+        for index, path in enumerate(self.outputs):
+            _remove(path)
+
+            cached = ospath.join(self.cache_path, OUTPUTS_NAME, str(index))
+            if ospath.isdir(cached):
+                shutil.copytree(cached, path, symlinks=True)
+            elif ospath.exists(cached):
+                _make_parent(path)
+                shutil.copy2(cached, path)
+
+            LOGGER.info('Restored {} from the hook cache'.format(path))
+
+    def save(self):
+        """ Store the fingerprint and the outputs after a successful run
+
+        The fingerprint of the inputs is the one taken before the run.
+        """
+        state_file = ospath.join(self.cache_path, STATE_NAME)
+        outputs_path = ospath.join(self.cache_path, OUTPUTS_NAME)
+
+        # Remove the old state first, so that a failure half way through
+        # never leaves a state pointing at the wrong outputs
+        if ospath.exists(state_file):
+            os.remove(state_file)
+        if ospath.exists(outputs_path):
+            shutil.rmtree(outputs_path)
+        os.makedirs(outputs_path)
+
+        for index, path in enumerate(self.outputs):
+            cached = ospath.join(outputs_path, str(index))
+            if ospath.isdir(path):
+                shutil.copytree(path, cached, symlinks=True)
+            elif ospath.exists(path):
+                shutil.copy2(path, cached)
+            else:
+                LOGGER.warning('Hook output {} does not exist'.format(path))
+
+        output_fingerprint, output_files = get_fingerprint(
+            [], self.outputs, {})
+
+        with open(state_file, 'w') as file_handle:
+            json.dump(
+                {
+                    'format': STATE_FORMAT,
+                    'fingerprint': self._fingerprint,
+                    'files': self._files,
+                    'outputs': self.outputs,
+                    'output-fingerprint': output_fingerprint,
+                    'output-files': output_files
+                },
+                file_handle)
+
+        LOGGER.debug('Stored hook state in {}'.format(state_file))
+
+
+def get_fingerprint(values, paths, previous_files):
+    """ Returns a fingerprint of some values and the files below paths
+
+    Files are only hashed if their size, mode or mtime differ from
+    previous_files.
+
+    :type values: list
+    :param values: Strings to include in the fingerprint
+    :type paths: list
+    :param paths: Files and directories
+    :type previous_files: dict
+    :param previous_files: Files from an earlier call, keyed by path
+    :returns: tuple -- (SHA1 hex digest, dict of files keyed by path)
+    """
+    digest = hashlib.sha1()
+    for value in values:
+        digest.update('value\0{}\0'.format(value))
+
+    files = {}
+    for path in paths:
+        if not ospath.exists(path):
+            digest.update('missing\0{}\0'.format(path))
+            continue
+
+        for filename in _find_files(path):
+            stat = os.stat(filename)
+            entry = previous_files.get(filename)
+            if entry and manifest.is_unchanged(entry, stat):
+                sha1 = entry['sha1']
+            else:
+                sha1 = compression.hash_file(filename)
+
+            files[filename] = {
+                'sha1': sha1,
+                'size': stat.st_size,
+                'mode': stat.st_mode,
+                'mtime': stat.st_mtime
+            }
+            digest.update('file\0{}\0{}\0{:o}\0'.format(
+                filename, sha1, stat.st_mode))
+
+    return digest.hexdigest(), files
+
+
+def _expand(patterns):
+    """ Expand glob patterns, keeping paths without wildcards as they are
+
+    :type patterns: list
+    :param patterns: Paths and glob patterns
+    :returns: list -- Paths
+    """
+    paths = []
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            paths.extend(sorted(glob.glob(pattern)))
+        else:
+            paths.append(pattern)
+
+    return paths
+
+
+def _find_files(path):
+    """ List the files below a path in a stable order
+
+    :type path: str
+    :param path: File or directory
+    :returns: generator -- File names
+    """
+    if not ospath.isdir(path):
+        yield path
+        return
+
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for basename in sorted(files):
+            yield ospath.join(root, basename)
+
+
+def _load_state(state_file):
+    """ Load the stored state of a hook
+
+    :type state_file: str
+    :param state_file: Path to the state file
+    :returns: dict -- State, empty if there is no usable state
+    """
+    if not ospath.exists(state_file):
+        return {}
+
+    try:
+        with open(state_file, 'r') as file_handle:
+            state = json.load(file_handle)
+    except ValueError as error:
+        LOGGER.warning('Ignoring broken hook state {}: {}'.format(
+            state_file, error))
+        return {}
+
+    if state.get('format') != STATE_FORMAT:
+        return {}
+
+    return state
+
+
+def _make_parent(path):
+    """ Create the parent directory of path if it does not exist
+
+    :type path: str
+    :param path: File path
+    """
+    parent = ospath.dirname(path)
+    if parent and not ospath.exists(parent):
+        os.makedirs(parent)
+
+
+def _remove(path):
+    """ Remove a file or directory if it exists
+
+    :type path: str
+    :param path: File or directory
+    """
+    if ospath.isdir(path) and not ospath.islink(path):
+        shutil.rmtree(path)
+    elif ospath.lexists(path):
+        os.remove(path)
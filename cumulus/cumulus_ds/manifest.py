@@ -0,0 +1,191 @@
+""" Bundle manifests used for incremental builds and delta bundles
+
+A manifest describes every file that went into the last archive built for a
+bundle type in an environment. It is stored together with that archive so
+that unchanged files can be copied from it without being compressed again.
+
+A remote manifest lists the content hash of every file in a bundle version.
+It is uploaded next to the bundle, so that delta bundles can be built
+against that version later.
+"""
+import json
+import logging
+import os
+import shutil
+import sys
+
+if sys.platform in ['win32', 'cygwin']:
+    import ntpath as ospath
+else:
+    import os.path as ospath
+
+LOGGER = logging.getLogger(__name__)
+
+# Bump this when the manifest format changes
+MANIFEST_FORMAT = 1
+
+# Bump this when the remote manifest or delta format changes
+REMOTE_MANIFEST_FORMAT = 1
+
+ARCHIVE_NAME = 'bundle.zip'
+MANIFEST_NAME = 'manifest.json'
+
+
+def get_cache_path(cache_dir, environment, bundle_type):
+    """ Returns the directory holding the manifest and archive
+
+    :type cache_dir: str
+    :param cache_dir: Cumulus cache directory
+    :type environment: str
+    :param environment: Environment name
+    :type bundle_type: str
+    :param bundle_type: Bundle name
+    :returns: str -- Path to the directory
+    """
+    return ospath.join(cache_dir, 'bundles', environment, bundle_type)
+
+
+def get_delta(base, target):
+    """ Compare two remote manifests
+
+    :type base: dict
+    :param base: Remote manifest of the installed version
+    :type target: dict
+    :param target: Remote manifest of the new version
+    :returns: tuple -- (sorted list of added or changed archive names,
+        sorted list of deleted archive names)
+    """
+    changed = [
+        arcname
+        for arcname, entry in target['files'].items()
+        if base['files'].get(arcname) != entry
+    ]
+    deleted = [
+        arcname
+        for arcname in base['files'].keys()
+        if arcname not in target['files']
+    ]
+
+    return sorted(changed), sorted(deleted)
+
+
+def get_remote_manifest(bundle_manifest):
+    """ Returns the remote manifest for a build
+
+    :type bundle_manifest: dict
+    :param bundle_manifest: Manifest returned when the bundle was built
+    :returns: dict -- Remote manifest, keyed by archive name
+    """
+    files = {}
+    for entry in bundle_manifest['files'].values():
+        files[entry['arcname']] = {
+            'sha1': entry['sha1'],
+            'mode': entry['mode']
+        }
+
+    return {
+        'format': REMOTE_MANIFEST_FORMAT,
+        'files': files
+    }
+
+
+def is_unchanged(entry, stat):
+    """ Check if a file looks unchanged compared to its manifest entry
+
+    :type entry: dict
+    :param entry: Manifest entry for the file
+    :type stat: posix.stat_result
+    :param stat: Current os.stat() result for the file
+    :returns: bool -- True if size, mode and mtime are the same
+    """
+    return (
+        entry['size'] == stat.st_size and
+        entry['mode'] == stat.st_mode and
+        entry['mtime'] == stat.st_mtime)
+
+
+def load(cache_path):
+    """ Load the manifest for the previous build
+
+    :type cache_path: str
+    :param cache_path: Directory from get_cache_path()
+    :returns: dict or None -- The manifest, or None if there is no usable
+        previous build
+    """
+    manifest_file = ospath.join(cache_path, MANIFEST_NAME)
+    archive_file = ospath.join(cache_path, ARCHIVE_NAME)
+
+    if not ospath.exists(manifest_file) or not ospath.exists(archive_file):
+        LOGGER.debug('No previous build found in {}'.format(cache_path))
+        return None
+
+    try:
+        with open(manifest_file, 'r') as file_handle:
+            manifest = json.load(file_handle)
+    except ValueError as error:
+        LOGGER.warning('Ignoring broken manifest {}: {}'.format(
+            manifest_file, error))
+        return None
+
+    if manifest.get('format') != MANIFEST_FORMAT:
+        LOGGER.debug('Ignoring manifest {} with old format'.format(
+            manifest_file))
+        return None
+
+    if manifest.get('archive-size') != os.path.getsize(archive_file):
+        LOGGER.warning(
+            'Archive {} does not match its manifest, '
+            'doing a full build'.format(archive_file))
+        return None
+
+    manifest['archive'] = archive_file
+    return manifest
+
+
+def new():
+    """ Returns an empty manifest
+
+    :returns: dict
+    """
+    return {
+        'format': MANIFEST_FORMAT,
+        'files': {}
+    }
+
+
+def save(cache_path, manifest, archive_file):
+    """ Store a manifest and its archive as the latest build
+
+    The archive is moved into the cache directory.
+
+    :type cache_path: str
+    :param cache_path: Directory from get_cache_path()
+    :type manifest: dict
+    :param manifest: Manifest describing archive_file
+    :type archive_file: str
+    :param archive_file: Path to the archive that was built
+    :returns: str -- New path to the archive
+    """
+    if not ospath.exists(cache_path):
+        os.makedirs(cache_path)
+
+    manifest_file = ospath.join(cache_path, MANIFEST_NAME)
+    target = ospath.join(cache_path, ARCHIVE_NAME)
+
+    # Remove the old manifest first, so that a failure half way through
+    # never leaves a manifest pointing at the wrong archive
+    if ospath.exists(manifest_file):
+        os.remove(manifest_file)
+
+    shutil.move(archive_file, target)
+
+    manifest = dict(manifest)
+    manifest.pop('archive', None)
+    manifest['archive-size'] = os.path.getsize(target)
+
+    with open(manifest_file, 'w') as file_handle:
+        json.dump(manifest, file_handle)
+
+    LOGGER.debug('Stored bundle manifest in {}'.format(manifest_file))
+
+    return target
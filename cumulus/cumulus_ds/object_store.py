@@ -0,0 +1,228 @@
+""" Content addressed storage of bundle files in AWS S3
+
+Every file is stored once in the bucket, under a key derived from the SHA1
+of its content. A bundle version is a small manifest mapping the archive
+names to those keys, so files shared between versions and environments are
+only uploaded once.
+"""
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+
+from boto.utils import compute_md5
+
+from cumulus_ds import checksum
+from cumulus_ds import compression
+from cumulus_ds import connection_handler
+from cumulus_ds import throughput
+from cumulus_ds import uploader
+from cumulus_ds.exceptions import ChecksumMismatchException
+
+LOGGER = logging.getLogger(__name__)
+
+# Bump this when the object manifest format changes
+OBJECTS_FORMAT = 1
+
+# Prefix of all object keys in the bucket
+OBJECT_PREFIX = 'objects/'
+
+# Suffix of objects stored as raw deflate streams
+DEFLATE_SUFFIX = '.deflate'
+
+
+def get_object_key_name(sha1, deflated):
+    """ Returns the key name of an object
+
+    :type sha1: str
+    :param sha1: SHA1 hex digest of the file content
+    :type deflated: bool
+    :param deflated: True if the object is stored as a raw deflate stream
+    :returns: str -- Key name
+    """
+    key_name = '{}{}/{}'.format(OBJECT_PREFIX, sha1[:2], sha1)
+    if deflated:
+        key_name += DEFLATE_SUFFIX
+
+    return key_name
+
+
+def list_objects(bucket):
+    """ Returns the key names of all objects in the bucket
+
+    :type bucket: boto.s3.bucket.Bucket
+    :param bucket: Bucket holding the objects
+    :returns: set -- Key names
+    """
+    return set([key.name for key in bucket.list(prefix=OBJECT_PREFIX)])
+
+
+class ObjectStore(object):
+    """ Uploads files as objects from several threads
+
+    Each thread uses its own S3 connection. Files whose content is already
+    in the bucket are not uploaded again.
+    """
+
+    def __init__(
+            self, bucket_name, existing, part_size, retries, journal_dir,
+            rate_limiter=None, progress=None):
+        """ Constructor
+
+        :type bucket_name: str
+        :param bucket_name: Bucket name
+        :type existing: set
+        :param existing: Key names of the objects in the bucket, from
+            list_objects(). Uploaded objects are added to it
+        :type part_size: int
+        :param part_size: Objects larger than this are uploaded in parts
+        :type retries: int
+        :param retries: Number of retries for each upload
+        :type journal_dir: str
+        :param journal_dir: Directory holding upload journals
+        :type rate_limiter: cumulus_ds.throughput.RateLimiter or None
+        :param rate_limiter: Rate limit for the uploads
+        :type progress: cumulus_ds.throughput.ProgressReporter or None
+        :param progress: Reporter to count the uploaded bytes in
+        """
+        self.bucket_name = bucket_name
+        self.existing = existing
+        self.part_size = part_size
+        self.retries = retries
+        self.journal_dir = journal_dir
+        self.rate_limiter = rate_limiter
+        self.progress = progress
+        self._local = threading.local()
+
+    def store(self, filename, arcname, policy, reproducible=False):
+        """ Upload a file, unless its content is already stored
+
+        The file is compressed according to policy before it is uploaded.
+
+        :type filename: str
+        :param filename: Path to the local file
+        :type arcname: str
+        :param arcname: Name of the file within the bundle
+        :type policy: cumulus_ds.compression.CompressionPolicy
+        :param policy: Decides if the file is deflated
+        :type reproducible: bool
+        :param reproducible: Normalize the file mode
+        :returns: tuple -- (manifest entry, number of uploaded bytes)
+        """
+        zinfo = compression.get_zipinfo(
+            filename, arcname, reproducible=reproducible)
+        sha1 = compression.hash_file(filename)
+
+        entry = {
+            'arcname': zinfo.filename,
+            'sha1': sha1,
+            'size': zinfo.file_size,
+            'mode': zinfo.external_attr >> 16
+        }
+
+        for deflated in [True, False]:
+            key_name = get_object_key_name(sha1, deflated)
+            if key_name in self.existing:
+                LOGGER.debug('Object for {} already stored'.format(arcname))
+                entry['key'] = key_name
+                return entry, 0
+
+        zinfo, data, data_sha1 = compression.compress_file(
+            filename, arcname, policy=policy)
+        try:
+            if data_sha1 != sha1:
+                raise ChecksumMismatchException(
+                    '{} changed while bundling'.format(filename))
+
+            entry['key'] = get_object_key_name(
+                sha1, zinfo.compress_type == zipfile.ZIP_DEFLATED)
+            self._upload(entry['key'], data, zinfo.compress_size)
+        finally:
+            data.close()
+
+        self.existing.add(entry['key'])
+        return entry, zinfo.compress_size
+
+    def _get_bucket(self):
+        """ Returns the bucket with a connection for this thread
+
+        :returns: boto.s3.bucket.Bucket
+        """
+        if not hasattr(self._local, 'bucket'):
+            self._local.bucket = connection_handler.connect_s3().get_bucket(
+                self.bucket_name, validate=False)
+
+        return self._local.bucket
+
+    def _upload(self, key_name, data, size):
+        """ Upload object data, retrying on failure
+
+        :type key_name: str
+        :param key_name: Key name of the object
+        :type data: file
+        :param data: File object with the object data
+        :type size: int
+        :param size: Size of the data in bytes
+        """
+        if size > self.part_size:
+            self._upload_multipart(key_name, data)
+            return
+
+        data.seek(0)
+        md5 = compute_md5(data)[0:2]
+
+        attempt = 0
+        while True:
+            try:
+                LOGGER.debug('Uploading {} ({:d} bytes)'.format(
+                    key_name, size))
+                data.seek(0)
+                self._get_bucket().new_key(key_name).set_contents_from_file(
+                    throughput.ThrottledFile(
+                        data, self.rate_limiter, self.progress),
+                    replace=True,
+                    md5=md5)
+                return
+            except Exception as error:
+                if attempt >= self.retries:
+                    raise
+
+                attempt += 1
+                delay = min(2 ** attempt, uploader.MAX_RETRY_DELAY)
+                LOGGER.warning(
+                    'Upload of {} failed ({}). '
+                    'Retrying in {:d} seconds'.format(key_name, error, delay))
+
+                # Keep the bucket, boto replaces failed HTTP connections
+                # itself
+                time.sleep(delay)
+
+    def _upload_multipart(self, key_name, data):
+        """ Upload large object data as a multipart upload
+
+        :type key_name: str
+        :param key_name: Key name of the object
+        :type data: file
+        :param data: File object with the object data
+        """
+        tmpfile = tempfile.NamedTemporaryFile(delete=False)
+        try:
+            data.seek(0)
+            shutil.copyfileobj(data, tmpfile)
+            tmpfile.close()
+
+            uploader.upload_file(
+                self._get_bucket(),
+                key_name,
+                tmpfile.name,
+                checksum.hash_file(tmpfile.name, self.part_size),
+                concurrency=1,
+                retries=self.retries,
+                journal_dir=self.journal_dir,
+                rate_limiter=self.rate_limiter)
+        finally:
+            tmpfile.close()
+            os.remove(tmpfile.name)
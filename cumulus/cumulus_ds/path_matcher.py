@@ -0,0 +1,251 @@
+""" Path rewrites, environment exclusion and ignore rules for bundle files
+
+The rules of a bundle are compiled once into a PathMatcher and IgnoreRules,
+so that the cost of matching a file does not grow with the number of rules.
+"""
+import fnmatch
+import re
+import sys
+
+if sys.platform in ['win32', 'cygwin']:
+    import ntpath as ospath
+else:
+    import os.path as ospath
+
+# Prefix of file and directory names targeting specific environments
+ENVIRONMENT_PREFIX = '__cumulus-'
+
+# Name of the file holding exclude patterns in a bundle path
+IGNORE_FILE = '.cumulusignore'
+
+
+def read_ignore_file(filename):
+    """ Returns the exclude patterns in an ignore file
+
+    Empty lines and lines starting with # are skipped.
+
+    :type filename: str
+    :param filename: Path to the ignore file
+    :returns: list -- Patterns, empty if the file does not exist
+    """
+    if not ospath.isfile(filename):
+        return []
+
+    with open(filename) as file_handle:
+        return parse_ignore_patterns(file_handle)
+
+
+def parse_ignore_patterns(lines):
+    """ Returns the exclude patterns in the lines of an ignore file
+
+    Empty lines and lines starting with # are skipped.
+
+    :type lines: iterable
+    :param lines: Lines of the ignore file
+    :returns: list -- Patterns
+    """
+    patterns = []
+    for line in lines:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            patterns.append(line)
+
+    return patterns
+
+
+class IgnoreRules(object):
+    """ Compiled exclude patterns
+
+    The patterns are shell style wildcards. A pattern ending with / only
+    matches directories. A pattern containing a / is matched against the
+    path relative to the bundle path, other patterns are matched against
+    the file or directory name.
+    """
+
+    def __init__(self, patterns):
+        """ Constructor
+
+        :type patterns: list
+        :param patterns: Exclude patterns
+        """
+        names = {False: [], True: []}
+        paths = {False: [], True: []}
+
+        for pattern in patterns:
+            directories_only = pattern.endswith('/')
+            pattern = pattern.strip('/')
+            if not pattern:
+                continue
+
+            if '/' in pattern:
+                paths[directories_only].append(fnmatch.translate(pattern))
+            else:
+                names[directories_only].append(fnmatch.translate(pattern))
+
+        # Directories are matched by all patterns, files only by the
+        # patterns not ending with /
+        self._names = {
+            False: _compile(names[False]),
+            True: _compile(names[False] + names[True])
+        }
+        self._paths = {
+            False: _compile(paths[False]),
+            True: _compile(paths[False] + paths[True])
+        }
+
+    def is_ignored(self, relpath, is_dir):
+        """ Check if a file or directory is excluded
+
+        :type relpath: str
+        :param relpath: Path relative to the bundle path, / separated
+        :type is_dir: bool
+        :param is_dir: True for directories
+        :returns: bool -- True if excluded
+        """
+        names = self._names[is_dir]
+        if names and names.match(relpath.rsplit('/', 1)[-1]):
+            return True
+
+        paths = self._paths[is_dir]
+        if paths and paths.match(relpath):
+            return True
+
+        return False
+
+
+class PathMatcher(object):
+    """ Compiled path rewrite and environment exclusion rules
+
+    The rewrite targets are stored in a character trie. Finding the
+    rewrites matching a path only walks the trie along the path, so it
+    costs at most the length of the longest target.
+
+    Rewrites are applied in the configured order. A rewrite applies if
+    the path, including the changes of earlier rewrites, starts with its
+    target. All occurrences of the target are then replaced.
+    """
+
+    def __init__(self, environment, rewrites):
+        """ Constructor
+
+        :type environment: str
+        :param environment: Environment name
+        :type rewrites: list
+        :param rewrites: (target, destination) tuples, in local path format
+        """
+        self.prefix = '__cumulus-{}__'.format(environment)
+        self.rewrites = list(rewrites)
+
+        # Each node is a dict mapping characters to child nodes. The None
+        # key holds the indexes of the rewrites ending at the node, in order
+        self._trie = {}
+        for index, (target, _) in enumerate(self.rewrites):
+            node = self._trie
+            for char in target:
+                node = node.setdefault(char, {})
+            node.setdefault(None, []).append(index)
+
+    def is_excluded(self, filename):
+        """ Check if a file targets another environment
+
+        :type filename: str
+        :param filename: Path to the local file
+        :returns: bool -- True if the file should not be bundled
+        """
+        basename = ospath.basename(filename)
+
+        if basename.startswith(ENVIRONMENT_PREFIX):
+            return len(basename.split(self.prefix)) != 2
+
+        return self.prefix in filename.split(ospath.sep)
+
+    def is_excluded_dir(self, basename):
+        """ Check if a directory targets another environment
+
+        Directories named __cumulus-<environment>__<name> are only bundled
+        for that environment.
+
+        :type basename: str
+        :param basename: Directory name
+        :returns: bool -- True if the directory should not be walked
+        """
+        if basename.startswith(ENVIRONMENT_PREFIX):
+            return len(basename.split(self.prefix)) != 2
+
+        return False
+
+    def rewrite(self, filename):
+        """ Apply the path rewrites to a file name
+
+        :type filename: str
+        :param filename: Path to the local file
+        :returns: str -- Name of the file within the bundle
+        """
+        if not self.rewrites:
+            return filename
+
+        arcname = filename
+        index = self._find_rewrite(arcname, 0)
+
+        while index is not None:
+            target, destination = self.rewrites[index]
+            arcname = arcname.replace(target, destination)
+            index = self._find_rewrite(arcname, index + 1)
+
+        return arcname
+
+    def _find_rewrite(self, path, start):
+        """ Find the first rewrite from start whose target prefixes path
+
+        :type path: str
+        :param path: Path to match
+        :type start: int
+        :param start: Lowest rewrite index to consider
+        :returns: int or None -- Rewrite index
+        """
+        found = _first_index(self._trie, start, None)
+
+        node = self._trie
+        for char in path:
+            node = node.get(char)
+            if node is None:
+                break
+
+            if None in node:
+                found = _first_index(node, start, found)
+
+        return found
+
+
+def _first_index(node, start, found):
+    """ Returns the lowest rewrite index at a trie node from start
+
+    :type node: dict
+    :param node: Trie node
+    :type start: int
+    :param start: Lowest rewrite index to consider
+    :type found: int or None
+    :param found: Lowest index found so far
+    :returns: int or None -- Rewrite index
+    """
+    for index in node.get(None, []):
+        if index >= start:
+            if found is None or index < found:
+                return index
+            break
+
+    return found
+
+
+def _compile(expressions):
+    """ Compile regular expressions into one
+
+    :type expressions: list
+    :param expressions: Regular expressions
+    :returns: re.RegexObject or None if expressions is empty
+    """
+    if not expressions:
+        return None
+
+    return re.compile('|'.join(
+        ['(?:{})'.format(expression) for expression in expressions]))
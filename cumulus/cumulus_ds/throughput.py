@@ -0,0 +1,254 @@
+""" Upload rate limiting, adaptive concurrency and progress reporting
+
+A RateLimiter caps the number of bytes per second sent by all uploads
+sharing it. A ConcurrencyController adjusts the number of parts uploaded in
+parallel to the throughput it observes: it adds a part while that makes
+the upload faster, removes one when throughput drops, and halves the
+concurrency when uploads fail. A ProgressReporter logs the throughput of
+an upload while it runs.
+
+Uploads read their data through a ThrottledFile, which applies the rate
+limit and reports progress as boto sends the data.
+"""
+import logging
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+# Up to this many seconds of unused rate may be used in a burst
+BURST_SECONDS = 1.0
+
+# Relative throughput change considered significant
+RATE_TOLERANCE = 0.05
+
+# Seconds between two progress reports of an upload
+REPORT_INTERVAL = 10
+
+
+class ConcurrencyController(object):
+    """ Adjusts the number of parts uploaded in parallel
+
+    Throughput is measured over windows of as many parts as are allowed in
+    parallel. After each window, one more part is allowed if throughput
+    grew, one less if it dropped, and half as many after a failure.
+    """
+
+    def __init__(self, maximum, initial=2):
+        """ Constructor
+
+        :type maximum: int
+        :param maximum: Maximum number of parts in parallel
+        :type initial: int
+        :param initial: Number of parts to start with
+        """
+        self.maximum = maximum
+        self.limit = max(1, min(initial, maximum))
+
+        self._active = 0
+        self._condition = threading.Condition()
+        self._previous_rate = None
+        self._window_bytes = 0
+        self._window_parts = 0
+        self._window_start = time.time()
+
+    def acquire(self):
+        """ Wait until another part may be uploaded """
+        with self._condition:
+            while self._active >= self.limit:
+                self._condition.wait()
+            self._active += 1
+
+    def release(self, size, failed=False):
+        """ Report a finished part upload
+
+        :type size: int
+        :param size: Size of the part in bytes
+        :type failed: bool
+        :param failed: True if the upload failed
+        """
+        with self._condition:
+            self._active -= 1
+
+            if failed:
+                self._set_limit(
+                    max(1, self.limit // 2), 'after a failed upload')
+                self._previous_rate = None
+                self._reset_window()
+            else:
+                self._window_bytes += size
+                self._window_parts += 1
+                if self._window_parts >= self.limit:
+                    self._adjust()
+
+            self._condition.notify_all()
+
+    def _adjust(self):
+        """ Adjust the limit to the throughput of the last window """
+        elapsed = max(time.time() - self._window_start, 0.001)
+        rate = self._window_bytes / elapsed
+
+        if (self._previous_rate is None or
+                rate > self._previous_rate * (1 + RATE_TOLERANCE)):
+            self._set_limit(
+                min(self.maximum, self.limit + 1), 'at {}'.format(
+                    format_rate(rate)))
+        elif rate < self._previous_rate * (1 - RATE_TOLERANCE):
+            self._set_limit(
+                max(1, self.limit - 1), 'at {}'.format(format_rate(rate)))
+
+        self._previous_rate = rate
+        self._reset_window()
+
+    def _reset_window(self):
+        """ Start a new measurement window """
+        self._window_bytes = 0
+        self._window_parts = 0
+        self._window_start = time.time()
+
+    def _set_limit(self, limit, reason):
+        """ Change the number of parts in parallel
+
+        :type limit: int
+        :param limit: New limit
+        :type reason: str
+        :param reason: Reason to log
+        """
+        if limit != self.limit:
+            LOGGER.debug('Uploading {:d} parts in parallel {}'.format(
+                limit, reason))
+        self.limit = limit
+
+
+class ProgressReporter(object):
+    """ Logs the progress and throughput of an upload """
+
+    def __init__(self, name, total=None, controller=None):
+        """ Constructor
+
+        :type name: str
+        :param name: Name of the upload to log
+        :type total: int or None
+        :param total: Total number of bytes, None if not known
+        :type controller: ConcurrencyController or None
+        :param controller: Controller to report the concurrency of
+        """
+        self.name = name
+        self.total = total
+        self.controller = controller
+        self.sent = 0
+
+        self._lock = threading.Lock()
+        self._start = time.time()
+        self._last_report = self._start
+        self._last_sent = 0
+
+    def update(self, size):
+        """ Count sent bytes and log the progress now and then
+
+        :type size: int
+        :param size: Number of bytes sent
+        """
+        with self._lock:
+            self.sent += size
+
+            now = time.time()
+            if now - self._last_report < REPORT_INTERVAL:
+                return
+
+            rate = (self.sent - self._last_sent) / (now - self._last_report)
+            self._last_report = now
+            self._last_sent = self.sent
+
+        if self.total:
+            progress = '{:.1f} of {:.1f} MB'.format(
+                self.sent / 1024.0 / 1024.0, self.total / 1024.0 / 1024.0)
+        else:
+            progress = '{:.1f} MB'.format(self.sent / 1024.0 / 1024.0)
+
+        if self.controller:
+            progress += ', {:d} parts in parallel'.format(
+                self.controller.limit)
+
+        LOGGER.info('Uploading {}: {} at {}'.format(
+            self.name, progress, format_rate(rate)))
+
+
+class RateLimiter(object):
+    """ Limits the number of bytes per second sent by several threads """
+
+    def __init__(self, rate):
+        """ Constructor
+
+        :type rate: float
+        :param rate: Maximum rate in bytes per second
+        """
+        self.rate = float(rate)
+
+        self._lock = threading.Lock()
+        self._next = time.time()
+
+    def consume(self, size):
+        """ Wait until size bytes may be sent
+
+        :type size: int
+        :param size: Number of bytes about to be sent
+        """
+        with self._lock:
+            now = time.time()
+            self._next = max(self._next, now - BURST_SECONDS) + \
+                size / self.rate
+            delay = self._next - now
+
+        if delay > 0:
+            time.sleep(delay)
+
+
+class ThrottledFile(object):
+    """ Read only file wrapper applying a rate limit and counting progress
+
+    All other file methods are passed through to the wrapped file.
+    """
+
+    def __init__(self, file_handle, rate_limiter=None, progress=None):
+        """ Constructor
+
+        :type file_handle: file
+        :param file_handle: File to read from
+        :type rate_limiter: RateLimiter or None
+        :param rate_limiter: Rate limit to apply
+        :type progress: ProgressReporter or None
+        :param progress: Reporter to count the read bytes in
+        """
+        self._file = file_handle
+        self._rate_limiter = rate_limiter
+        self._progress = progress
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def read(self, size=-1):
+        """ Read data, waiting for the rate limit
+
+        :type size: int
+        :param size: Maximum number of bytes to read, all if negative
+        :returns: str -- Data
+        """
+        data = self._file.read(size)
+        if data:
+            if self._rate_limiter:
+                self._rate_limiter.consume(len(data))
+            if self._progress:
+                self._progress.update(len(data))
+
+        return data
+
+
+def format_rate(rate):
+    """ Format a throughput for log messages
+
+    :type rate: float
+    :param rate: Bytes per second
+    :returns: str
+    """
+    return '{:.2f} MB/s'.format(rate / 1024.0 / 1024.0)
@@ -0,0 +1,202 @@
+""" Local ledger of the objects uploaded to S3
+
+Every object cumulus uploads is recorded with its ETag, MD5 and size in a
+SQLite database in the cache directory. Before uploading, the ledger is
+consulted instead of asking S3 whether the object is already there, so
+unchanged bundles can be deployed again without any S3 requests.
+
+Entries can be verified against S3 again after a while, in case objects
+were changed or removed by someone else.
+"""
+import contextlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+LEDGER_NAME = 'uploads.sqlite'
+
+# Wait this many seconds for other processes writing to the ledger
+LOCK_TIMEOUT = 30
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS uploads (
+    endpoint TEXT NOT NULL,
+    bucket TEXT NOT NULL,
+    key TEXT NOT NULL,
+    etag TEXT NOT NULL,
+    md5 TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    uploaded REAL NOT NULL,
+    verified REAL NOT NULL,
+    PRIMARY KEY (endpoint, bucket, key)
+)
+"""
+
+# Ledger files whose schema has been created, and the connections of each
+# thread keyed by ledger file. Connections are reset in forked processes
+_REGISTRY = {
+    'pid': os.getpid(),
+    'created': set(),
+    'local': threading.local()
+}
+_REGISTRY_LOCK = threading.Lock()
+
+
+def forget(ledger_file, endpoint, bucket_name, key_name):
+    """ Remove an object from the ledger
+
+    :type ledger_file: str
+    :param ledger_file: Path to the ledger database
+    :type endpoint: str
+    :param endpoint: S3 endpoint, empty for AWS
+    :type bucket_name: str
+    :param bucket_name: S3 bucket name
+    :type key_name: str
+    :param key_name: S3 key name
+    """
+    with _connect(ledger_file) as connection:
+        connection.execute(
+            'DELETE FROM uploads WHERE endpoint = ? AND bucket = ? '
+            'AND key = ?',
+            (endpoint, bucket_name, key_name))
+
+
+def forget_keys(ledger_file, endpoint, bucket_name, key_names):
+    """ Remove several objects of a bucket from the ledger
+
+    :type ledger_file: str
+    :param ledger_file: Path to the ledger database
+    :type endpoint: str
+    :param endpoint: S3 endpoint, empty for AWS
+    :type bucket_name: str
+    :param bucket_name: S3 bucket name
+    :type key_names: list
+    :param key_names: S3 key names
+    """
+    with _connect(ledger_file) as connection:
+        connection.executemany(
+            'DELETE FROM uploads WHERE endpoint = ? AND bucket = ? '
+            'AND key = ?',
+            [(endpoint, bucket_name, key_name) for key_name in key_names])
+
+
+def lookup(ledger_file, endpoint, bucket_name, key_name):
+    """ Find an object in the ledger
+
+    :type ledger_file: str
+    :param ledger_file: Path to the ledger database
+    :type endpoint: str
+    :param endpoint: S3 endpoint, empty for AWS
+    :type bucket_name: str
+    :param bucket_name: S3 bucket name
+    :type key_name: str
+    :param key_name: S3 key name
+    :returns: dict or None -- etag, md5, size, uploaded and verified of the
+        object, None if it is not in the ledger
+    """
+    with _connect(ledger_file) as connection:
+        row = connection.execute(
+            'SELECT etag, md5, size, uploaded, verified FROM uploads '
+            'WHERE endpoint = ? AND bucket = ? AND key = ?',
+            (endpoint, bucket_name, key_name)).fetchone()
+
+    if not row:
+        return None
+
+    return {
+        'etag': row[0],
+        'md5': row[1],
+        'size': row[2],
+        'uploaded': row[3],
+        'verified': row[4]
+    }
+
+
+def mark_verified(ledger_file, endpoint, bucket_name, key_name):
+    """ Record that an object was found in S3 as recorded
+
+    :type ledger_file: str
+    :param ledger_file: Path to the ledger database
+    :type endpoint: str
+    :param endpoint: S3 endpoint, empty for AWS
+    :type bucket_name: str
+    :param bucket_name: S3 bucket name
+    :type key_name: str
+    :param key_name: S3 key name
+    """
+    with _connect(ledger_file) as connection:
+        connection.execute(
+            'UPDATE uploads SET verified = ? WHERE endpoint = ? '
+            'AND bucket = ? AND key = ?',
+            (time.time(), endpoint, bucket_name, key_name))
+
+
+def record(ledger_file, endpoint, bucket_name, key_name, etag, md5, size):
+    """ Record an uploaded object
+
+    :type ledger_file: str
+    :param ledger_file: Path to the ledger database
+    :type endpoint: str
+    :param endpoint: S3 endpoint, empty for AWS
+    :type bucket_name: str
+    :param bucket_name: S3 bucket name
+    :type key_name: str
+    :param key_name: S3 key name
+    :type etag: str
+    :param etag: ETag of the object, with or without quotes
+    :type md5: str
+    :param md5: MD5 hex digest of the object data
+    :type size: int
+    :param size: Size of the object in bytes
+    """
+    now = time.time()
+    with _connect(ledger_file) as connection:
+        connection.execute(
+            'INSERT OR REPLACE INTO uploads '
+            '(endpoint, bucket, key, etag, md5, size, uploaded, verified) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (
+                endpoint, bucket_name, key_name, etag.replace('"', ''), md5,
+                size, now, now
+            ))
+
+    LOGGER.debug('Recorded s3://{}/{} in the upload ledger'.format(
+        bucket_name, key_name))
+
+
+@contextlib.contextmanager
+def _connect(ledger_file):
+    """ Use the ledger in a transaction, creating it if needed
+
+    Each thread keeps its own connection for the whole run, as SQLite
+    connections cannot be shared between threads or worker processes.
+
+    :type ledger_file: str
+    :param ledger_file: Path to the ledger database
+    :returns: sqlite3.Connection
+    """
+    with _REGISTRY_LOCK:
+        if _REGISTRY['pid'] != os.getpid():
+            _REGISTRY['pid'] = os.getpid()
+            _REGISTRY['local'] = threading.local()
+        local = _REGISTRY['local']
+
+    connections = local.__dict__.setdefault('connections', {})
+    connection = connections.get(ledger_file)
+    if connection is None:
+        connection = sqlite3.connect(ledger_file, timeout=LOCK_TIMEOUT)
+        connections[ledger_file] = connection
+
+    with _REGISTRY_LOCK:
+        created = ledger_file in _REGISTRY['created']
+    if not created:
+        connection.execute(SCHEMA)
+        with _REGISTRY_LOCK:
+            _REGISTRY['created'].add(ledger_file)
+
+    with connection:
+        yield connection
@@ -0,0 +1,558 @@
+""" Multipart uploads of bundles to AWS S3 """
+import base64
+import binascii
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
+
+from boto.exception import S3ResponseError
+from boto.s3.multipart import MultiPartUpload
+
+if sys.platform in ['win32', 'cygwin']:
+    import ntpath as ospath
+else:
+    import os.path as ospath
+
+from cumulus_ds import connection_handler
+from cumulus_ds import throughput
+from cumulus_ds.checksum import (
+    BundleChecksum,
+    get_multipart_etag,
+    get_part_size)
+from cumulus_ds.exceptions import ChecksumMismatchException
+
+LOGGER = logging.getLogger(__name__)
+
+# Longest wait in seconds between two attempts to upload a part
+MAX_RETRY_DELAY = 30
+
+
+def upload_file(
+        bucket, key_name, filename, checksum, concurrency, retries,
+        journal_dir, rate_limiter=None, adaptive=False):
+    """ Upload a file to S3, using a multipart upload for large files
+
+    Parts are uploaded in parallel and each part is retried on failure.
+    Completed parts are recorded in a journal in journal_dir. If the upload
+    is interrupted, the next upload of the same file to the same key
+    continues from the completed parts.
+
+    The progress of the upload is logged while it runs.
+
+    :type bucket: boto.s3.bucket.Bucket
+    :param bucket: Bucket to upload to
+    :type key_name: str
+    :param key_name: Key name of the uploaded object
+    :type filename: str
+    :param filename: Path to the local file
+    :type checksum: cumulus_ds.checksum.BundleChecksum
+    :param checksum: Checksum of the file. Its part size is used for the
+        upload and its part digests are sent along with each part
+    :type concurrency: int
+    :param concurrency: Number of parts to upload in parallel
+    :type retries: int
+    :param retries: Number of retries for each part
+    :type journal_dir: str
+    :param journal_dir: Directory holding upload journals
+    :type rate_limiter: cumulus_ds.throughput.RateLimiter or None
+    :param rate_limiter: Rate limit for the upload
+    :type adaptive: bool
+    :param adaptive: Adjust the number of parts uploaded in parallel to the
+        observed throughput, up to concurrency
+    :returns: str -- ETag of the uploaded object
+    """
+    size = ospath.getsize(filename)
+    part_size = get_part_size(checksum.part_size, size)
+
+    if size <= part_size:
+        key = bucket.new_key(key_name)
+        with open(filename, 'rb') as file_handle:
+            key.set_contents_from_file(
+                throughput.ThrottledFile(
+                    file_handle,
+                    rate_limiter,
+                    throughput.ProgressReporter(key_name, size)),
+                replace=True,
+                md5=(checksum.md5, base64.b64encode(
+                    binascii.unhexlify(checksum.md5))))
+        return key.etag.replace('"', '')
+
+    # Reuse the part digests if the checksum was made with this part size
+    part_digests = None
+    if part_size == checksum.part_size:
+        part_digests = checksum.part_digests
+
+    journal_file = ospath.join(
+        journal_dir,
+        '{}.json'.format(
+            hashlib.md5('{}/{}'.format(bucket.name, key_name)).hexdigest()))
+    journal = _load_journal(
+        journal_file, bucket, key_name, checksum.md5, part_size)
+
+    if journal:
+        LOGGER.info('Resuming upload of {} ({:d} parts already done)'.format(
+            key_name, len(journal['parts'])))
+    else:
+        upload = bucket.initiate_multipart_upload(key_name)
+        journal = {
+            'bucket': bucket.name,
+            'key': key_name,
+            'md5': checksum.md5,
+            'part-size': part_size,
+            'upload-id': upload.id,
+            'parts': {}
+        }
+        _save_journal(journal_file, journal)
+
+    part_count = max(1, -(-size // part_size))
+    controller = None
+    if adaptive:
+        controller = throughput.ConcurrencyController(concurrency)
+    uploader = _PartUploader(
+        bucket.name,
+        key_name,
+        journal['upload-id'],
+        retries,
+        rate_limiter=rate_limiter,
+        controller=controller,
+        progress=throughput.ProgressReporter(key_name, size, controller))
+    lock = threading.Lock()
+
+    def upload_part(part_number):
+        """ Read and upload one part of the file """
+        with open(filename, 'rb') as file_handle:
+            file_handle.seek((part_number - 1) * part_size)
+            data = file_handle.read(part_size)
+
+        if part_digests:
+            digest = part_digests[part_number - 1]
+        else:
+            digest = hashlib.md5(data).digest()
+        uploader.upload(part_number, data, digest)
+
+        with lock:
+            journal['parts'][str(part_number)] = binascii.hexlify(digest)
+            _save_journal(journal_file, journal)
+
+        LOGGER.debug('Uploaded part {:d} of {:d} of {}'.format(
+            part_number, part_count, key_name))
+
+    remaining = [
+        part_number for part_number in range(1, part_count + 1)
+        if str(part_number) not in journal['parts']
+    ]
+
+    pool = ThreadPool(concurrency)
+    try:
+        pool.map(upload_part, remaining, chunksize=1)
+        pool.close()
+    except:
+        pool.terminate()
+        LOGGER.error(
+            'Upload of {} failed. {:d} of {:d} parts are done, '
+            'the upload will be resumed next time'.format(
+                key_name, len(journal['parts']), part_count))
+        raise
+    finally:
+        pool.join()
+
+    upload = MultiPartUpload(bucket)
+    upload.key_name = key_name
+    upload.id = journal['upload-id']
+    etag = upload.complete_upload().etag.replace('"', '')
+    os.remove(journal_file)
+
+    expected = get_multipart_etag([
+        binascii.unhexlify(journal['parts'][str(part_number)])
+        for part_number in range(1, part_count + 1)
+    ])
+    if etag != expected:
+        LOGGER.error('Mismatching ETag for {} ({}, expected {})'.format(
+            key_name, etag, expected))
+        bucket.delete_key(key_name)
+        raise ChecksumMismatchException(
+            'Mismatching ETag for {} ({}, expected {})'.format(
+                key_name, etag, expected))
+
+    return etag
+
+
+def _load_journal(journal_file, bucket, key_name, md5, part_size):
+    """ Load an upload journal, if it can be used to resume an upload
+
+    The journal is only used if it is for the same file and part size, and
+    the multipart upload still exists in S3. Parts that S3 does not know
+    about are removed from the journal.
+
+    :type journal_file: str
+    :param journal_file: Path to the journal
+    :type bucket: boto.s3.bucket.Bucket
+    :param bucket: Bucket to upload to
+    :type key_name: str
+    :param key_name: Key name of the uploaded object
+    :type md5: str
+    :param md5: MD5 hex digest of the file
+    :type part_size: int
+    :param part_size: Part size in bytes
+    :returns: dict or None -- The journal
+    """
+    if not ospath.exists(journal_file):
+        return None
+
+    try:
+        with open(journal_file, 'r') as file_handle:
+            journal = json.load(file_handle)
+    except ValueError:
+        LOGGER.warning('Ignoring broken upload journal {}'.format(
+            journal_file))
+        return None
+
+    upload = MultiPartUpload(bucket)
+    upload.key_name = key_name
+    upload.id = journal['upload-id']
+
+    if journal['md5'] != md5 or journal['part-size'] != part_size:
+        LOGGER.info('Bundle has changed since the last upload attempt')
+        try:
+            upload.cancel_upload()
+        except S3ResponseError:
+            pass
+        return None
+
+    try:
+        uploaded = dict([
+            (str(part.part_number), part.etag.replace('"', ''))
+            for part in upload
+        ])
+    except S3ResponseError as error:
+        LOGGER.info('Can not resume upload {}: {}'.format(
+            journal['upload-id'], error.reason))
+        return None
+
+    journal['parts'] = dict([
+        (part_number, digest)
+        for part_number, digest in journal['parts'].items()
+        if uploaded.get(part_number) == digest
+    ])
+
+    return journal
+
+
+def _save_journal(journal_file, journal):
+    """ Write an upload journal
+
+    :type journal_file: str
+    :param journal_file: Path to the journal
+    :type journal: dict
+    :param journal: Journal content
+    """
+    if not ospath.exists(ospath.dirname(journal_file)):
+        os.makedirs(ospath.dirname(journal_file))
+
+    with open('{}.tmp'.format(journal_file), 'w') as file_handle:
+        json.dump(journal, file_handle)
+
+    if sys.platform in ['win32', 'cygwin'] and ospath.exists(journal_file):
+        os.remove(journal_file)
+    os.rename('{}.tmp'.format(journal_file), journal_file)
+
+
+class MultipartUploadStream(object):
+    """ Write only file object uploading its content to S3
+
+    Everything written is cut into parts of part_size bytes. Each part is
+    uploaded in a background thread as soon as it is complete, so the
+    upload runs while the rest of the data is produced. At most
+    concurrency + 1 parts are held in memory at any time.
+
+    The checksum of the stream is calculated as the data is written. The
+    ETag of the completed upload is verified against it when the stream is
+    closed.
+    """
+
+    def __init__(
+            self, bucket, key_name, part_size, concurrency, retries=0,
+            metadata=None, rate_limiter=None, adaptive=False):
+        """ Constructor
+
+        :type bucket: boto.s3.bucket.Bucket
+        :param bucket: Bucket to upload to
+        :type key_name: str
+        :param key_name: Key name of the uploaded object
+        :type part_size: int
+        :param part_size: Part size in bytes
+        :type concurrency: int
+        :param concurrency: Number of parts to upload in parallel
+        :type retries: int
+        :param retries: Number of retries for each part
+        :type metadata: dict or None
+        :param metadata: S3 metadata of the uploaded object
+        :type rate_limiter: cumulus_ds.throughput.RateLimiter or None
+        :param rate_limiter: Rate limit for the upload
+        :type adaptive: bool
+        :param adaptive: Adjust the number of parts uploaded in parallel to
+            the observed throughput, up to concurrency
+        """
+        self.bucket = bucket
+        self.key_name = key_name
+        self.checksum = BundleChecksum(part_size)
+        self.part_size = self.checksum.part_size
+        self.etag = None
+
+        self._buffer = []
+        self._buffered = 0
+        self._parts = 0
+        self._results = []
+        self._error = None
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._pool = ThreadPool(concurrency)
+        self._upload = bucket.initiate_multipart_upload(
+            key_name, metadata=metadata)
+
+        controller = None
+        if adaptive:
+            controller = throughput.ConcurrencyController(concurrency)
+        self._uploader = _PartUploader(
+            bucket.name,
+            key_name,
+            self._upload.id,
+            retries,
+            rate_limiter=rate_limiter,
+            controller=controller,
+            progress=throughput.ProgressReporter(
+                key_name, controller=controller))
+        self._closed = False
+
+        LOGGER.debug('Initiated multipart upload {} for {}'.format(
+            self._upload.id, key_name))
+
+    def abort(self):
+        """ Cancel the upload and discard all uploaded parts """
+        if self._closed:
+            return
+
+        self._closed = True
+        self._pool.terminate()
+        self._pool.join()
+
+        LOGGER.warning('Aborting multipart upload of {}'.format(
+            self.key_name))
+        self._upload.cancel_upload()
+
+    def close(self):
+        """ Upload the last part and complete the upload
+
+        :returns: str -- ETag of the uploaded object
+        """
+        if self._closed:
+            return self.etag
+
+        if self._buffered or not self._parts:
+            self._submit_part(''.join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+
+        self._pool.close()
+        for result in self._results:
+            result.get()
+        self._pool.join()
+
+        self._closed = True
+        completed = self._upload.complete_upload()
+        self.etag = completed.etag.replace('"', '')
+
+        if not self.checksum.matches_etag(self.etag):
+            LOGGER.error('Mismatching ETag for {} ({}, MD5 {})'.format(
+                self.key_name, self.etag, self.checksum.md5))
+            self.bucket.delete_key(self.key_name)
+            raise ChecksumMismatchException(
+                'Mismatching ETag for {} ({}, MD5 {})'.format(
+                    self.key_name, self.etag, self.checksum.md5))
+
+        LOGGER.debug('Completed multipart upload of {} ({} parts)'.format(
+            self.key_name, self._parts))
+
+        return self.etag
+
+    def flush(self):
+        """ Data is flushed part by part, so this is a no-op """
+        pass
+
+    def tell(self):
+        """ Returns the number of bytes written
+
+        :returns: int
+        """
+        return self.checksum.size
+
+    def write(self, data):
+        """ Write data to the upload
+
+        Blocks while the maximum number of parts are being uploaded.
+
+        :type data: str
+        :param data: Data to write
+        """
+        if not data:
+            return
+
+        self.checksum.update(data)
+        self._buffer.append(data)
+        self._buffered += len(data)
+
+        if self._buffered < self.part_size:
+            return
+
+        data = ''.join(self._buffer)
+        offset = 0
+        while len(data) - offset >= self.part_size:
+            self._submit_part(data[offset:offset + self.part_size])
+            offset += self.part_size
+
+        self._buffer = [data[offset:]]
+        self._buffered = len(data) - offset
+
+    def _submit_part(self, data):
+        """ Queue a part for upload
+
+        :type data: str
+        :param data: Part data
+        """
+        self._parts += 1
+        part_number = self._parts
+        digest = self.checksum.part_digests[part_number - 1]
+
+        # Fail early if an upload has already failed
+        if self._error:
+            raise self._error
+
+        self._slots.acquire()
+        self._results.append(self._pool.apply_async(
+            self._upload_part,
+            (part_number, data, digest)))
+
+    def _upload_part(self, part_number, data, digest):
+        """ Upload a part. Executed in the upload threads
+
+        :type part_number: int
+        :param part_number: Part number, starting at 1
+        :type data: str
+        :param data: Part data
+        :type digest: str
+        :param digest: Binary MD5 digest of data
+        """
+        try:
+            self._uploader.upload(part_number, data, digest)
+        except Exception as error:
+            self._error = error
+            raise
+        finally:
+            self._slots.release()
+
+
+class _PartUploader(object):
+    """ Upload parts of a multipart upload from several threads
+
+    Each thread uses its own S3 connection.
+    """
+
+    def __init__(
+            self, bucket_name, key_name, upload_id, retries,
+            rate_limiter=None, controller=None, progress=None):
+        """ Constructor
+
+        :type bucket_name: str
+        :param bucket_name: Bucket name
+        :type key_name: str
+        :param key_name: Key name of the uploaded object
+        :type upload_id: str
+        :param upload_id: Multipart upload ID
+        :type retries: int
+        :param retries: Number of retries for each part
+        :type rate_limiter: cumulus_ds.throughput.RateLimiter or None
+        :param rate_limiter: Rate limit for the part uploads
+        :type controller: cumulus_ds.throughput.ConcurrencyController or None
+        :param controller: Controller limiting the parts uploaded at once
+        :type progress: cumulus_ds.throughput.ProgressReporter or None
+        :param progress: Reporter to count the uploaded bytes in
+        """
+        self.bucket_name = bucket_name
+        self.key_name = key_name
+        self.upload_id = upload_id
+        self.retries = retries
+        self.rate_limiter = rate_limiter
+        self.controller = controller
+        self.progress = progress
+        self._local = threading.local()
+
+    def upload(self, part_number, data, digest):
+        """ Upload a part, retrying on failure
+
+        :type part_number: int
+        :param part_number: Part number, starting at 1
+        :type data: str
+        :param data: Part data
+        :type digest: str
+        :param digest: Binary MD5 digest of data. boto verifies the part
+            ETag against it
+        """
+        attempt = 0
+        while True:
+            if self.controller:
+                self.controller.acquire()
+
+            try:
+                LOGGER.debug('Uploading part {:d} of {} ({:d} bytes)'.format(
+                    part_number, self.key_name, len(data)))
+
+                self._get_upload().upload_part_from_file(
+                    throughput.ThrottledFile(
+                        StringIO(data), self.rate_limiter, self.progress),
+                    part_number,
+                    md5=(
+                        binascii.hexlify(digest),
+                        base64.b64encode(digest)),
+                    size=len(data))
+            except Exception as error:
+                if self.controller:
+                    self.controller.release(len(data), failed=True)
+
+                if attempt >= self.retries:
+                    raise
+
+                attempt += 1
+                delay = min(2 ** attempt, MAX_RETRY_DELAY)
+                LOGGER.warning(
+                    'Upload of part {:d} of {} failed ({}). '
+                    'Retrying in {:d} seconds'.format(
+                        part_number, self.key_name, error, delay))
+
+                # Start over with a new upload object, boto replaces failed
+                # HTTP connections itself
+                self._local.__dict__.pop('upload', None)
+                time.sleep(delay)
+            else:
+                if self.controller:
+                    self.controller.release(len(data))
+                return
+
+    def _get_upload(self):
+        """ Returns a MultiPartUpload with a connection for this thread
+
+        :returns: boto.s3.multipart.MultiPartUpload
+        """
+        if not hasattr(self._local, 'upload'):
+            bucket = connection_handler.connect_s3().get_bucket(
+                self.bucket_name, validate=False)
+            upload = MultiPartUpload(bucket)
+            upload.key_name = self.key_name
+            upload.id = self.upload_id
+            self._local.upload = upload
+
+        return self._local.upload